@@ -0,0 +1,155 @@
+"""Semantic cache of knowledge base chat answers.
+
+The first question of a /chat session costs an embedding, a Pinecone query
+and an LLM call. Users often ask it again in other words: an answer is
+reused when the embedding of the new question has a cosine similarity of at
+least ANSWER_CACHE_SIMILARITY with a cached question of the same user, and
+the user's knowledge base has not changed since it was answered.
+
+Entries live in Redis, shared by the webhook workers:
+- answer_cache:{user}:version  knowledge base version, bumped by invalidate()
+                               whenever notes or chats of the user are uploaded
+- answer_cache:{user}:vectors  entry id -> normalized question embedding (float16)
+- answer_cache:{user}:entries  entry id -> answer, sources and their version
+- answer_cache:{user}:used     entry id -> last use, the least recently used
+                               entries beyond ANSWER_CACHE_MAX_ENTRIES are evicted
+
+All keys expire ANSWER_CACHE_TTL after the last write. The cache is an
+optimization: Redis errors are logged and treated as misses.
+"""
+
+import os
+import time
+import uuid
+import logging
+from dataclasses import dataclass, field
+
+import numpy as np
+import orjson
+from langchain_core.documents import Document
+from redis.exceptions import RedisError
+
+from metrics import ANSWER_CACHE_EVICTIONS, ANSWER_CACHE_LOOKUPS
+
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 50))
+ANSWER_CACHE_TTL = 7 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheLookup:
+    # Knowledge base version the lookup saw, an answer computed after a miss is stored with it
+    version: int
+    answer: str | None = None
+    documents: list[Document] = field(default_factory=list)
+
+
+def _keys(user_id: int) -> tuple[str, str, str, str]:
+    prefix = f'answer_cache:{user_id}'
+    return f'{prefix}:version', f'{prefix}:vectors', f'{prefix}:entries', f'{prefix}:used'
+
+
+def _normalize(embedding: list[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+
+    def __init__(self, redis=None, similarity: float = ANSWER_CACHE_SIMILARITY, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        # redis.asyncio.Redis returning bytes, None disables the cache
+        self.redis = redis
+        self.similarity = similarity
+        self.max_entries = max_entries
+
+    async def get(self, user_id: int, embedding: list[float]) -> CacheLookup:
+
+        if self.redis is None:
+            return CacheLookup(0)
+
+        version_key, vectors_key, entries_key, used_key = _keys(user_id)
+        try:
+            version, vectors = await self.redis.pipeline(transaction=False).get(version_key).hgetall(vectors_key).execute()
+            lookup = CacheLookup(int(version or 0))
+            if not vectors:
+                ANSWER_CACHE_LOOKUPS.inc(result='miss')
+                return lookup
+
+            ids = list(vectors)
+            matrix = np.frombuffer(b''.join(vectors[entry_id] for entry_id in ids), dtype=np.float16).reshape(len(ids), -1)
+            similarities = matrix.astype(np.float32) @ _normalize(embedding)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity:
+                ANSWER_CACHE_LOOKUPS.inc(result='miss')
+                return lookup
+
+            entry = await self.redis.hget(entries_key, ids[best])
+            entry = orjson.loads(entry) if entry else None
+            if entry is None or entry['version'] != lookup.version:
+                # Answered from an older knowledge base, invalidate() raced with the write
+                await self.redis.pipeline(transaction=False).hdel(vectors_key, ids[best]).hdel(entries_key, ids[best]).zrem(used_key, ids[best]).execute()
+                ANSWER_CACHE_LOOKUPS.inc(result='stale')
+                return lookup
+
+            await self.redis.zadd(used_key, {ids[best]: time.time()})
+        except (RedisError, ValueError):
+            logger.exception(f'Answer cache lookup failed for user {user_id}')
+            return CacheLookup(0)
+
+        ANSWER_CACHE_LOOKUPS.inc(result='hit')
+        lookup.answer = entry['answer']
+        lookup.documents = [Document(page_content=doc['page_content'], metadata=doc['metadata']) for doc in entry['documents']]
+        return lookup
+
+    async def put(self, user_id: int, version: int, embedding: list[float], question: str, answer: str, documents: list[Document]):
+
+        if self.redis is None:
+            return
+
+        version_key, vectors_key, entries_key, used_key = _keys(user_id)
+        entry_id = uuid.uuid4().hex[:16]
+        entry = {
+            'question': question,
+            'answer': answer,
+            'version': version,
+            'documents': [{'page_content': doc.page_content, 'metadata': doc.metadata} for doc in documents],
+        }
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.hset(vectors_key, entry_id, _normalize(embedding).astype(np.float16).tobytes())
+            pipeline.hset(entries_key, entry_id, orjson.dumps(entry, default=str))
+            pipeline.zadd(used_key, {entry_id: time.time()})
+            # Least recently used entries over the cap
+            pipeline.zrange(used_key, 0, -self.max_entries - 1)
+            for key in (version_key, vectors_key, entries_key, used_key):
+                pipeline.expire(key, ANSWER_CACHE_TTL)
+            evicted = (await pipeline.execute())[3]
+
+            if evicted:
+                await self.redis.pipeline(transaction=False).hdel(vectors_key, *evicted).hdel(entries_key, *evicted).zrem(used_key, *evicted).execute()
+                ANSWER_CACHE_EVICTIONS.inc(len(evicted))
+        except RedisError:
+            logger.exception(f'Failed to cache an answer for user {user_id}')
+
+    async def invalidate(self, user_id: int):
+        """Drop the answers of a user, their knowledge base changed."""
+
+        if self.redis is None:
+            return
+
+        version_key, vectors_key, entries_key, used_key = _keys(user_id)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.incr(version_key)
+            pipeline.expire(version_key, ANSWER_CACHE_TTL)
+            pipeline.delete(vectors_key, entries_key, used_key)
+            await pipeline.execute()
+        except RedisError:
+            logger.exception(f'Failed to invalidate the answer cache of user {user_id}')
+
+
+# Connected to the bot's Redis in bot.py
+ANSWER_CACHE = AnswerCache()
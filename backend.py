@@ -1,33 +1,34 @@
 import os
 import sys
+import asyncio
+import functools
+import importlib
 import aiofiles
 from aiocsv import AsyncWriter
 import datetime
 import logging
 import random
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 from dataclasses import dataclass
 import polars as pl
 
-from langchain_openai import OpenAIEmbeddings
-from langchain_pinecone.vectorstores import Pinecone
-from langchain_community.document_loaders import TextLoader, PDFMinerLoader, CSVLoader, PolarsDataFrameLoader
-from langchain.docstore.document import Document
-from langchain_text_splitters import CharacterTextSplitter
+from langchain_core.documents import Document
 from polars import DataFrame
 
-from langchain.agents.openai_assistant import OpenAIAssistantRunnable
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.retrieval import create_retrieval_chain
-from langchain.tools import Tool
-from langchain.agents import AgentExecutor
-from langchain_community.tools import DuckDuckGoSearchRun
 
-
-from models import TelegramUser
+from models import Note, TelegramUser
+from chunking import TokenChunker, ChunkStats, window_conversation
+from context_packer import CONTEXT_CANDIDATES, pack_context
+from conversation import Conversation
+from answer_cache import ANSWER_CACHE, CacheLookup
+from inline_search import INLINE_SEARCH
+from retrieval import FETCH_K_FACTOR, fetch_candidates, select_distinct
+from search_filters import NOTE_TYPE
+from import_archive import ImportArchive, SeenIndex, WindowIndex, chat_key, message_fingerprints, window_fingerprint
+from term_stats import TermStatsIndex, CHAT_KIND, NOTES_KIND
 from generate_schema import init
+from metrics import CONTEXT_TOKENS, measure, timed, track, openai_http_client
+from tracing import langchain_config
 from tortoise import Tortoise
 
 import dotenv
@@ -39,6 +40,16 @@ class AssistantMessage:
     text: str
     thread_id: str
 
+@dataclass
+class ImportSummary:
+    new: int
+    edited: int
+    unchanged: int
+    chunk_stats: Optional[ChunkStats] = None
+
+    def __str__(self):
+        return f'{self.new} new / {self.edited} edited / {self.unchanged} unchanged messages'
+
 ASSISTANT_PROMPT = '''
 You are a helpful assistant that helps users with their notes. User can search his knowledge base, chat with the assistant, and add new notes.
 The assistant should be able to understand the context of the conversation and provide relevant responses.
@@ -52,6 +63,7 @@ Here is the list of comands in telegram bot:
 "/link 🔗 - Invite friends with discount\n"
 "/subscribe ✅ - Your access to the bot\n"
 "/update 🔄 - Update the vector store\n"
+"/cloud ☁️ - Wordcloud of your notes and chats\n"
 "/help ℹ️ - What can I do?"
 Here thie info about the bot:
 "✨ <b>Добро пожаловать в Saved AI!</b> ✨\n\n"
@@ -69,25 +81,71 @@ Below is the context, including found relevant documents.
 '''
 
 ASSISTANT_PROMPT_RAG = '''
-You are an assistant for question-answering tasks. You should take into account text of the message and also this meta info to understand who sent the message:
-- From the chat: it's a name of the dialoge the user imported (ignore it unless user asks about the particular imported chat)
+You are an assistant for question-answering tasks. Documents from imported chats are fragments of a conversation, one message per line in the format "Sender: message" or "Sender (forwarded from Original sender): message":
 - Sender: it's the person who sent the message, take attention to the sender, this is IMPORTANT information
 - Forwarded from: if the message was forwarded, it's the original sender
-If these fields are not provided, assume that the message is sent by the user, it's his own note.
+- From the chat: the last line, it's a name of the dialoge the user imported (ignore it unless user asks about the particular imported chat)
+If there are no senders in the document, assume that it is sent by the user, it's his own note.
 
 Язык по умолчанию - русский, но пользователь может использовать любой язык для заметок и общения с ассистентом, ассистент должен понимать и отвечать том же языке, который использует пользователь.
 
 {context}
 '''
 
-RAG_PROMPT = ChatPromptTemplate.from_messages(
-    [
-        ("system", ASSISTANT_PROMPT_RAG),
-        ("human", "{input}"),
-    ]
+# LangChain, OpenAI and Pinecone take seconds to import, they are imported on first use
+# and the clients below are created then. warm_up() does it ahead of the first request.
+HEAVY_MODULES = (
+    'openai',
+    'langchain_openai',
+    'langchain_pinecone.vectorstores',
+    'langchain_community.document_loaders',
+    'langchain.chains.combine_documents',
 )
 
-LLM = ChatOpenAI(model="gpt-4o-mini", temperature=0.6)
+@functools.cache
+def get_rag_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", ASSISTANT_PROMPT_RAG),
+            ("human", "{input}"),
+        ]
+    )
+
+# One connection pool for every OpenAI call, its transport records latency and token usage
+@functools.cache
+def get_openai_http_client():
+    return openai_http_client()
+
+@functools.cache
+def get_llm():
+    from langchain_openai import ChatOpenAI
+
+    # stream_usage: streamed answers report their tokens too
+    return ChatOpenAI(model="gpt-4o-mini", temperature=0.6, stream_usage=True, http_async_client=get_openai_http_client())
+
+@functools.cache
+def get_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model='text-embedding-3-small', http_async_client=get_openai_http_client())
+
+# One client per index, Pinecone's own API for what the LangChain vector store doesn't offer
+@functools.cache
+def get_pinecone_index(index_name: str):
+    from pinecone import Pinecone
+
+    return Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index(index_name)
+
+def warm_up():
+    """Import the heavy modules and create the clients, e.g. in a thread right after startup."""
+
+    for module in HEAVY_MODULES:
+        importlib.import_module(module)
+    get_rag_prompt()
+    get_llm()
+    get_embeddings()
 
 INDEX_NAMES = (
     'saved-ai-1',
@@ -95,7 +153,13 @@ INDEX_NAMES = (
     'saved-ai-3'
 )
 
-EMBEDDINGS = OpenAIEmbeddings(model='text-embedding-3-small')
+# Most ids a Pinecone delete request takes
+PINECONE_DELETE_BATCH = 1000
+
+# Notes and chat messages are mostly shorter than one chunk and are embedded as is
+CHUNKER = TokenChunker()
+
+logger = logging.getLogger(__name__)
 
 async def handle_event(event_text: str):
     """
@@ -110,67 +174,102 @@ async def handle_event(event_text: str):
         # If parsing fails, just print the event_text
         print(f"Could not parse datetime from event: {event_text}")
 
-# Define the custom tool
-event_tool = Tool(
-    name="EventHandler",
-    func=handle_event,
-    description="Handles any events or deadlines mentioned by the user by extracting and printing the datetime."
-)
-
-TOOLS = []
-
 async def fetch_stats(index_name: str, namespace: str):
     # TODO: Implement this function to fetch stats from Pinecone
     pass
 
-async def start_kb_chat(user: TelegramUser, message: str):
+async def list_vector_ids(index_name: str, namespace: str, prefix: str) -> list[str]:
 
-    vector_store = Pinecone.from_existing_index(
-        index_name=user.index_name,
-        namespace=user.vector_storage_namespace,
-        embedding=EMBEDDINGS
-    )
+    def list_ids():
+        return [vector_id for page in get_pinecone_index(index_name).list(prefix=prefix, namespace=namespace) for vector_id in page]
 
-    retriever = vector_store.as_retriever()
+    with track('pinecone', 'list'):
+        return await asyncio.to_thread(list_ids)
 
-    question_answer_chain = create_stuff_documents_chain(LLM, RAG_PROMPT)
-    rag_chain = create_retrieval_chain(retriever, question_answer_chain)
+async def delete_vectors(index_name: str, namespace: str, ids: list[str]):
 
-    result = await rag_chain.ainvoke({'input': message})
+    index = get_pinecone_index(index_name)
+    for i in range(0, len(ids), PINECONE_DELETE_BATCH):
+        await asyncio.to_thread(index.delete, ids=ids[i:i + PINECONE_DELETE_BATCH], namespace=namespace)
 
-    agent = await OpenAIAssistantRunnable.acreate_assistant(
-        name='notes-ai-pincone',
-        instructions=ASSISTANT_PROMPT,
-        model='gpt-4o-mini',
-        tools=TOOLS,
-        as_agent=True
-    )
+@timed('start_kb_chat')
+async def start_kb_chat(user: TelegramUser, message: str, metadata_filter: dict | None = None) -> tuple[dict, Conversation]:
+    """Answer the first question of a chat, `metadata_filter` (see search_filters.py) narrows the retrieval."""
+
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+
+    embedding = await get_embeddings().aembed_query(message)
 
-    relevant_docs = result.get('context', [])
-    relevant_contents = list(set([doc.page_content for doc in relevant_docs]))
-    relevant_contents.append(result.get('answer', ''))
-    relevant_contents.append('Carefully analyze relevant documents provided above and just say "OK"')
-    context = "\n\n".join([pc for pc in relevant_contents])
-    agent_executor = AgentExecutor(agent=agent, tools=TOOLS)
-    response = await agent_executor.ainvoke({'content': context})
-    thread_id = response['thread_id']
+    # A question close to an earlier one over the same knowledge base gets the same answer,
+    # the cache doesn't know filters and is skipped for filtered questions
+    cached = await ANSWER_CACHE.get(user.telegram_id, embedding) if metadata_filter is None else CacheLookup(0)
+    if cached.answer is not None:
+        logger.info(f'Answer of user {user.telegram_id} from the cache')
+        return new_conversation(message, cached.answer, cached.documents)
 
-    return result, thread_id, agent.assistant_id
+    with track('pinecone', 'query'):
+        docs, scores, vectors = await fetch_candidates(
+            get_pinecone_index(user.index_name), user.vector_storage_namespace,
+            embedding, CONTEXT_CANDIDATES * FETCH_K_FACTOR, metadata_filter,
+        )
+    candidates = select_distinct(docs, scores, vectors, embedding, CONTEXT_CANDIDATES)
 
-async def continue_kb_chat(user: TelegramUser, message: str, thread_id, assistant_id):
+    # Only the relevant, non-overlapping part of the candidates within the token budget goes into the prompt
+    packed = pack_context(candidates)
+    CONTEXT_TOKENS.inc(packed.retrieved_tokens, stage='retrieved')
+    CONTEXT_TOKENS.inc(packed.tokens, stage='packed')
+    logger.info(f'Context of user {user.telegram_id}: {packed}')
 
-    agent = OpenAIAssistantRunnable(assistant_id=assistant_id, as_agent=True)
-    agent_executor = AgentExecutor(agent=agent, tools=TOOLS)
-    response = await agent_executor.ainvoke({'content': message, 'thread_id': thread_id})
-    thread_id = response['thread_id']
-    output = response['output']
+    question_answer_chain = create_stuff_documents_chain(get_llm(), get_rag_prompt())
+    answer = await question_answer_chain.ainvoke({'input': message, 'context': packed.documents}, config=langchain_config())
+    if metadata_filter is None:
+        await ANSWER_CACHE.put(user.telegram_id, cached.version, embedding, message, answer, packed.documents)
+
+    return new_conversation(message, answer, packed.documents)
+
+def new_conversation(message: str, answer: str, documents: list[Document]) -> tuple[dict, Conversation]:
+    """Result of the first question of a chat and the conversation it starts."""
+
+    result = {'input': message, 'context': documents, 'answer': answer}
+
+    # Follow-ups are answered from the same documents
+    conversation = Conversation(context='\n\n'.join(doc.page_content for doc in documents))
+    conversation.add(message, answer)
+
+    return result, conversation
+
+@timed('continue_kb_chat')
+async def continue_kb_chat(
+    user: TelegramUser,
+    message: str,
+    conversation: Conversation,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> str:
+    """Answer a follow-up with one streamed completion, `on_text` gets the answer so far after every chunk."""
+
+    llm = get_llm()
+    output = ''
+    async for chunk in llm.astream(conversation.messages(ASSISTANT_PROMPT, message), config=langchain_config()):
+        if not chunk.content:
+            continue
+        output += chunk.content
+        if on_text is not None:
+            await on_text(output)
 
-    return output, thread_id, assistant_id
+    # The caller compacts the conversation once the answer is sent, see Conversation.compact
+    conversation.add(message, output)
 
+    return output
+
+
+async def get_not_uploaded_notes(user: TelegramUser) -> list[Note]:
+    """Notes not embedded yet. Callers keep this one read and mark exactly these notes by id,
+    a note saved in the meantime waits for the next upload instead of being marked unembedded."""
+    return await user.notes.filter(is_vectorized=False).all()
 
 async def generate_csv_from_notes(user: TelegramUser) -> str:
     
-    notes = await user.notes.filter(is_vectorized=False).all()
+    notes = await get_not_uploaded_notes(user)
     notes_data = [["message_id", "text"]] + [[note.telegram_message_id, note.text] for note in notes]
 
     # Generate filename with timestamp
@@ -184,26 +283,37 @@ async def generate_csv_from_notes(user: TelegramUser) -> str:
 
     return filename
 
-async def get_docs_from_not_uploaded_notes(user: TelegramUser) -> list[Document]:
+def note_unix(created_at: datetime.datetime) -> int:
+    """Unix time of a note, created_at is naive UTC (Tortoise's default timezone, use_tz is off)."""
+    return int(created_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def note_documents(notes: list[Note]) -> list[Document]:
 
-    notes = await user.notes.filter(is_vectorized=False).all()
-    notes_data = [{"message_id": note.telegram_message_id, "text": note.text} for note in notes]
+    notes_data = [{"message_id": note.telegram_message_id, "text": note.text, "date": note_unix(note.created_at)} for note in notes]
 
     docs = []
     for note in notes_data:
         docs.append(Document(
             page_content=note['text'],
-            metadata={"source": note['message_id']}
+            # Structured fields the search filters on, see search_filters.py
+            metadata={"source": note['message_id'], "date_unix": note['date'], "date_end_unix": note['date'], "msg_types": [NOTE_TYPE]}
         ))
 
     return docs
 
+async def get_docs_from_not_uploaded_notes(user: TelegramUser) -> list[Document]:
+    return note_documents(await get_not_uploaded_notes(user))
+
+@timed('upload_notes_to_pinecone')
 async def upload_notes_to_pinecone(user: TelegramUser):
 
-    documents = await get_docs_from_not_uploaded_notes(user)
+    from langchain_pinecone.vectorstores import Pinecone
 
-    text_splitter = CharacterTextSplitter(chunk_size=1024, chunk_overlap=256)
-    docs = text_splitter.split_documents(documents)
+    notes = await get_not_uploaded_notes(user)
+    documents = note_documents(notes)
+
+    docs, stats = CHUNKER.split_documents(documents)
+    logger.info(f'Embedding notes of user {user.telegram_id}: {stats}')
 
     if user.index_name:
         index_name = user.index_name
@@ -212,81 +322,136 @@ async def upload_notes_to_pinecone(user: TelegramUser):
         user.index_name = index_name
         await user.save()
 
-    vector_store = await Pinecone.afrom_documents(
-        docs,
-        index_name=index_name,
-        embedding=EMBEDDINGS,
-        namespace=user.vector_storage_namespace,
-    )
-
-    # Mark notes as vectorized
-    await user.notes.filter(is_vectorized=False).update(is_vectorized=True)
-
-    return
-
-async def search_notes(user: TelegramUser, query: str):
-
-    vector_store = Pinecone(
-        index_name=user.index_name,
-        namespace=user.vector_storage_namespace,
-        embedding=EMBEDDINGS
-    )
-
-    search_results = await vector_store.asimilarity_search_with_relevance_scores(query=query, k=5, score_threshold=0.6)
-    
-    # Sort by relevance score, return only docs
-    search_results = [doc for doc, score in sorted(search_results, key=lambda x: x[1], reverse=True)]
-    print(search_results)
-
-    # Remove duplicates
-    unique_search_results = []
-    seen_sources = set()
-
-    for doc in search_results:
-
-        try:
-            source = doc.metadata['source']
-        except KeyError:
-            continue
-        if source not in seen_sources:
-            unique_search_results.append(doc)
-            seen_sources.add(doc.metadata['source'])
-
-        try:
-            date = doc.metadata['date']
-        except KeyError:
-            continue
-        unique_search_results.append(doc)
+    # Pinecone timings include embedding the documents, OpenAI calls are also timed on their own
+    with track('pinecone', 'upsert'):
+        vector_store = await Pinecone.afrom_documents(
+            docs,
+            index_name=index_name,
+            embedding=get_embeddings(),
+            namespace=user.vector_storage_namespace,
+        )
+
+    term_stats = TermStatsIndex(user.telegram_id)
+    await asyncio.to_thread(term_stats.add, notes_frame(user, [{'text': note.text, 'created_at': note.created_at} for note in notes]), NOTES_KIND)
+
+    # Mark the embedded notes as vectorized
+    await user.notes.filter(id__in=[note.id for note in notes]).update(is_vectorized=True)
+
+    # The scheduled update runs for every user, only new notes change the answers
+    if docs:
+        await ANSWER_CACHE.invalidate(user.telegram_id)
+        await INLINE_SEARCH.invalidate(user.telegram_id)
+
+    return stats
+
+def notes_frame(user: TelegramUser, notes: list[dict]) -> DataFrame:
+    """Notes (text and created_at values) as messages for the term statistics."""
+
+    return pl.DataFrame({
+        'msg_content': [note['text'] for note in notes],
+        'sender': [user.first_name] * len(notes),
+        'date': [note['created_at'].isoformat() for note in notes],
+    }, schema={'msg_content': pl.Utf8, 'sender': pl.Utf8, 'date': pl.Utf8})
+
+async def get_term_stats(user: TelegramUser) -> TermStatsIndex:
+    """Term statistics of the user, built from the import archive and the embedded notes the first time."""
+
+    term_stats = TermStatsIndex(user.telegram_id)
+    if not term_stats.exists:
+        # Notes count once they are embedded, upload_notes_to_pinecone adds the others
+        notes = await user.notes.filter(is_vectorized=True).values('text', 'created_at')
+        chats = ImportArchive(user.telegram_id).scan()
+        with measure('term_stats.build'):
+            await asyncio.to_thread(term_stats.build, chats, notes_frame(user, notes))
+    return term_stats
+
+@timed('search_notes')
+async def search_notes(user: TelegramUser, query: str, k: int = 5, metadata_filter: dict | None = None):
+
+    embedding = await get_embeddings().aembed_query(query)
+    with track('pinecone', 'query'):
+        docs, scores, vectors = await fetch_candidates(
+            get_pinecone_index(user.index_name), user.vector_storage_namespace,
+            embedding, k * FETCH_K_FACTOR, metadata_filter,
+        )
+
+    # One result per note or conversation window, near copies collapsed
+    search_results = [doc for doc, _ in select_distinct(docs, scores, vectors, embedding, k, score_threshold=0.6)]
 
     # Update user's queries_count
     user.queries_count += 1
     await user.save()
 
-    return unique_search_results
-
-async def upload_exported_chat_to_pinecone(user: TelegramUser, df: DataFrame, chat_name: str):
-
-    # Create column "text", which is msg_content + \n\n + chat_name
-    df = df.with_columns(
-        (pl.col('msg_content') + f'\nFrom the chat: {chat_name}' + '\n\nSender: ' + pl.col('sender') + '\nForwarded from: ' + pl.col('forwarded_from')).alias('text')
-    )
-    df = df.select(['text', 'date'])
-
-    df = df.with_columns(
-        pl.col('text')
-        .map_elements(lambda x: str(x) if x is not None else None, return_dtype=pl.Utf8)
-        .alias('text')
-    ).filter(pl.col('text').is_not_null())
-
-    unique_filename = f"chat_{chat_name}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-    df.write_csv(unique_filename)
-
-
-    loader = PolarsDataFrameLoader(df, page_content_column='text')
-    documents = loader.load()
-
-    text_splitter = CharacterTextSplitter(chunk_size=1024, chunk_overlap=256)
-    docs = text_splitter.split_documents(documents)
+    return search_results
+
+@timed('upload_exported_chat_to_pinecone')
+async def upload_exported_chat_to_pinecone(user: TelegramUser, df: DataFrame, chat_name: str) -> ImportSummary:
+
+    from langchain_pinecone.vectorstores import Pinecone
+    from langchain_community.document_loaders import PolarsDataFrameLoader
+
+    # Reading, hashing, windowing and writing the archive are CPU and disk bound, they run in
+    # threads to keep the event loop serving other users
+
+    # Re-exports of a chat repeat its whole history, only a chat with new or edited messages is embedded
+    def classify():
+        seen = SeenIndex(user.telegram_id)
+        keys, hashes = message_fingerprints(df, chat_name)
+        return (seen, keys, hashes, *seen.classify(keys, hashes))
+
+    with measure('import.dedup'):
+        seen, keys, hashes, new, edited = await asyncio.to_thread(classify)
+    fresh = new | edited
+    summary = ImportSummary(new=int(new.sum()), edited=int(edited.sum()), unchanged=int((~fresh).sum()))
+    logger.info(f'Chat "{chat_name}" of user {user.telegram_id}: {summary}')
+
+    # Keep the parsed chat, the source JSON is deleted after parsing. The archived versions
+    # of edited messages are read first, their terms are taken out of the term statistics
+    archive = ImportArchive(user.telegram_id)
+
+    def archive_chat() -> pl.DataFrame:
+        archived = archive.scan(chat_name)
+        edited_versions = (
+            archived.filter(pl.col('msg_id').is_in(df.filter(pl.Series(edited))['msg_id'].cast(pl.Int64, strict=False).implode())).collect()
+            if archived is not None and edited.any() else pl.DataFrame()
+        )
+        archive.add_chat(df, chat_name)
+        return edited_versions
+
+    with measure('import.archive'):
+        edited_versions = await asyncio.to_thread(archive_chat)
+
+    if not fresh.any():
+        return summary
+
+    # One document per conversation window instead of per message. A window depends on its
+    # neighbours, so the whole archived chat is windowed again and only changed windows are embedded
+    def window_chat() -> tuple[pl.DataFrame, pl.DataFrame]:
+        chat_df = archive.scan(chat_name).drop('chat_name').collect()
+        return chat_df, window_conversation(chat_df, chat_name)
+
+    with measure('import.window'):
+        chat_df, windows = await asyncio.to_thread(window_chat)
+    logger.info(f'Chat "{chat_name}": {chat_df.height} messages -> {windows.height} windows')
+
+    def chunk_windows():
+        documents = PolarsDataFrameLoader(windows, page_content_column='text').load()
+        for doc in documents:
+            # Pinecone rejects null metadata, e.g. chat_id of an export without one
+            doc.metadata = {key: value for key, value in doc.metadata.items() if value is not None}
+        return CHUNKER.split_documents(documents)
+
+    with measure('import.chunk'):
+        docs, stats = await asyncio.to_thread(chunk_windows)
+
+    # Deterministic ids, an unchanged window keeps its id and a retried import overwrites instead of duplicating
+    key = chat_key(chat_df, chat_name)
+    chunk_numbers = {}
+    ids = []
+    for doc in docs:
+        first_msg_id = doc.metadata['msg_ids'][0]
+        chunk_numbers[first_msg_id] = chunk_numbers.get(first_msg_id, -1) + 1
+        ids.append(f'chat_{key}_{first_msg_id}_{chunk_numbers[first_msg_id]}')
 
     if user.index_name:
         index_name = user.index_name
@@ -295,11 +460,47 @@ async def upload_exported_chat_to_pinecone(user: TelegramUser, df: DataFrame, ch
         user.index_name = index_name
         await user.save()
 
-    vector_store = await Pinecone.afrom_documents(
-        docs,
-        index_name=index_name,
-        embedding=EMBEDDINGS,
-        namespace=user.vector_storage_namespace
-    )
-
-    return
\ No newline at end of file
+    window_index = await asyncio.to_thread(WindowIndex, user.telegram_id)
+    stored = window_index.stored(key)
+    if stored is None:
+        # Chats imported before the window index: their vectors are known by id only and embedded again
+        stored = dict.fromkeys(await list_vector_ids(index_name, user.vector_storage_namespace, f'chat_{key}_'))
+    fingerprints = [window_fingerprint(doc.page_content, doc.metadata['msg_ids']) for doc in docs]
+    changed = [i for i, (vector_id, fingerprint) in enumerate(zip(ids, fingerprints)) if stored.get(vector_id) != fingerprint]
+    replaced = sorted(set(stored) - set(ids))
+
+    summary.chunk_stats = stats
+    logger.info(f'Embedding {len(changed)} of {stats.chunks} chunks of chat "{chat_name}" of user {user.telegram_id}, {len(replaced)} replaced: {stats}')
+
+    if changed:
+        with measure('import.embed_upsert'), track('pinecone', 'upsert'):
+            await Pinecone.afrom_documents(
+                [docs[i] for i in changed],
+                ids=[ids[i] for i in changed],
+                index_name=index_name,
+                embedding=get_embeddings(),
+                namespace=user.vector_storage_namespace
+            )
+    if replaced:
+        with track('pinecone', 'delete'):
+            await delete_vectors(index_name, user.vector_storage_namespace, replaced)
+
+    def save_indexes():
+        window_index.replace(key, ids, fingerprints)
+        window_index.save()
+        seen.add(keys[fresh], hashes[fresh])
+        seen.save()
+
+    await asyncio.to_thread(save_indexes)
+    await ANSWER_CACHE.invalidate(user.telegram_id)
+    await INLINE_SEARCH.invalidate(user.telegram_id)
+
+    def update_term_stats():
+        term_stats = TermStatsIndex(user.telegram_id)
+        term_stats.remove(edited_versions, CHAT_KIND, chat_name)
+        term_stats.add(df.filter(pl.Series(fresh)), CHAT_KIND, chat_name)
+
+    with measure('import.term_stats'):
+        await asyncio.to_thread(update_term_stats)
+
+    return summary
@@ -0,0 +1,107 @@
+"""Startup benchmark: import time and memory of the bot process.
+
+Imports bot.py in fresh interpreters and compares the best import time and
+the RSS after the import with the `startup` entry of benchmarks/baseline.json.
+The run also fails when one of LAZY_MODULES is imported at startup, those are
+loaded on first use or by backend.warm_up after startup.
+
+Usage:
+    python benchmarks/bench_startup.py                    # compare with the baseline
+    python benchmarks/bench_startup.py --update-baseline  # record a new baseline
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+import orjson
+
+from bench_suite import BASELINE_PATH, compare, load_baseline, save_baseline
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy dependencies that must not be imported by `import bot`
+LAZY_MODULES = (
+    'openai',
+    'langchain_openai',
+    'langchain_pinecone',
+    'langchain_community',
+    'langchain.agents',
+    'langsmith',
+    'pinecone',
+    'wordcloud',
+    'matplotlib',
+    'sklearn',
+    'duckduckgo_search',
+)
+
+PROBE = '''
+import sys, time, resource
+import orjson
+started = time.perf_counter()
+import bot
+elapsed = time.perf_counter() - started
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss = rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+print(orjson.dumps({'time_s': elapsed, 'rss_mb': rss, 'modules': [name for name in %r if name in sys.modules]}).decode())
+''' % (LAZY_MODULES,)
+
+# bot.py needs a well-formed token and the clients need keys, nothing is called
+ENVIRONMENT = {
+    'TG_BOT_TOKEN': '123456789:STARTUPBENCHMARKTOKEN',
+    'OPENAI_API_KEY': 'sk-startup-benchmark',
+    'PINECONE_API_KEY': 'pc-startup-benchmark',
+}
+
+
+def measure_startup() -> dict:
+    """Import bot in a fresh interpreter."""
+
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=ROOT, env={**os.environ, **ENVIRONMENT},
+        capture_output=True, text=True, check=True,
+    ).stdout
+    # bot.py may print on import, the result is the last line
+    return orjson.loads(output.strip().splitlines()[-1])
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the import time and memory of bot.py.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--time-tolerance", type=float, default=0.3, help="allowed relative slowdown")
+    parser.add_argument("--memory-tolerance", type=float, default=0.2, help="allowed relative memory growth")
+    args = parser.parse_args()
+
+    runs = [measure_startup() for _ in range(args.repeat)]
+    result = {
+        'time_s': round(min(run['time_s'] for run in runs), 3),
+        'rss_mb': round(min(run['rss_mb'] for run in runs), 1),
+    }
+    eager = sorted({name for run in runs for name in run['modules']})
+
+    baseline = load_baseline(args.baseline)
+    base = baseline.get('startup', {})
+    print(f"import bot: {result['time_s']:.3f} s (baseline {base.get('time_s', '-')}), "
+          f"RSS {result['rss_mb']:.1f} MB (baseline {base.get('rss_mb', '-')})")
+    if eager:
+        print("Imported at startup but should be lazy: " + ', '.join(eager))
+
+    if args.update_baseline:
+        save_baseline(args.baseline, {**baseline, 'startup': result})
+        print(f"Baseline saved to {args.baseline}")
+        regressions = []
+    else:
+        regressions = compare('startup', result, base, args.time_tolerance, args.memory_tolerance)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+
+    if eager or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""Micro-benchmarks of the import pipeline on synthetic Telegram exports.
+
+Every case runs in a fresh process: the best wall time of `--repeat` runs,
+the Python heap peak (tracemalloc) of one more run and the peak RSS growth of
+the process are compared with benchmarks/baseline.json. A case slower or
+bigger than the baseline by more than the tolerance fails the run, so does a
+case missing from the baseline. A case that regressed is run again, up to
+`--attempts` times, and only fails when the best of the runs still regresses.
+RSS is noisy and only fails beyond MIN_RSS_DELTA.
+
+Usage:
+    python benchmarks/bench_suite.py                    # compare with the baseline
+    python benchmarks/bench_suite.py --update-baseline  # record a new baseline
+    python benchmarks/bench_suite.py --only parser_polars clean_text
+"""
+
+import os
+import sys
+import csv
+import time
+import resource
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import multiprocessing
+
+import orjson
+
+# Add the parent directory to the sys.path to allow importing from backend and models
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_export import write_export
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Differences below these are noise whatever the relative change
+MIN_TIME_DELTA = 0.005  # seconds
+MIN_MEMORY_DELTA = 1.0  # MB
+# Peak RSS of identical runs differs by up to tens of MB (allocator arenas, native libraries),
+# the tracemalloc peak is what gates the memory of a case
+MIN_RSS_DELTA = 32.0  # MB
+
+CASES = {}
+
+
+def case(name: str):
+    """Register a case: a function of (messages, workdir) returning the callable to measure."""
+
+    def register(setup):
+        CASES[name] = setup
+        return setup
+
+    return register
+
+
+def export_file(messages: int, workdir: str, chats: int = 1) -> str:
+    return write_export(os.path.join(workdir, f'export_{messages}_{chats}.json'), messages=messages, chats=chats)
+
+
+def parsed_chat(messages: int, workdir: str):
+    from parse_telegram_json_polars import TelegramChatParser
+
+    df, chat_name = TelegramChatParser(max_messages=messages).process(export_file(messages, workdir))
+    return df, chat_name
+
+
+@case('parser_polars')
+def parser_polars(messages: int, workdir: str):
+    from parse_telegram_json_polars import TelegramChatParser
+
+    path = export_file(messages, workdir)
+    return lambda: TelegramChatParser(max_messages=messages).process(path)
+
+
+@case('parser_polars_multichat')
+def parser_polars_multichat(messages: int, workdir: str):
+    from parse_telegram_json_polars import TelegramChatParser
+
+    path = export_file(messages, workdir, chats=5)
+    return lambda: TelegramChatParser(max_messages=messages).process(path)
+
+
+@case('parser_csv')
+def parser_csv(messages: int, workdir: str):
+    import parse_telegram_json_cli_csv
+
+    path = export_file(messages, workdir, chats=5)
+    output_dir = os.path.join(workdir, 'csv')
+    os.makedirs(output_dir, exist_ok=True)
+
+    def run():
+        parser = parse_telegram_json_cli_csv.TelegramChatParser()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data = parser.process(path)
+        # to_csv writes into the working directory
+        cwd = os.getcwd()
+        os.chdir(output_dir)
+        try:
+            parser.to_csv(data)
+        finally:
+            os.chdir(cwd)
+
+    return run
+
+
+@case('clean_text')
+def clean_text_case(messages: int, workdir: str):
+    from text_tools import clean_text
+
+    df, _ = parsed_chat(messages, workdir)
+    texts = df['msg_content'].to_list()
+    return lambda: [clean_text(text) for text in texts]
+
+
+@case('generate_wordcloud')
+def generate_wordcloud_case(messages: int, workdir: str):
+    from text_tools import generate_wordcloud
+
+    df, chat_name = parsed_chat(messages, workdir)
+    return lambda: generate_wordcloud(df, chat_name)
+
+
+@case('window_conversation')
+def window_conversation_case(messages: int, workdir: str):
+    from chunking import get_encoding, window_conversation
+
+    df, chat_name = parsed_chat(messages, workdir)
+    get_encoding()
+    return lambda: window_conversation(df, chat_name)
+
+
+@case('split_documents')
+def split_documents_case(messages: int, workdir: str):
+    from langchain_core.documents import Document
+    from chunking import TokenChunker, get_encoding, window_conversation
+
+    df, chat_name = parsed_chat(messages, workdir)
+    windows = window_conversation(df, chat_name)
+    # Long notes make the chunker actually split
+    documents = [Document(page_content=text, metadata={'date': date}) for text, date in windows.select('text', 'date').iter_rows()]
+    documents += [Document(page_content='\n\n'.join(documents[i + j].page_content for j in range(8))) for i in range(0, len(documents) - 8, 8)]
+    chunker = TokenChunker()
+    get_encoding()
+    return lambda: chunker.split_documents(documents)
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def _run_case(name: str, messages: int, repeat: int) -> dict:
+    """Measure one case, called in a fresh process."""
+
+    with tempfile.TemporaryDirectory() as workdir:
+        fn = CASES[name](messages, workdir)
+        fn()  # warm up caches and lazy imports
+        rss_before = _max_rss_mb()
+
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - started)
+        rss_after = _max_rss_mb()
+
+        tracemalloc.start()
+        fn()
+        _, py_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'time_s': round(min(times), 4),
+        'py_peak_mb': round(py_peak / (1024 * 1024), 2),
+        'rss_growth_mb': round(rss_after - rss_before, 2),
+    }
+
+
+def run_case(name: str, messages: int, repeat: int) -> dict:
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_run_case, (name, messages, repeat))
+
+
+def compare(name: str, result: dict, baseline: dict, time_tolerance: float, memory_tolerance: float) -> list[str]:
+    """Descriptions of the metrics of a case that regressed against the baseline."""
+
+    regressions = []
+    for metric, tolerance, min_delta in (
+        ('time_s', time_tolerance, MIN_TIME_DELTA),
+        ('py_peak_mb', memory_tolerance, MIN_MEMORY_DELTA),
+        ('rss_growth_mb', memory_tolerance, MIN_RSS_DELTA),
+        ('rss_mb', memory_tolerance, MIN_RSS_DELTA),
+    ):
+        if metric not in baseline:
+            continue
+        delta = result[metric] - baseline[metric]
+        if delta > min_delta and delta > baseline[metric] * tolerance:
+            regressions.append(f"{name}.{metric}: {baseline[metric]} -> {result[metric]}")
+    return regressions
+
+
+def best_of(result: dict, other: dict) -> dict:
+    return {metric: min(value, other[metric]) for metric, value in result.items()}
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def save_baseline(path: str, baseline: dict):
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(baseline, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the import pipeline against a stored baseline.")
+    parser.add_argument("--only", nargs="+", choices=sorted(CASES), help="cases to run, all by default")
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--attempts", type=int, default=3, help="runs of a case that regressed before it fails")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--time-tolerance", type=float, default=0.3, help="allowed relative slowdown")
+    parser.add_argument("--memory-tolerance", type=float, default=0.2, help="allowed relative memory growth")
+    parser.add_argument("--report", help="write results as CSV")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    results, regressions, failed, unrecorded = {}, [], [], []
+
+    print(f"{'case':<26} {'time s':>8} {'base':>8} {'py MB':>8} {'base':>8} {'rss MB':>8} {'base':>8}")
+    for name in args.only or CASES:
+        base = baseline.get(name, {})
+        if not base:
+            unrecorded.append(name)
+        elif base.get('messages') != args.messages:
+            print(f"{name:<26} baseline was recorded with {base.get('messages')} messages, not compared")
+            base = {}
+
+        try:
+            result = run_case(name, args.messages, args.repeat)
+            # A regression has to reproduce, a busy machine slows down single runs
+            for _ in range(args.attempts - 1):
+                if args.update_baseline or not compare(name, result, base, args.time_tolerance, args.memory_tolerance):
+                    break
+                result = best_of(result, run_case(name, args.messages, args.repeat))
+        except Exception as e:
+            print(f"{name:<26} failed: {e!r}")
+            failed.append(name)
+            continue
+        results[name] = {**result, 'messages': args.messages}
+
+        print(
+            f"{name:<26} {result['time_s']:>8.3f} {base.get('time_s', '-'):>8} "
+            f"{result['py_peak_mb']:>8.1f} {base.get('py_peak_mb', '-'):>8} "
+            f"{result['rss_growth_mb']:>8.1f} {base.get('rss_growth_mb', '-'):>8}"
+        )
+        regressions += compare(name, result, base, args.time_tolerance, args.memory_tolerance)
+
+    if args.report:
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['case', 'messages', 'time_s', 'py_peak_mb', 'rss_growth_mb'])
+            writer.writeheader()
+            for name, result in results.items():
+                writer.writerow({'case': name, **result})
+
+    if args.update_baseline:
+        save_baseline(args.baseline, {**baseline, **results})
+        print(f"Baseline saved to {args.baseline}")
+    else:
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+        if unrecorded:
+            print(f"\nNot in the baseline, record them with --update-baseline --only {' '.join(unrecorded)}")
+
+    if failed or ((regressions or unrecorded) and not args.update_baseline):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark of generate_wordcloud against the previous TfidfVectorizer implementation.
+
+Usage:
+    python benchmarks/bench_wordcloud.py --sizes 50000 500000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import numpy as np
+import polars as pl
+
+# Add the parent directory to the sys.path to allow importing from backend and models
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_tools import STOPWORDS, clean_text, term_frequencies, render_wordcloud
+
+WORDS_RU = ['привет', 'встреча', 'завтра', 'проект', 'код', 'бот', 'заметка', 'идея', 'книга', 'кофе', 'это', 'как', 'что']
+WORDS_EN = ['meeting', 'tomorrow', 'project', 'code', 'deploy', 'review', 'idea', 'the', 'and', 'release']
+
+
+def synthetic_messages(n: int, seed: int = 0) -> pl.DataFrame:
+    rng = random.Random(seed)
+    vocabulary = WORDS_RU + WORDS_EN + [f'слово{i}' for i in range(2000)]
+    messages = []
+    for _ in range(n):
+        if rng.random() < 0.05:
+            messages.append('(File not included. Change data exporting settings to download.)')
+            continue
+        words = rng.choices(vocabulary, k=rng.randint(1, 25))
+        messages.append(' '.join(words) + rng.choice(['', '!', '?', ' :)', ' https://t.me/x']))
+    return pl.DataFrame({'msg_content': messages})
+
+
+def legacy_term_frequencies(df: pl.DataFrame) -> dict:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer(stop_words=list(STOPWORDS))
+    tfidf_matrix = vectorizer.fit_transform(df['msg_content'].map_elements(clean_text, return_dtype=pl.Object))
+    column_sums = np.array(tfidf_matrix.sum(axis=0)).flatten()
+    return dict(zip(vectorizer.get_feature_names_out(), column_sums))
+
+
+def legacy_render(word_frequencies: dict) -> bytes:
+    from wordcloud import WordCloud
+
+    wordcloud = WordCloud(max_font_size=80, max_words=100, stopwords=STOPWORDS, min_font_size=15)
+    wordcloud.generate_from_frequencies(word_frequencies)
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = os.path.join(tmp, 'wordcloud.png')
+        wordcloud.to_file(image_path)
+        with open(image_path, 'rb') as f:
+            return f.read()
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the wordcloud pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50_000, 500_000])
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    # Imported lazily by the bot, once per process; the first render shouldn't pay for it
+    import wordcloud
+
+    print(f"{'messages':>9} {'impl':<8} {'terms s':>8} {'render s':>9} {'total s':>8}")
+    for size in args.sizes:
+        df = synthetic_messages(size)
+
+        # generate_wordcloud split in its two stages, each timed on its own
+        frequencies, terms_time = timed(term_frequencies, df)
+        _, render_time = timed(render_wordcloud, frequencies)
+        print(f"{size:>9} {'polars':<8} {terms_time:>8.2f} {render_time:>9.2f} {terms_time + render_time:>8.2f}")
+
+        if args.skip_legacy:
+            continue
+        legacy_frequencies, legacy_terms_time = timed(legacy_term_frequencies, df)
+        _, legacy_render_time = timed(legacy_render, legacy_frequencies)
+        print(
+            f"{size:>9} {'sklearn':<8} {legacy_terms_time:>8.2f} {legacy_render_time:>9.2f} "
+            f"{legacy_terms_time + legacy_render_time:>8.2f}"
+        )
+
+        top = sorted(frequencies, key=frequencies.get, reverse=True)[:100]
+        assert all(abs(frequencies[t] - legacy_frequencies[t]) < 1e-6 * max(1, frequencies[t]) for t in top)
+
+
+if __name__ == '__main__':
+    main()
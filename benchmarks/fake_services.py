@@ -0,0 +1,639 @@
+"""Local stand-ins for the Telegram Bot API, OpenAI and Pinecone.
+
+Enough of each API is implemented for the bot's handlers to run unchanged:
+Bot API methods and file downloads (documents are synthetic exports), OpenAI
+embeddings, chat completions (also streamed) and assistants with threads and
+runs, and a brute-force Pinecone index with control and data plane routes.
+
+Every route can be slowed down and made to fail. Faults are configured per
+service ("openai") or per route ("openai.embeddings", "telegram.sendmessage"),
+latency is lognormal around the given median.
+
+Usage:
+    python benchmarks/fake_services.py --latency openai=300 openai.embeddings=80 --errors pinecone=0.01
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import zlib
+import base64
+import random
+import asyncio
+import argparse
+from collections import Counter
+from dataclasses import dataclass, field
+
+import numpy as np
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_export import generate_export
+
+EMBEDDING_DIMENSION = 1536
+
+
+@dataclass
+class Fault:
+    latency_ms: float = 0.0
+    sigma: float = 0.5  # spread of the lognormal latency
+    error_rate: float = 0.0
+
+
+@dataclass
+class ServicesConfig:
+    host: str = '127.0.0.1'
+    telegram_port: int = 8081
+    openai_port: int = 8082
+    pinecone_port: int = 8083
+    faults: dict[str, Fault] = field(default_factory=dict)
+    assistant_run_ms: float = 1000.0
+    pinecone_indexes: tuple[str, ...] = ('saved-ai-1', 'saved-ai-2', 'saved-ai-3')
+    seed: int = 0
+
+    @property
+    def telegram_url(self) -> str:
+        return f'http://{self.host}:{self.telegram_port}'
+
+    @property
+    def openai_url(self) -> str:
+        return f'http://{self.host}:{self.openai_port}/v1'
+
+    @property
+    def pinecone_url(self) -> str:
+        return f'http://{self.host}:{self.pinecone_port}'
+
+
+def parse_faults(latency: list[str], errors: list[str]) -> dict[str, Fault]:
+    """Faults from SERVICE[.ROUTE]=VALUE pairs of the command line."""
+
+    faults: dict[str, Fault] = {}
+    for items, attribute in ((latency, 'latency_ms'), (errors, 'error_rate')):
+        for item in items or []:
+            key, value = item.split('=', 1)
+            setattr(faults.setdefault(key.lower(), Fault()), attribute, float(value))
+    return faults
+
+
+class FakeService:
+    name = ''
+
+    def __init__(self, config: ServicesConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.app = web.Application(middlewares=[self.fault_middleware], client_max_size=64 * 1024 * 1024)
+        self.app.router.add_get('/_stats', self.stats)
+        self.setup_routes()
+
+    def setup_routes(self):
+        raise NotImplementedError
+
+    def route_key(self, request: web.Request) -> str:
+        return request.match_info.route.name or 'other'
+
+    def fault(self, route: str) -> Fault:
+        faults = self.config.faults
+        return faults.get(f'{self.name}.{route}'.lower()) or faults.get(self.name) or Fault()
+
+    def error_response(self) -> web.Response:
+        return web.json_response({'error': {'message': 'Injected failure', 'type': 'server_error'}}, status=500)
+
+    @web.middleware
+    async def fault_middleware(self, request: web.Request, handler):
+
+        if request.path == '/_stats':
+            return await handler(request)
+
+        route = self.route_key(request)
+        self.requests[route] += 1
+        fault = self.fault(route)
+        if fault.latency_ms:
+            await asyncio.sleep(fault.latency_ms * self.rng.lognormvariate(0, fault.sigma) / 1000)
+        if fault.error_rate and self.rng.random() < fault.error_rate:
+            self.errors[route] += 1
+            return self.error_response()
+        return await handler(request)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({'requests': self.requests, 'errors': self.errors})
+
+
+class FakeTelegram(FakeService):
+    """Bot API answering every method, documents are synthetic exports named by their file_id.
+
+    A file_id `export-<messages>-<seed>` downloads an export of that many
+    messages generated with that seed.
+    """
+
+    name = 'telegram'
+
+    MESSAGE_METHODS = {
+        'sendmessage', 'sendphoto', 'senddocument', 'sendinvoice', 'forwardmessage',
+        'sendsticker', 'sendvoice', 'sendvideo', 'editmessagetext',
+    }
+
+    def __init__(self, config: ServicesConfig):
+        super().__init__(config)
+        self.message_id = 0
+        self.exports: dict[str, bytes] = {}
+
+    def setup_routes(self):
+        self.app.router.add_post('/bot{token}/{method}', self.method, name='method')
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self.file, name='file')
+
+    def route_key(self, request: web.Request) -> str:
+        if 'method' in request.match_info:
+            return request.match_info['method'].lower()
+        return super().route_key(request)
+
+    def error_response(self) -> web.Response:
+        return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error: injected failure'}, status=500)
+
+    def _message(self, data) -> dict:
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+        }
+        if data.get('text'):
+            message['text'] = data['text']
+        if data.get('caption'):
+            message['caption'] = data['caption']
+        return message
+
+    def _export(self, file_id: str) -> bytes:
+        if file_id not in self.exports:
+            match = re.fullmatch(r'export-(\d+)-(\d+)', file_id)
+            messages, seed = (int(match[1]), int(match[2])) if match else (100, 0)
+            export = generate_export(messages=messages, seed=seed)
+            self.exports[file_id] = json.dumps(export, ensure_ascii=False).encode()
+            # Imports are one-off, keep only a few recent ones
+            if len(self.exports) > 64:
+                self.exports.pop(next(iter(self.exports)))
+        return self.exports[file_id]
+
+    async def method(self, request: web.Request) -> web.Response:
+
+        method = request.match_info['method'].lower()
+        data = await request.post()
+
+        if method in self.MESSAGE_METHODS:
+            result = self._message(data)
+        elif method == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake bot', 'username': 'fake_saved_ai_bot'}
+        elif method == 'getfile':
+            file_id = data.get('file_id', '')
+            result = {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self._export(file_id)),
+                'file_path': f'documents/{file_id}.json',
+            }
+        else:
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+    async def file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info['path'].rsplit('/', 1)[-1].removesuffix('.json')
+        return web.Response(body=self._export(file_id), content_type='application/json')
+
+
+def fake_embedding(item, dimension: int = EMBEDDING_DIMENSION) -> np.ndarray:
+    """Deterministic hashed bag of words (or of token ids), texts sharing words are similar."""
+
+    features = item if isinstance(item, list) else re.findall(r'\w+', str(item).lower())
+    vector = np.zeros(dimension, dtype=np.float32)
+    for feature in features:
+        vector[zlib.crc32(str(feature).encode()) % dimension] += 1.0
+    norm = np.linalg.norm(vector)
+    if not norm:
+        vector[zlib.crc32(str(item).encode()) % dimension] = 1.0
+        return vector
+    return vector / norm
+
+
+class FakeOpenAI(FakeService):
+    """Embeddings, chat completions and the assistants API, answers are canned."""
+
+    name = 'openai'
+
+    def __init__(self, config: ServicesConfig):
+        super().__init__(config)
+        self.threads: dict[str, list[dict]] = {}
+        self.runs: dict[str, dict] = {}
+
+    def setup_routes(self):
+        router = self.app.router
+        router.add_post('/v1/embeddings', self.embeddings, name='embeddings')
+        router.add_post('/v1/chat/completions', self.chat_completions, name='chat')
+        router.add_post('/v1/assistants', self.create_assistant, name='assistants.create')
+        router.add_post('/v1/threads', self.create_thread, name='assistants.thread')
+        router.add_post('/v1/threads/runs', self.create_thread_and_run, name='assistants.thread_run')
+        router.add_post('/v1/threads/{thread_id}/messages', self.create_message, name='assistants.message')
+        router.add_get('/v1/threads/{thread_id}/messages', self.list_messages, name='assistants.messages')
+        router.add_post('/v1/threads/{thread_id}/runs', self.create_run, name='assistants.run')
+        router.add_get('/v1/threads/{thread_id}/runs/{run_id}', self.retrieve_run, name='assistants.run_status')
+
+    def route_key(self, request: web.Request) -> str:
+        # aiohttp names must be unique, several assistant routes share one fault key
+        for name in ('embeddings', 'chat', 'assistants'):
+            if (request.match_info.route.name or '').startswith(name):
+                return name
+        return 'other'
+
+    @staticmethod
+    def _tokens(text: str) -> int:
+        return max(1, len(text) // 4)
+
+    def _answer(self, question: str) -> str:
+        words = re.findall(r'\w+', question)[:12]
+        return 'Ответ по базе знаний: ' + ' '.join(words)
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+
+        body = await request.json()
+        inputs = body['input']
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimension = body.get('dimensions') or EMBEDDING_DIMENSION
+
+        data = []
+        for i, item in enumerate(inputs):
+            vector = fake_embedding(item, dimension)
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+
+        tokens = sum(len(item) if isinstance(item, list) else self._tokens(item) for item in inputs)
+        return web.json_response({
+            'object': 'list', 'data': data, 'model': body.get('model'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+
+        body = await request.json()
+        messages = body.get('messages', [])
+        question = next((m.get('content') for m in reversed(messages) if m.get('role') == 'user'), '') or ''
+        if not isinstance(question, str):
+            question = ' '.join(part.get('text', '') for part in question if isinstance(part, dict))
+        answer = self._answer(question)
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        created = int(time.time())
+        prompt_tokens = sum(self._tokens(str(m.get('content', ''))) for m in messages)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': self._tokens(answer),
+            'total_tokens': prompt_tokens + self._tokens(answer),
+        }
+
+        if not body.get('stream'):
+            return web.json_response({
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        pieces = re.findall(r'\S+\s*', answer)
+        for i, piece in enumerate(pieces):
+            chunk = {
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': body.get('model'),
+                'choices': [{'index': 0, 'delta': {'content': piece, **({'role': 'assistant'} if i == 0 else {})}, 'finish_reason': None}],
+            }
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        final = {
+            'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': body.get('model'),
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+        }
+        if (body.get('stream_options') or {}).get('include_usage'):
+            final['usage'] = usage
+        await response.write(f'data: {json.dumps(final)}\n\ndata: [DONE]\n\n'.encode())
+        await response.write_eof()
+        return response
+
+    async def create_assistant(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({
+            'id': f'asst_{uuid.uuid4().hex[:24]}', 'object': 'assistant', 'created_at': int(time.time()),
+            'name': body.get('name'), 'description': None, 'model': body.get('model'),
+            'instructions': body.get('instructions'), 'tools': body.get('tools', []), 'metadata': {},
+        })
+
+    def _thread(self, messages: list[dict] | None = None) -> dict:
+        thread_id = f'thread_{uuid.uuid4().hex[:24]}'
+        self.threads[thread_id] = []
+        for message in messages or []:
+            self._add_message(thread_id, message.get('role', 'user'), message.get('content', ''))
+        return {'id': thread_id, 'object': 'thread', 'created_at': int(time.time()), 'metadata': {}}
+
+    def _add_message(self, thread_id: str, role: str, content: str, run_id: str | None = None, assistant_id: str | None = None) -> dict:
+        message = {
+            'id': f'msg_{uuid.uuid4().hex[:24]}', 'object': 'thread.message', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'role': role, 'status': 'completed',
+            'content': [{'type': 'text', 'text': {'value': content, 'annotations': []}}],
+            'run_id': run_id, 'assistant_id': assistant_id, 'attachments': [], 'metadata': {},
+        }
+        self.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    def _run(self, thread_id: str, assistant_id: str) -> dict:
+        run = {
+            'id': f'run_{uuid.uuid4().hex[:24]}', 'object': 'thread.run', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'assistant_id': assistant_id, 'status': 'in_progress',
+            'model': 'gpt-4o-mini', 'instructions': '', 'tools': [], 'metadata': {},
+            'parallel_tool_calls': True,
+        }
+        duration = self.config.assistant_run_ms * self.rng.lognormvariate(0, 0.3) / 1000
+        self.runs[run['id']] = {**run, '_done_at': time.monotonic() + duration}
+        return run
+
+    async def create_thread(self, request: web.Request) -> web.Response:
+        body = await request.json() if request.can_read_body else {}
+        return web.json_response(self._thread(body.get('messages')))
+
+    async def create_thread_and_run(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        thread = self._thread((body.get('thread') or {}).get('messages'))
+        return web.json_response(self._run(thread['id'], body['assistant_id']))
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        content = body.get('content', '')
+        if not isinstance(content, str):
+            content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+        return web.json_response(self._add_message(request.match_info['thread_id'], body.get('role', 'user'), content))
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        messages = self.threads.get(request.match_info['thread_id'], [])
+        if request.query.get('order', 'desc') == 'desc':
+            messages = messages[::-1]
+        return web.json_response({
+            'object': 'list', 'data': messages, 'has_more': False,
+            'first_id': messages[0]['id'] if messages else None,
+            'last_id': messages[-1]['id'] if messages else None,
+        })
+
+    async def create_run(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(self._run(request.match_info['thread_id'], body['assistant_id']))
+
+    async def retrieve_run(self, request: web.Request) -> web.Response:
+
+        run = self.runs.get(request.match_info['run_id'])
+        if run is None:
+            return web.json_response({'error': {'message': 'No such run', 'type': 'invalid_request_error'}}, status=404)
+
+        if run['status'] == 'in_progress' and time.monotonic() >= run['_done_at']:
+            run['status'] = 'completed'
+            run['completed_at'] = int(time.time())
+            thread = self.threads.get(run['thread_id'], [])
+            question = next((m['content'][0]['text']['value'] for m in reversed(thread) if m['role'] == 'user'), '')
+            self._add_message(run['thread_id'], 'assistant', self._answer(question), run['id'], run['assistant_id'])
+
+        return web.json_response({key: value for key, value in run.items() if not key.startswith('_')})
+
+
+def matches_filter(metadata: dict, condition: dict) -> bool:
+    """Pinecone metadata filter semantics: $and/$or and per-field operators."""
+
+    for key, value in condition.items():
+        if key == '$and':
+            if not all(matches_filter(metadata, part) for part in value):
+                return False
+            continue
+        if key == '$or':
+            if not any(matches_filter(metadata, part) for part in value):
+                return False
+            continue
+
+        actual = metadata.get(key)
+        operators = value if isinstance(value, dict) else {'$eq': value}
+        for operator, expected in operators.items():
+            if operator == '$exists':
+                ok = (key in metadata) == expected
+            elif actual is None:
+                ok = operator in ('$ne', '$nin')
+            elif operator == '$eq':
+                ok = expected in actual if isinstance(actual, list) else actual == expected
+            elif operator == '$ne':
+                ok = actual != expected
+            elif operator == '$in':
+                ok = any(item in expected for item in actual) if isinstance(actual, list) else actual in expected
+            elif operator == '$nin':
+                ok = not (any(item in expected for item in actual) if isinstance(actual, list) else actual in expected)
+            elif operator == '$gt':
+                ok = actual > expected
+            elif operator == '$gte':
+                ok = actual >= expected
+            elif operator == '$lt':
+                ok = actual < expected
+            elif operator == '$lte':
+                ok = actual <= expected
+            else:
+                raise ValueError(f'Unsupported filter operator {operator}')
+            if not ok:
+                return False
+    return True
+
+
+class FakePinecone(FakeService):
+    """Control plane returning this server as the host of any index, and an in-memory data plane.
+
+    All indexes share the storage, the bot keeps every user in their own namespace anyway.
+    """
+
+    name = 'pinecone'
+
+    def __init__(self, config: ServicesConfig):
+        super().__init__(config)
+        self.namespaces: dict[str, dict[str, tuple[np.ndarray, dict]]] = {}
+        self.matrices: dict[str, tuple[list[str], np.ndarray]] = {}
+
+    def setup_routes(self):
+        router = self.app.router
+        router.add_get('/indexes', self.list_indexes, name='control.list')
+        router.add_get('/indexes/{name}', self.describe_index, name='control')
+        router.add_post('/vectors/upsert', self.upsert, name='upsert')
+        router.add_post('/query', self.query, name='query')
+        router.add_get('/vectors/fetch', self.fetch, name='fetch')
+        router.add_post('/vectors/delete', self.delete, name='delete')
+        router.add_get('/vectors/list', self.list_ids, name='list')
+        router.add_route('*', '/describe_index_stats', self.describe_index_stats, name='stats')
+
+    def error_response(self) -> web.Response:
+        return web.json_response({'code': 13, 'message': 'Injected failure', 'details': []}, status=500)
+
+    def route_key(self, request: web.Request) -> str:
+        return super().route_key(request).split('.')[0]
+
+    def _index(self, name: str) -> dict:
+        return {
+            'name': name,
+            'dimension': EMBEDDING_DIMENSION,
+            'metric': 'cosine',
+            'host': self.config.pinecone_url,
+            'vector_type': 'dense',
+            'deletion_protection': 'disabled',
+            'spec': {'serverless': {'cloud': 'aws', 'region': 'us-east-1'}},
+            'status': {'ready': True, 'state': 'Ready'},
+        }
+
+    async def list_indexes(self, request: web.Request) -> web.Response:
+        return web.json_response({'indexes': [self._index(name) for name in self.config.pinecone_indexes]})
+
+    async def describe_index(self, request: web.Request) -> web.Response:
+        return web.json_response(self._index(request.match_info['name']))
+
+    async def upsert(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        namespace = body.get('namespace', '')
+        vectors = self.namespaces.setdefault(namespace, {})
+        for vector in body['vectors']:
+            vectors[vector['id']] = (np.asarray(vector['values'], dtype=np.float32), vector.get('metadata') or {})
+        self.matrices.pop(namespace, None)
+        return web.json_response({'upsertedCount': len(body['vectors'])})
+
+    def _matrix(self, namespace: str) -> tuple[list[str], np.ndarray]:
+        if namespace not in self.matrices:
+            vectors = self.namespaces.get(namespace, {})
+            ids = list(vectors)
+            matrix = np.stack([vectors[i][0] for i in ids]) if ids else np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self.matrices[namespace] = (ids, matrix / np.where(norms == 0, 1, norms))
+        return self.matrices[namespace]
+
+    async def query(self, request: web.Request) -> web.Response:
+
+        body = await request.json()
+        namespace = body.get('namespace', '')
+        top_k = body.get('topK', 10)
+        vectors = self.namespaces.get(namespace, {})
+
+        if body.get('id'):
+            query = vectors[body['id']][0] if body['id'] in vectors else None
+        else:
+            query = np.asarray(body.get('vector', []), dtype=np.float32)
+
+        matches = []
+        ids, matrix = self._matrix(namespace)
+        if query is not None and len(ids):
+            scores = matrix @ (query / (np.linalg.norm(query) or 1))
+            condition = body.get('filter')
+            for i in np.argsort(-scores):
+                values, metadata = vectors[ids[i]]
+                if condition and not matches_filter(metadata, condition):
+                    continue
+                matches.append({
+                    'id': ids[i], 'score': float(scores[i]),
+                    'values': values.tolist() if body.get('includeValues') else [],
+                    'metadata': metadata if body.get('includeMetadata') else None,
+                })
+                if len(matches) == top_k:
+                    break
+
+        return web.json_response({'matches': matches, 'namespace': namespace, 'usage': {'readUnits': 5}})
+
+    async def fetch(self, request: web.Request) -> web.Response:
+        namespace = request.query.get('namespace', '')
+        vectors = self.namespaces.get(namespace, {})
+        found = {
+            vector_id: {'id': vector_id, 'values': vectors[vector_id][0].tolist(), 'metadata': vectors[vector_id][1]}
+            for vector_id in request.query.getall('ids', []) if vector_id in vectors
+        }
+        return web.json_response({'vectors': found, 'namespace': namespace, 'usage': {'readUnits': 1}})
+
+    async def delete(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        namespace = body.get('namespace', '')
+        if body.get('deleteAll'):
+            self.namespaces.pop(namespace, None)
+        else:
+            vectors = self.namespaces.get(namespace, {})
+            for vector_id in body.get('ids', []):
+                vectors.pop(vector_id, None)
+        self.matrices.pop(namespace, None)
+        return web.json_response({})
+
+    async def list_ids(self, request: web.Request) -> web.Response:
+        namespace = request.query.get('namespace', '')
+        prefix = request.query.get('prefix', '')
+        limit = int(request.query.get('limit', 100))
+        ids = sorted(i for i in self.namespaces.get(namespace, {}) if i.startswith(prefix))
+        start = int(request.query.get('paginationToken') or 0)
+        page = ids[start:start + limit]
+        response = {'vectors': [{'id': i} for i in page], 'namespace': namespace, 'usage': {'readUnits': 1}}
+        if start + limit < len(ids):
+            response['pagination'] = {'next': str(start + limit)}
+        return web.json_response(response)
+
+    async def describe_index_stats(self, request: web.Request) -> web.Response:
+        namespaces = {name: {'vectorCount': len(vectors)} for name, vectors in self.namespaces.items()}
+        return web.json_response({
+            'namespaces': namespaces, 'dimension': EMBEDDING_DIMENSION, 'indexFullness': 0.0,
+            'totalVectorCount': sum(n['vectorCount'] for n in namespaces.values()),
+        })
+
+
+async def start_services(config: ServicesConfig) -> list[web.AppRunner]:
+    runners = []
+    for service, port in (
+        (FakeTelegram(config), config.telegram_port),
+        (FakeOpenAI(config), config.openai_port),
+        (FakePinecone(config), config.pinecone_port),
+    ):
+        runner = web.AppRunner(service.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, config.host, port).start()
+        runners.append(runner)
+    return runners
+
+
+def serve(config: ServicesConfig, ready=None):
+    """Run the services until killed, `ready` (a multiprocessing Event) is set once they listen."""
+
+    async def main():
+        await start_services(config)
+        if ready is not None:
+            ready.set()
+        await asyncio.Event().wait()
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(main())
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run fake Telegram, OpenAI and Pinecone services.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8081, help="Telegram port, OpenAI and Pinecone use the next two")
+    parser.add_argument("--latency", nargs="*", default=[], metavar="SERVICE[.ROUTE]=MS")
+    parser.add_argument("--errors", nargs="*", default=[], metavar="SERVICE[.ROUTE]=RATE")
+    parser.add_argument("--assistant-run-ms", type=float, default=1000.0)
+    args = parser.parse_args()
+
+    config = ServicesConfig(
+        host=args.host, telegram_port=args.port, openai_port=args.port + 1, pinecone_port=args.port + 2,
+        faults=parse_faults(args.latency, args.errors), assistant_run_ms=args.assistant_run_ms,
+    )
+    print(f"Telegram {config.telegram_url}\nOpenAI   {config.openai_url}\nPinecone {config.pinecone_url}")
+    serve(config)
+
+
+if __name__ == '__main__':
+    main()
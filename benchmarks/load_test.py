@@ -0,0 +1,464 @@
+"""Load test of the bot: virtual users feeding updates into the Dispatcher.
+
+The bot runs in this process exactly as in production (OrderedDispatcher,
+FSM storage, SQLite or Postgres through DB_URL), while Telegram, OpenAI and
+Pinecone are replaced by benchmarks/fake_services.py running in a separate
+process. Virtual users add notes, search, chat with the knowledge base and
+import chats, each action being the command plus the message that follows it.
+Inline searches are typed: an inline query per keystroke, KEYSTROKE_SECONDS
+apart, the latency is that of the last one.
+
+The number of users grows stage by stage. Every stage reports throughput and
+p50/p95/p99 latency per action and per handler. The run stops at the
+saturation point: the first stage whose throughput grew by less than
+`--min-gain` over the previous one, or whose p95 or error rate exceeded the
+limits.
+
+Usage:
+    python benchmarks/load_test.py --stages 10 50 100 250 500 1000 --stage-seconds 30
+    python benchmarks/load_test.py --latency openai=300 openai.embeddings=80 pinecone=40 --errors openai=0.01
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+import itertools
+import multiprocessing
+from collections import defaultdict
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+import aiohttp
+
+# Add the parent directory to the sys.path to allow importing from backend and models
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import ServicesConfig, parse_faults, serve
+from synthetic_export import WORDS_RU, WORDS_EN
+
+FIRST_USER_ID = 7_000_000_000
+
+ACTIONS = ('note', 'search', 'chat', 'import', 'inline')
+KEYSTROKE_SECONDS = 0.08
+
+
+class LatencyRecorder:
+    """Latencies and errors per name, bucketed by stage."""
+
+    def __init__(self):
+        self.stage = 0
+        self.samples: dict[int, dict[str, list[float]]] = defaultdict(lambda: defaultdict(list))
+        self.errors: dict[int, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, name: str, seconds: float, ok: bool = True):
+        if ok:
+            self.samples[self.stage][name].append(seconds)
+        else:
+            self.errors[self.stage][name] += 1
+
+    def summary(self, stage: int, duration: float) -> dict[str, dict]:
+        names = set(self.samples[stage]) | set(self.errors[stage])
+        summary = {}
+        for name in sorted(names):
+            samples = np.array(self.samples[stage][name] or [np.nan])
+            errors = self.errors[stage][name]
+            count = len(self.samples[stage][name])
+            summary[name] = {
+                'count': count,
+                'errors': errors,
+                'per_second': count / duration,
+                'p50': float(np.nanpercentile(samples, 50)) if count else None,
+                'p95': float(np.nanpercentile(samples, 95)) if count else None,
+                'p99': float(np.nanpercentile(samples, 99)) if count else None,
+            }
+        return summary
+
+
+class HandlerTimer:
+    """Inner middleware recording the time spent in each handler under its function name."""
+
+    def __init__(self, recorder: LatencyRecorder):
+        self.recorder = recorder
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event: Any, data: dict) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self.recorder.record(f'handler.{name}', time.perf_counter() - started, ok=False)
+            raise
+        self.recorder.record(f'handler.{name}', time.perf_counter() - started)
+        return result
+
+
+class VirtualUser:
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, harness: 'LoadHarness', index: int):
+        self.harness = harness
+        self.telegram_id = FIRST_USER_ID + index
+        self.username = f'load_user_{index}'
+        self.rng = random.Random(index)
+        self.message_ids = itertools.count(1)
+        self.imports = 0
+
+    def _update(self, text: str | None = None, document: dict | None = None) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.telegram_id, 'type': 'private'},
+            'from': {'id': self.telegram_id, 'is_bot': False, 'first_name': 'Load', 'username': self.username},
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        if document is not None:
+            message['document'] = document
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def _inline_query(self, query: str) -> dict:
+        inline_query = {
+            'id': str(next(self.update_ids)),
+            'from': {'id': self.telegram_id, 'is_bot': False, 'first_name': 'Load', 'username': self.username},
+            'query': query,
+            'offset': '',
+        }
+        return {'update_id': next(self.update_ids), 'inline_query': inline_query}
+
+    def _text(self, words: int) -> str:
+        vocabulary = WORDS_RU if self.rng.random() < 0.6 else WORDS_EN
+        return ' '.join(self.rng.choices(vocabulary, k=words))
+
+    async def send(self, update: dict):
+        await self.harness.feed(update)
+
+    async def timed(self, action: str, *updates: dict):
+        """Feed the updates in order, the time of the last one is the action's latency."""
+
+        started = time.perf_counter()
+        try:
+            for update in updates[:-1]:
+                await self.send(update)
+            started = time.perf_counter()
+            await self.send(updates[-1])
+        except Exception as e:
+            self.harness.recorder.record(action, time.perf_counter() - started, ok=False)
+            self.harness.note_error(action, e)
+            return
+        self.harness.recorder.record(action, time.perf_counter() - started)
+
+    async def start(self):
+        await self.timed('start', self._update('/start'))
+        await self.timed('note', self._update(self._text(self.rng.randint(3, 30))))
+
+    async def act(self, action: str):
+        if action == 'note':
+            await self.timed('note', self._update('/note'), self._update(self._text(self.rng.randint(3, 30))))
+        elif action == 'search':
+            await self.timed('search', self._update('/search'), self._update(self._text(self.rng.randint(1, 4))))
+        elif action == 'chat':
+            await self.timed('chat.start', self._update('/chat'), self._update(self._text(self.rng.randint(3, 12)) + '?'))
+            for _ in range(self.rng.randint(0, 2)):
+                await self.timed('chat.continue', self._update(self._text(self.rng.randint(3, 12)) + '?'))
+        elif action == 'import':
+            self.imports += 1
+            file_id = f'export-{self.harness.args.import_messages}-{self.telegram_id * 100 + self.imports}'
+            document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'result.json', 'mime_type': 'application/json'}
+            await self.timed('import', self._update('/import'), self._update(document=document))
+        elif action == 'inline':
+            await self.type_inline(self._text(self.rng.randint(1, 3)))
+
+    async def type_inline(self, query: str):
+        """Send an inline query per keystroke without waiting for the answers, as Telegram does."""
+
+        keystrokes = []
+        for end in range(1, len(query) + 1):
+            keystrokes.append(asyncio.create_task(self.send(self._inline_query(query[:end]))))
+            await asyncio.sleep(KEYSTROKE_SECONDS)
+        started = time.perf_counter() - KEYSTROKE_SECONDS
+        results = await asyncio.gather(*keystrokes, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            self.harness.note_error('inline', error)
+        self.harness.recorder.record('inline', time.perf_counter() - started, ok=not errors)
+
+    async def run(self, stop: asyncio.Event):
+        args = self.harness.args
+        actions, weights = zip(*self.harness.mix.items())
+        await self.start()
+        while not stop.is_set():
+            await self.act(self.rng.choices(actions, weights)[0])
+            # Exponential think time, users don't fire back to back
+            await asyncio.sleep(self.rng.expovariate(1000 / args.think_ms) if args.think_ms else 0)
+
+
+class LoadHarness:
+
+    def __init__(self, args: argparse.Namespace, services: ServicesConfig, workdir: str):
+        self.args = args
+        self.services = services
+        self.workdir = workdir
+        self.mix = {action: float(weight) for action, weight in (item.split('=') for item in args.mix) if float(weight) > 0}
+        self.recorder = LatencyRecorder()
+        self.error_samples: dict[str, str] = {}
+        self.users: list[VirtualUser] = []
+        self.tasks: list[asyncio.Task] = []
+        self.stop = asyncio.Event()
+
+    def note_error(self, action: str, error: Exception):
+        self.error_samples.setdefault(f'{action}: {type(error).__name__}', str(error)[:300])
+
+    async def setup(self):
+        """Import the bot against the fake services and create subscribed users."""
+
+        from aiogram import types
+        from aiogram.client.telegram import TelegramAPIServer
+        from aiogram.fsm.storage.memory import MemoryStorage
+
+        import bot as bot_module
+        from backend import warm_up
+        from answer_cache import ANSWER_CACHE
+        from search_pages import SEARCH_PAGES
+        from inline_search import INLINE_SEARCH
+        from generate_schema import init
+        from models import TelegramUser
+        from loop_monitor import LOOP_MONITOR
+
+        # bot.py loads .env with override, point everything back to the fakes
+        os.environ.update(self.environment)
+
+        self.bot = bot_module.bot
+        self.bot.session.api = TelegramAPIServer.from_base(self.services.telegram_url)
+        self.dp = bot_module.dp
+        if self.args.memory_storage:
+            self.dp.fsm.storage = MemoryStorage()
+            ANSWER_CACHE.redis = None
+            SEARCH_PAGES.redis = None
+            INLINE_SEARCH.redis = None
+        self.dp.message.middleware(HandlerTimer(self.recorder))
+        self.dp.inline_query.middleware(HandlerTimer(self.recorder))
+        self.types = types
+
+        await init(self.environment['DB_URL'])
+        # In the bot this runs in the background after startup, don't count the imports as stalls
+        await asyncio.to_thread(warm_up)
+        self.loop_monitor = LOOP_MONITOR
+        self.loop_monitor.start()
+        subscription_end = datetime.datetime.now() + datetime.timedelta(days=30)
+        await TelegramUser.bulk_create([
+            TelegramUser(
+                telegram_id=FIRST_USER_ID + i, username=f'load_user_{i}', first_name='Load',
+                subscription_end_date=subscription_end,
+            )
+            for i in range(max(self.args.stages))
+        ], batch_size=1000)
+
+    @property
+    def environment(self) -> dict[str, str]:
+        return {
+            'TG_BOT_TOKEN': '123456789:LOADTESTFAKETOKEN',
+            'OPENAI_API_KEY': 'sk-load-test',
+            'OPENAI_BASE_URL': self.services.openai_url,
+            'OPENAI_API_BASE': self.services.openai_url,
+            'PINECONE_API_KEY': 'pc-load-test',
+            'PINECONE_CONTROLLER_HOST': self.services.pinecone_url,
+            'DB_URL': self.args.db_url or f"sqlite://{os.path.join(self.workdir, 'load.sqlite3')}",
+            'IMPORT_ARCHIVE_DIR': os.path.join(self.workdir, 'import_archive'),
+        }
+
+    async def feed(self, update: dict):
+        update = self.types.Update.model_validate(update, context={'bot': self.bot})
+        await self.dp.feed_update(self.bot, update)
+
+    async def grow(self, users: int):
+        stagger = self.args.ramp_seconds / max(1, users - len(self.users))
+        while len(self.users) < users:
+            user = VirtualUser(self, len(self.users))
+            self.users.append(user)
+            self.tasks.append(asyncio.create_task(user.run(self.stop)))
+            await asyncio.sleep(stagger)
+
+    async def service_stats(self) -> dict:
+        stats = {}
+        async with aiohttp.ClientSession() as session:
+            for name, url in (
+                ('telegram', self.services.telegram_url),
+                ('openai', self.services.openai_url.removesuffix('/v1')),
+                ('pinecone', self.services.pinecone_url),
+            ):
+                async with session.get(f'{url}/_stats') as response:
+                    stats[name] = await response.json()
+        return stats
+
+    def print_stage(self, stage: int, users: int, summary: dict, duration: float):
+        actions = {name: row for name, row in summary.items() if not name.startswith('handler.')}
+        handlers = {name: row for name, row in summary.items() if name.startswith('handler.')}
+        total = sum(row['count'] for row in actions.values())
+        errors = sum(row['errors'] for row in actions.values())
+        executor = self.dp.executor.stats()
+        loop = self.loop_monitor.stats()
+
+        print(f"\n=== stage {stage}: {users} users, {total / duration:.1f} actions/s, "
+              f"{errors} errors, queue depth {executor['queue_depth']}, "
+              f"avg queue wait {executor['wait_avg'] * 1000:.0f} ms, max loop lag {loop['max_lag'] * 1000:.0f} ms")
+        print(f"{'name':<36} {'count':>7} {'err':>5} {'/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for name, row in itertools.chain(actions.items(), handlers.items()):
+            p = [f"{row[q] * 1000:>8.0f}" if row[q] is not None else f"{'-':>8}" for q in ('p50', 'p95', 'p99')]
+            print(f"{name:<36} {row['count']:>7} {row['errors']:>5} {row['per_second']:>7.1f} {' '.join(p)}")
+
+    async def run(self) -> dict:
+
+        from generate_schema import shutdown
+
+        await self.setup()
+        try:
+            return await self.ramp()
+        finally:
+            self.loop_monitor.stop()
+            await self.bot.session.close()
+            await shutdown()
+
+    async def ramp(self) -> dict:
+
+        args = self.args
+
+        stages, previous, saturation = [], None, None
+        for stage, users in enumerate(args.stages):
+            self.recorder.stage = stage
+            started = time.perf_counter()
+            await self.grow(users)
+            await asyncio.sleep(max(0.0, args.stage_seconds - (time.perf_counter() - started)))
+            duration = time.perf_counter() - started
+
+            summary = self.recorder.summary(stage, duration)
+            actions = [row for name, row in summary.items() if not name.startswith('handler.')]
+            completed = sum(row['count'] for row in actions)
+            errors = sum(row['errors'] for row in actions)
+            throughput = completed / duration
+            p95 = max((row['p95'] for row in actions if row['p95'] is not None), default=0.0)
+            error_rate = errors / max(1, completed + errors)
+
+            self.print_stage(stage, users, summary, duration)
+            stages.append({
+                'users': users, 'duration': duration, 'throughput': throughput,
+                'error_rate': error_rate, 'max_p95': p95, 'latency': summary,
+            })
+
+            reasons = []
+            if previous is not None and throughput < previous * (1 + args.min_gain):
+                reasons.append(f'throughput {previous:.1f} -> {throughput:.1f} actions/s')
+            if p95 > args.max_p95:
+                reasons.append(f'p95 {p95:.1f}s > {args.max_p95}s')
+            if error_rate > args.max_error_rate:
+                reasons.append(f'error rate {error_rate:.1%} > {args.max_error_rate:.1%}')
+            if reasons:
+                saturation = {'users': users, 'previous_users': stages[-2]['users'] if len(stages) > 1 else None, 'reasons': reasons}
+                break
+            previous = throughput
+
+        self.stop.set()
+        await asyncio.wait(self.tasks, timeout=args.drain_seconds)
+        for task in self.tasks:
+            task.cancel()
+
+        if saturation:
+            print(f"\nSaturated at {saturation['users']} users ({'; '.join(saturation['reasons'])}), "
+                  f"last healthy stage: {saturation['previous_users']} users")
+        else:
+            print(f"\nNot saturated up to {args.stages[-1]} users")
+        if self.error_samples:
+            print("\nErrors:\n  " + "\n  ".join(f'{key}: {value}' for key, value in self.error_samples.items()))
+        loop = self.loop_monitor.stats()
+        if loop['stalls']:
+            print("\nEvent loop stalls:\n  " + "\n  ".join(f'{site}: {count}' for site, count in loop['stalls'].items()))
+
+        return {
+            'stages': stages,
+            'saturation': saturation,
+            'errors': self.error_samples,
+            'services': await self.service_stats(),
+            'executor': self.dp.executor.stats(),
+            'loop': self.loop_monitor.stats(),
+        }
+
+
+def start_services(config: ServicesConfig) -> multiprocessing.Process:
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(target=serve, args=(config, ready), daemon=True)
+    process.start()
+    if not ready.wait(30):
+        process.terminate()
+        raise RuntimeError('Fake services did not start')
+    return process
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Load test the bot against fake Telegram, OpenAI and Pinecone.")
+    parser.add_argument("--stages", type=int, nargs="+", default=[10, 50, 100, 250, 500, 1000], help="virtual users per stage")
+    parser.add_argument("--stage-seconds", type=float, default=30)
+    parser.add_argument("--ramp-seconds", type=float, default=5, help="time over which a stage's new users start")
+    parser.add_argument("--think-ms", type=float, default=1000, help="mean pause of a user between actions")
+    parser.add_argument("--mix", nargs="+", default=['note=60', 'search=20', 'chat=15', 'import=5'], metavar="ACTION=WEIGHT")
+    parser.add_argument("--import-messages", type=int, default=300, help="messages in an imported chat")
+    parser.add_argument("--latency", nargs="*", default=['telegram=30', 'openai=400', 'openai.embeddings=80', 'pinecone=40'], metavar="SERVICE[.ROUTE]=MS")
+    parser.add_argument("--errors", nargs="*", default=[], metavar="SERVICE[.ROUTE]=RATE")
+    parser.add_argument("--assistant-run-ms", type=float, default=1500)
+    parser.add_argument("--port", type=int, default=18081, help="first of three ports of the fake services")
+    parser.add_argument("--db-url", help="database to test against, a fresh SQLite file by default")
+    parser.add_argument("--memory-storage", action="store_true", help="FSM in memory instead of the bot's Redis, the answer cache, search paging and the inline search cache are off")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="throughput growth below which a stage is saturated")
+    parser.add_argument("--max-p95", type=float, default=10.0, help="seconds")
+    parser.add_argument("--max-error-rate", type=float, default=0.05)
+    parser.add_argument("--drain-seconds", type=float, default=30)
+    parser.add_argument("--report", help="write the full results as JSON")
+    args = parser.parse_args()
+
+    unknown = {item.split('=')[0] for item in args.mix} - set(ACTIONS)
+    if unknown:
+        parser.error(f"unknown actions in --mix: {', '.join(unknown)}")
+
+    services = ServicesConfig(
+        telegram_port=args.port, openai_port=args.port + 1, pinecone_port=args.port + 2,
+        faults=parse_faults(args.latency, args.errors), assistant_run_ms=args.assistant_run_ms,
+    )
+    process = start_services(services)
+
+    # Files the handlers write (downloaded exports, archives, the database) stay in a scratch directory
+    workdir = tempfile.mkdtemp(prefix='saved_ai_load_')
+    os.makedirs(os.path.join(workdir, 'exported_chats'))
+    shutil.copy(os.path.join(ROOT, 'image.png'), workdir)
+
+    harness = LoadHarness(args, services, workdir)
+    os.environ.update(harness.environment)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    try:
+        results = asyncio.run(harness.run())
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""Generator of synthetic Telegram Desktop JSON exports.
+
+Produces the same structure as "Export chat history" (one chat) or "Export
+Telegram data" (a `chats.list` of several chats): Russian and English text,
+formatted text with entities, media, polls, locations, replies, forwards and
+service messages in configurable proportions.
+
+Usage:
+    python benchmarks/synthetic_export.py result.json --messages 50000 --chats 3
+"""
+
+import random
+import datetime
+import argparse
+from dataclasses import dataclass, asdict
+
+import orjson
+
+WORDS_RU = (
+    'привет встреча завтра проект код бот заметка идея книга кофе работа задача созвон отчёт '
+    'сегодня вечером неделя релиз сервер база данных поиск ответ вопрос спасибо отлично посмотрю'
+).split()
+WORDS_EN = (
+    'meeting tomorrow project code deploy review idea release server database search answer '
+    'question thanks great look later today week notes chat model index vector embedding'
+).split()
+NAMES = ['Анна', 'Борис', 'Вера', 'Глеб', 'Дарья', 'Alice', 'Bob', 'Carol', 'Dave', 'Eve']
+
+FILE_NOT_INCLUDED = '(File not included. Change data exporting settings to download.)'
+
+# (media_type or None, weight), None items are photos, polls and locations
+MEDIA_KINDS = [
+    ('photo', 40), ('sticker', 20), ('voice_message', 10), ('video_file', 8),
+    ('animation', 6), ('audio_file', 4), ('file', 6), ('poll', 3), ('location', 3),
+]
+ENTITY_KINDS = [
+    ('link', 30), ('mention', 20), ('hashtag', 15), ('bold', 15),
+    ('bot_command', 8), ('email', 6), ('phone', 6),
+]
+
+
+@dataclass
+class ExportConfig:
+    messages: int = 10_000
+    chats: int = 1
+    senders: int = 6
+    media_ratio: float = 0.15
+    entity_ratio: float = 0.2
+    reply_ratio: float = 0.2
+    forward_ratio: float = 0.05
+    service_ratio: float = 0.02
+    russian_ratio: float = 0.6
+    include_files: bool = False
+    seed: int = 0
+
+
+class ExportGenerator:
+
+    def __init__(self, config: ExportConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+
+    def _words(self, n: int) -> str:
+        words = WORDS_RU if self.rng.random() < self.config.russian_ratio else WORDS_EN
+        return ' '.join(self.rng.choices(words, k=n))
+
+    def _entity(self, kind: str) -> dict:
+        text = {
+            'link': 'https://example.com/' + self.rng.choice(WORDS_EN),
+            'mention': '@' + self.rng.choice(WORDS_EN) + str(self.rng.randint(1, 99)),
+            'hashtag': '#' + self.rng.choice(WORDS_RU + WORDS_EN),
+            'bold': self._words(2),
+            'bot_command': '/' + self.rng.choice(['start', 'search', 'chat', 'help']),
+            'email': self.rng.choice(WORDS_EN) + '@example.com',
+            'phone': '+7 9' + ''.join(self.rng.choices('0123456789', k=9)),
+        }[kind]
+        return {'type': kind, 'text': text}
+
+    def _text(self) -> tuple[str | list, list[dict]]:
+        """Message text and text_entities as exported: a plain string, or a list of strings and entities."""
+
+        if self.rng.random() >= self.config.entity_ratio:
+            text = self._words(self.rng.randint(1, 30))
+            if self.rng.random() < 0.1:
+                text += '\n' + self._words(self.rng.randint(1, 10))
+            return text, [{'type': 'plain', 'text': text}]
+
+        kinds, weights = zip(*ENTITY_KINDS)
+        parts = []
+        for _ in range(self.rng.randint(1, 3)):
+            parts.append(self._words(self.rng.randint(1, 10)) + ' ')
+            parts.append(self._entity(self.rng.choices(kinds, weights)[0]))
+        if self.rng.random() < 0.5:
+            parts.append(' ' + self._words(self.rng.randint(1, 5)))
+        entities = [part if isinstance(part, dict) else {'type': 'plain', 'text': part} for part in parts]
+        return parts, entities
+
+    def _file(self, folder: str, n: int, extension: str) -> str:
+        return f'{folder}/file_{n}.{extension}' if self.config.include_files else FILE_NOT_INCLUDED
+
+    def _media(self, message: dict):
+        kinds, weights = zip(*MEDIA_KINDS)
+        kind = self.rng.choices(kinds, weights)[0]
+        n = message['id']
+
+        if kind == 'photo':
+            message.update(photo=self._file('photos', n, 'jpg'), width=1280, height=960)
+        elif kind == 'sticker':
+            message.update(
+                file=self._file('stickers', n, 'webp'), media_type='sticker',
+                sticker_emoji=self.rng.choice(['😀', '👍', '🔥', '❤️']), width=512, height=512
+            )
+        elif kind == 'voice_message':
+            message.update(
+                file=self._file('voice_messages', n, 'ogg'), media_type='voice_message',
+                mime_type='audio/ogg', duration_seconds=self.rng.randint(1, 120)
+            )
+        elif kind in ('video_file', 'animation'):
+            message.update(
+                file=self._file('video_files', n, 'mp4'), media_type=kind, mime_type='video/mp4',
+                duration_seconds=self.rng.randint(1, 60), width=720, height=1280
+            )
+        elif kind == 'audio_file':
+            message.update(
+                file=self._file('files', n, 'mp3'), media_type='audio_file', mime_type='audio/mpeg',
+                performer=self.rng.choice(NAMES), title=self._words(2), duration_seconds=self.rng.randint(60, 300)
+            )
+        elif kind == 'file':
+            message.update(file=self._file('files', n, 'pdf'), mime_type='application/pdf')
+        elif kind == 'poll':
+            message['poll'] = {
+                'question': self._words(5) + '?',
+                'closed': False,
+                'total_voters': self.rng.randint(0, 50),
+                'answers': [{'text': self._words(2), 'voters': self.rng.randint(0, 10), 'chosen': False} for _ in range(3)],
+            }
+        elif kind == 'location':
+            message['location_information'] = {
+                'latitude': round(self.rng.uniform(-90, 90), 6),
+                'longitude': round(self.rng.uniform(-180, 180), 6),
+            }
+
+        # Media captions are optional
+        if kind not in ('poll', 'location') and self.rng.random() < 0.3:
+            message['text'], message['text_entities'] = self._text()
+        else:
+            message['text'], message['text_entities'] = '', []
+
+    def chat(self, chat_id: int, name: str, messages: int, first_id: int = 1) -> dict:
+
+        config = self.config
+        senders = [
+            (self.rng.choice(NAMES) + f' {i}', f'user{self.rng.randint(10 ** 6, 10 ** 9)}')
+            for i in range(config.senders)
+        ]
+        timestamp = int(datetime.datetime(2023, 1, 1).timestamp())
+
+        result = []
+        for msg_id in range(first_id, first_id + messages):
+            # Bursts of conversation separated by longer pauses
+            timestamp += self.rng.choice([self.rng.randint(1, 120), self.rng.randint(600, 36_000)])
+            date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S')
+            sender, sender_id = self.rng.choice(senders)
+
+            if self.rng.random() < config.service_ratio:
+                result.append({
+                    'id': msg_id, 'type': 'service', 'date': date, 'date_unixtime': str(timestamp),
+                    'actor': sender, 'actor_id': sender_id,
+                    'action': self.rng.choice(['pin_message', 'invite_members', 'edit_group_title']),
+                    'text': '', 'text_entities': [],
+                })
+                continue
+
+            message = {
+                'id': msg_id, 'type': 'message', 'date': date, 'date_unixtime': str(timestamp),
+                'from': sender, 'from_id': sender_id,
+            }
+            if msg_id > first_id and self.rng.random() < config.reply_ratio:
+                message['reply_to_message_id'] = self.rng.randint(max(first_id, msg_id - 20), msg_id - 1)
+            if self.rng.random() < config.forward_ratio:
+                message['forwarded_from'] = self.rng.choice(['Новости', 'Tech Digest', 'Канал заметок'])
+
+            if self.rng.random() < config.media_ratio:
+                self._media(message)
+            else:
+                message['text'], message['text_entities'] = self._text()
+
+            result.append(message)
+
+        return {'name': name, 'type': 'private_group', 'id': chat_id, 'messages': result}
+
+    def export(self) -> dict:
+        """A single chat export, or a full data export with `chats.list` when there are several chats."""
+
+        config = self.config
+        if config.chats <= 1:
+            return self.chat(1_000_000, 'Synthetic chat', config.messages)
+
+        chats, first_id = [], 1
+        per_chat = config.messages // config.chats
+        for i in range(config.chats):
+            count = per_chat + (config.messages % config.chats if i == config.chats - 1 else 0)
+            chats.append(self.chat(1_000_000 + i, f'Synthetic chat {i + 1}', count, first_id))
+            first_id += count
+
+        return {
+            'about': 'Here is the data you requested.',
+            'chats': {'about': 'This page lists all chats from this export.', 'list': chats},
+        }
+
+
+def generate_export(**kwargs) -> dict:
+    return ExportGenerator(ExportConfig(**kwargs)).export()
+
+
+def write_export(path: str, **kwargs) -> str:
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(generate_export(**kwargs), option=orjson.OPT_INDENT_2))
+    return path
+
+
+def main():
+
+    defaults = ExportConfig()
+    parser = argparse.ArgumentParser(description="Generate a synthetic Telegram JSON export.")
+    parser.add_argument("output")
+    for name, value in asdict(defaults).items():
+        flag = '--' + name.replace('_', '-')
+        if isinstance(value, bool):
+            parser.add_argument(flag, action="store_true")
+        else:
+            parser.add_argument(flag, type=type(value), default=value)
+    args = vars(parser.parse_args())
+
+    output = args.pop('output')
+    write_export(output, **args)
+    print(f"Wrote {args['messages']} messages in {args['chats']} chat(s) to {output}")
+
+
+if __name__ == '__main__':
+    main()
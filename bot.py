@@ -15,19 +15,36 @@ from apscheduler.jobstores.redis import RedisJobStore
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.storage.base import StorageKey
 from apscheduler_di import ContextSchedulerDecorator
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from aiogram.filters.callback_data import CallbackData
 
 from models import TelegramUser, Note, UserMessage
 from tortoise import Tortoise
 from generate_schema import init
-from backend import upload_notes_to_pinecone, search_notes, start_kb_chat, continue_kb_chat, upload_exported_chat_to_pinecone
+from backend import upload_notes_to_pinecone, search_notes, start_kb_chat, continue_kb_chat, get_llm, get_term_stats, upload_exported_chat_to_pinecone, warm_up
+from conversation import Conversation
+from answer_cache import ANSWER_CACHE
+from search_pages import SEARCH_PAGES, SEARCH_PAGE_SIZE, SEARCH_RESULTS
+from inline_search import INLINE_SEARCH, INLINE_DEADLINE, INLINE_MIN_CHARS, INLINE_RESULTS, normalize_query
+from search_filters import metadata_filter, parse_filters
 from parse_telegram_json_polars import parse_telegram_chat
-from text_tools import generate_wordcloud
+from text_tools import generate_wordcloud, render_wordcloud
+from chat_executor import OrderedDispatcher
+from chat_analytics import chat_report
+from tracing import SINK, format_trace
+from profiling import PROFILER, PROFILE_UPDATES, ProfilingMiddleware
+from loop_monitor import LOOP_MONITOR
+from metrics import (
+    METRICS_PORT, QUEUE_DEPTH, HandlerMetricsMiddleware, instrument_bot, instrument_redis, measure, start_metrics_server
+)
 
 import asyncio
 import logging
 import os
 import sys
+import time
+import html
+import shlex
 import datetime
 
 import dotenv
@@ -36,6 +53,7 @@ dotenv.load_dotenv(override=True)
 # Bot token can be obtained via https://t.me/BotFather
 TOKEN = os.getenv('TG_BOT_TOKEN')
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+instrument_bot(bot)
 storage = MemoryStorage()
 
 UPDATE_INTERVAL = int(os.getenv('UPDATE_INTERVAL', 60))
@@ -48,8 +66,29 @@ JOBSTORES = {
 scheduler = ContextSchedulerDecorator(AsyncIOScheduler(jobstores=JOBSTORES))
 scheduler.ctx.add_instance(bot, Bot)
 
+# Updates of one chat are handled in order, different chats in parallel up to this limit
+MAX_CONCURRENT_CHATS = int(os.getenv('MAX_CONCURRENT_CHATS', 100))
+
+# Seconds between edits of a streamed chat answer
+STREAM_EDIT_INTERVAL = 1.0
+# Seconds Telegram may answer the same inline query of a user without asking the bot
+INLINE_CACHE_TIME = 30
+
 redis_storage = RedisStorage.from_url('redis://localhost:6379')
-dp = Dispatcher(storage=redis_storage)
+dp = OrderedDispatcher(storage=redis_storage, max_concurrency=MAX_CONCURRENT_CHATS)
+
+instrument_redis(redis_storage.redis)
+# Chat answers, search pages and inline search results are cached next to the FSM data
+ANSWER_CACHE.redis = redis_storage.redis
+SEARCH_PAGES.redis = redis_storage.redis
+INLINE_SEARCH.redis = redis_storage.redis
+dp.update.outer_middleware(ProfilingMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.pre_checkout_query.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.inline_query.middleware(HandlerMetricsMiddleware())
+QUEUE_DEPTH.set_function(lambda: dp.executor.queue_depth, queue='chat_updates')
+QUEUE_DEPTH.set_function(lambda: dp.executor.running, queue='chat_updates_running')
 
 class States(StatesGroup):
     notes = State()
@@ -59,12 +98,19 @@ class States(StatesGroup):
     wait_for_payment = State()
     wait_for_json = State()
 
+class SearchMore(CallbackData, prefix='search'):
+    cursor: str
+    offset: int
+
 PRICE_1_MONTH = 640
 PRICE_3_MONTHS = 580
 PRICE_6_MONTHS = 540
 PRICE_12_MONTHS = 480
 INVITE_DISCOUNT = 0.8
 
+# Telegram ids of users allowed to run the diagnostic commands (/trace, /profile), comma separated
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
 FREE_USERS = ['ryko_official', 'netnet_dada', 'AristotelPetrov', 'donRumata03', 'Minlos', 'youryouthhh', 'random_chemist_name_7', 'MLfroge', 'Maxie_fintech']
 
 async def check_subscription(user: TelegramUser):
@@ -120,7 +166,8 @@ async def command_start_handler(message: types.Message, state: FSMContext, comma
     invited_message = None
 
     invited_by = command.args
-    if invited_by:
+    # Other deep links (the inline mode button) carry no inviter
+    if invited_by and invited_by.isdigit():
 
         invited_by_user = await TelegramUser.get(telegram_id=invited_by)
         if invited_by_user:
@@ -156,13 +203,14 @@ async def command_start_handler(message: types.Message, state: FSMContext, comma
 async def cmd_help(message: types.Message):
     help_text = (
         "Вот, что я могу:\n\n"
-        "/search 🔎 - Your notes\n"
+        "/search 🔎 - Your notes, e.g. /search chat=\"Chat\" sender=Name from=2024-03-01 to=2024-03-31 type=photo\n"
         "/chat 💬 - With the knowledge base\n"
         "/note ✍️ - Back to notes mode\n"
         "/import 📥 - Import notes from Telegram\n"
         "/link 🔗 - Invite friends with discount\n"
         "/subscribe ✅ - Your access to the bot\n"
         "/update 🔄 - Update the vector store\n"
+        "/cloud ☁️ - Wordcloud of your notes and chats\n"
         "/help ℹ️ - What can I do?"
     )
 
@@ -244,16 +292,48 @@ async def cmd_note_mode(message: types.Message, state: FSMContext):
     await state.set_state(States.notes)
     await message.answer('Добавляй заметки, а я их запомню ✍️')
 
+FILTERS_USAGE = (
+    'Поиск и чат можно ограничить фильтрами после команды или прямо в запросе, например:\n'
+    '/search chat="Название чата" sender=Имя from=2024-03-01 to=2024-03-31 type=photo\n'
+    'Для заметок используй chat=notes'
+)
+
+async def resolve_filters(message: types.Message, user: TelegramUser, text: str) -> tuple[str, dict | None] | None:
+    """Query without the filters and their Pinecone filter, None after telling the user what is wrong with them."""
+
+    try:
+        query, filters = parse_filters(text)
+    except ValueError:
+        await message.answer(FILTERS_USAGE)
+        return None
+    if not filters:
+        return query, None
+
+    try:
+        # Names are looked up in the import archive on disk
+        return query, await asyncio.to_thread(metadata_filter, filters, user.telegram_id)
+    except LookupError as e:
+        await message.answer(f'Не нашел в импортированных чатах чат или отправителя "{html.escape(e.args[0])}"\n\n{FILTERS_USAGE}')
+        return None
+
 @dp.message(Command('chat'))
-async def cmd_chat_mode(message: types.Message, state: FSMContext):
+async def cmd_chat_mode(message: types.Message, state: FSMContext, command: CommandObject):
 
     await state.clear()
 
+    try:
+        parse_filters(command.args or '')
+    except ValueError:
+        await message.answer(FILTERS_USAGE)
+        return
+
     await state.set_state(States.chat)
+    # Filters given with the command narrow the retrieval for the first question
+    await state.update_data(chat_filters=command.args)
     await message.answer('Чат с базой знаний активирован. Задавай вопросы 💬')
 
 @dp.message(Command('search'))
-async def cmd_search(message: types.Message, state: FSMContext):
+async def cmd_search(message: types.Message, state: FSMContext, command: CommandObject):
     user, _ = await TelegramUser.get_or_create(
         telegram_id=message.from_user.id,
         defaults={
@@ -271,8 +351,16 @@ async def cmd_search(message: types.Message, state: FSMContext):
     if not notes:
         await message.answer('У тебя пока нет заметок')
         return
-    
+
+    try:
+        parse_filters(command.args or '')
+    except ValueError:
+        await message.answer(FILTERS_USAGE)
+        return
+
     await state.set_state(States.search)
+    # Filters given with the command apply to the query that follows
+    await state.update_data(search_filters=command.args)
     await message.answer('Введи свой поисковый запрос 🔎')
 
 @dp.message(Command('update'))
@@ -294,6 +382,129 @@ async def cmd_update_pincone(message: types.Message):
     await upload_notes_to_pinecone(user)
     await message.answer('Обновил базу знаний 🔄')
 
+CLOUD_USAGE = (
+    'Облако ключевых слов по всем заметкам и чатам или с фильтрами, например:\n'
+    '/cloud chat="Название чата" sender=Имя from=2024-01-01 to=2024-03-31\n'
+    'Для заметок используй chat=notes'
+)
+
+@dp.message(Command('cloud'))
+async def cmd_cloud(message: types.Message, command: CommandObject):
+    user, _ = await TelegramUser.get_or_create(
+        telegram_id=message.from_user.id,
+        defaults={
+            'username': message.from_user.username or "there",
+            'first_name': message.from_user.first_name or "",
+            'last_name': message.from_user.last_name or ""
+        }
+    )
+
+    has_active_subscription = await check_subscription(user)
+    if not has_active_subscription:
+        await message.answer('Для облака ключевых слов нужно оформить подписку: /subscribe')
+        return
+
+    filters = {}
+    try:
+        for arg in shlex.split(command.args or ''):
+            key, value = arg.split('=', 1)
+            if key == 'chat':
+                filters['source'] = value
+            elif key == 'sender':
+                filters['sender'] = value
+            elif key == 'from':
+                filters['date_from'] = datetime.date.fromisoformat(value)
+            elif key == 'to':
+                filters['date_to'] = datetime.date.fromisoformat(value)
+            else:
+                raise ValueError(key)
+    except ValueError:
+        await message.answer(CLOUD_USAGE)
+        return
+
+    term_stats = await get_term_stats(user)
+    frequencies = await asyncio.to_thread(term_stats.frequencies, **filters)
+    if not frequencies:
+        await message.answer('Не нашел сообщений для облака ☹️\n\n' + CLOUD_USAGE)
+        return
+
+    wordcloud_image = types.BufferedInputFile(render_wordcloud(frequencies), filename='wordcloud.png')
+    await message.answer_photo(photo=wordcloud_image, caption='Лови облако ключевых слов ☁️')
+
+async def resolve_user_id(target: str) -> int | None:
+    """Telegram id from a numeric id or a @username of a known user."""
+
+    if target.lstrip('-').isdigit():
+        return int(target)
+    user = await TelegramUser.get_or_none(username=target.removeprefix('@'))
+    return user.telegram_id if user else None
+
+TRACE_USAGE = 'Разбивка последнего запроса пользователя по этапам: /trace [telegram_id или @username]'
+
+@dp.message(Command('trace'), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_trace(message: types.Message, command: CommandObject):
+
+    target = (command.args or '').strip()
+    user_id = await resolve_user_id(target) if target else message.from_user.id
+    if user_id is None:
+        await message.answer(f'Не знаю пользователя {html.escape(target)}\n\n{TRACE_USAGE}')
+        return
+
+    if not SINK.path:
+        await message.answer('Трассировка выключена (TRACE_PATH)')
+        return
+
+    data = await asyncio.to_thread(SINK.last_trace, user_id)
+    if data is None:
+        await message.answer(f'Нет запросов пользователя {user_id} в журнале трассировки')
+        return
+
+    await message.answer(format_trace(data))
+
+PROFILE_USAGE = (
+    'Профилирование следующих запросов пользователя (CPU и память):\n'
+    f'/profile telegram_id или @username [число запросов, по умолчанию {PROFILE_UPDATES}]\n'
+    '/profile off telegram_id или @username\n'
+    '/profile — статус и последние профили'
+)
+
+@dp.message(Command('profile'), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: types.Message, command: CommandObject):
+
+    args = (command.args or '').split()
+
+    if not args:
+        armed = ', '.join(f'{user_id}: {left}' for user_id, left in PROFILER.armed.items()) or 'нет'
+        saved = '\n'.join(html.escape(path) for path in PROFILER.saved[-5:]) or 'нет'
+        await message.answer(f'Ожидают профилирования: {armed}\nПоследние профили:\n{saved}\n\n{PROFILE_USAGE}')
+        return
+
+    disarm = args[0] == 'off'
+    if disarm:
+        args = args[1:]
+    try:
+        target = args[0]
+        updates = int(args[1]) if len(args) > 1 else PROFILE_UPDATES
+    except (IndexError, ValueError):
+        await message.answer(PROFILE_USAGE)
+        return
+
+    user_id = await resolve_user_id(target)
+    if user_id is None:
+        await message.answer(f'Не знаю пользователя {html.escape(target)}\n\n{PROFILE_USAGE}')
+        return
+
+    if disarm:
+        PROFILER.disarm(user_id)
+        await message.answer(f'Профилирование пользователя {user_id} отменено')
+        return
+
+    PROFILER.arm(user_id, updates)
+    await message.answer(
+        f'Профилирую следующие {updates} запросов пользователя {user_id}, '
+        f'результаты будут в {html.escape(PROFILER.directory)}'
+    )
+
 @dp.message(States.subscription_choice)
 async def process_subscription_choice(message: types.Message, state: FSMContext):
 
@@ -392,6 +603,14 @@ async def process_successful_payment(message: types.Message):
         if not flag:
             print('SUBSCRIPTION NOT ACTIVE, SOMETHING WRONG')
     
+def imported_chat_message(doc) -> str:
+    """Markdown of a found document of an imported chat: its messages, the chat and the date."""
+
+    body, _, chat_name = doc.page_content.partition('\nFrom the chat: ')
+    # The context packer may cut the footer, conversation windows also keep the chat in metadata
+    chat_name = chat_name or doc.metadata.get('chat_name', '')
+    return f"```\n{body}\n```From the chat: {chat_name}\n\nDate: {doc.metadata['date'].split('T')[0]}"
+
 @dp.message(States.chat)
 async def chat_with_kb(message: types.Message, state: FSMContext):
 
@@ -418,21 +637,56 @@ async def chat_with_kb(message: types.Message, state: FSMContext):
         return
     
     data = await state.get_data()
-    thread_id = data.get('thread_id')
-    assistant_id = data.get('assistant_id')
 
-    if thread_id and assistant_id:
+    if data.get('conversation'):
+
+        conversation = Conversation.from_dict(data['conversation'])
+        reply = None
+        last_edit = 0.0
+
+        async def show_partial(text: str):
+            # The answer is streamed into one message, Telegram allows about one edit per second
+            nonlocal reply, last_edit
+            if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            if reply is None:
+                reply = await message.answer(text, parse_mode=None)
+            else:
+                await reply.edit_text(text, parse_mode=None)
+
+        output = await continue_kb_chat(user, message.text, conversation, on_text=show_partial)
+        await state.update_data(conversation=conversation.to_dict())
+
+        if reply is None:
+            await message.answer(output, parse_mode=ParseMode.MARKDOWN)
+        else:
+            try:
+                await reply.edit_text(output, parse_mode=ParseMode.MARKDOWN)
+            except aiogram.exceptions.TelegramBadRequest as e:
+                # The last partial text was already the whole answer
+                if 'message is not modified' not in str(e):
+                    raise
 
-        output, thread_id, assistant_id = await continue_kb_chat(user, message.text, data['thread_id'], data['assistant_id'])
-        await state.update_data(thread_id=thread_id, assistant_id=assistant_id)
-        await message.answer(output, parse_mode=ParseMode.MARKDOWN)
+        # Summarizing the older turns waits until the user has the answer, the next
+        # update of the chat is only handled after this one so it sees the compacted history
+        if await conversation.compact(get_llm()):
+            await state.update_data(conversation=conversation.to_dict())
 
         return
     
     else:
 
-        results, thread_id, assistant_id = await start_kb_chat(user, message.text)
-        await state.update_data(thread_id=thread_id, assistant_id=assistant_id)
+        resolved = await resolve_filters(message, user, f"{data.get('chat_filters') or ''} {message.text or ''}")
+        if resolved is None:
+            return
+        question, chat_filter = resolved
+        if not question:
+            await message.answer(f'Задай вопрос по своим заметкам 💬\n\n{FILTERS_USAGE}')
+            return
+
+        results, conversation = await start_kb_chat(user, question, chat_filter)
+        await state.update_data(conversation=conversation.to_dict())
 
         await message.answer(results.get('answer', ''), parse_mode=ParseMode.MARKDOWN, reply_markup=types.ReplyKeyboardRemove())
         await message.answer('Мой ответ основан на следующих сообщениях:', reply_markup=types.ReplyKeyboardRemove())
@@ -454,21 +708,13 @@ async def chat_with_kb(message: types.Message, state: FSMContext):
 
         sent_messages = set()
         for result in results.get('context', []):
-            try:
-                date = result.metadata['date']
-            except KeyError:
+            if 'date' not in result.metadata:
                 continue
-            message_from_imported_chat = result.page_content
-            message_from_imported_chat += f'\n\nDate: {date.split('T')[0]}'
+            message_from_imported_chat = imported_chat_message(result)
             if message_from_imported_chat in sent_messages:
                 continue
             sent_messages.add(message_from_imported_chat)
 
-            messages_parts = message_from_imported_chat.split('From the chat: ')
-            part_monospace = f'```\n{messages_parts[0]}```'
-            part_info = f'From the chat: {messages_parts[1]}'
-            message_from_imported_chat = part_monospace + part_info
-
             await message.answer(message_from_imported_chat, parse_mode=ParseMode.MARKDOWN)
 
 
@@ -506,23 +752,30 @@ async def process_json_file(message: types.Message, state: FSMContext):
 
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     file_name = os.path.join('exported_chats', f'chat_{file_id}stamp_{timestamp}.json')
-    await bot.download_file(file.file_path, file_name)
+    with measure('import.download'):
+        await bot.download_file(file.file_path, file_name)
     
 
-    df, chat_name = parse_telegram_chat(file_name)
-    wordcloud_path = generate_wordcloud(df, chat_name)
-    wordcloud_image = types.FSInputFile(wordcloud_path)
+    with measure('import.parse'):
+        df, chat_name = parse_telegram_chat(file_name)
+    with measure('import.report'):
+        report = chat_report(df, chat_name)
+    with measure('import.wordcloud'):
+        wordcloud_png = generate_wordcloud(df, chat_name)
+    wordcloud_image = types.BufferedInputFile(wordcloud_png, filename=f'{chat_name}_wordcloud.png')
 
-    await upload_exported_chat_to_pinecone(user, df, chat_name)
+    summary = await upload_exported_chat_to_pinecone(user, df, chat_name)
 
     await message.answer_photo(
         photo=wordcloud_image,
-        caption=f'Чат "{chat_name}" успешно импортирован. Лови облако ключевых слов из чата ☁️',
+        caption=(
+            f'Чат "{chat_name}" успешно импортирован: {summary.new + summary.edited} новых сообщений, '
+            f'{summary.unchanged} уже были в базе знаний. Лови облако ключевых слов из чата ☁️'
+        ),
         show_caption_above_media=True,
         reply_markup=types.ReplyKeyboardRemove()
     )
-
-    os.remove(wordcloud_path)
+    await message.answer(report)
 
 @dp.message(States.notes)
 async def add_note(message: types.Message):
@@ -593,11 +846,60 @@ async def process_search_query(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    search_results = await search_notes(user, message.text)
+    data = await state.get_data()
+    resolved = await resolve_filters(message, user, f"{data.get('search_filters') or ''} {message.text or ''}")
+    if resolved is None:
+        return
+    query, search_filter = resolved
+    if not query:
+        await message.answer('Введи свой поисковый запрос 🔎')
+        return
+
+    search_results = await search_notes(user, query, k=SEARCH_RESULTS, metadata_filter=search_filter)
+
+    if not search_results:
+        await message.answer('Ничего не найдено😕 Попробуй другой запрос')
+        return
+
+    # The rest is paged with the "More" button without searching again
+    page, rest = search_results[:SEARCH_PAGE_SIZE], search_results[SEARCH_PAGE_SIZE:]
+    await send_search_results(message, page)
+    cursor = await SEARCH_PAGES.save(user.telegram_id, rest)
+    if cursor:
+        await message.answer(f'Показано {len(page)} из {len(search_results)}', reply_markup=more_button(cursor, 0))
+
+    await state.clear()
+
+@dp.callback_query(SearchMore.filter())
+async def more_search_results(callback: types.CallbackQuery, callback_data: SearchMore):
+
+    # The button moves to the end of the next page
+    await callback.message.edit_reply_markup(reply_markup=None)
+
+    page = await SEARCH_PAGES.page(callback.from_user.id, callback_data.cursor, callback_data.offset)
+    if page is None:
+        await callback.answer('Результаты поиска устарели, повтори поиск: /search', show_alert=True)
+        return
+    await callback.answer()
+
+    documents, total = page
+    await send_search_results(callback.message, documents)
+
+    offset = callback_data.offset + len(documents)
+    reply_markup = more_button(callback_data.cursor, offset) if offset < total else None
+    await callback.message.answer(f'Показано {SEARCH_PAGE_SIZE + offset} из {SEARCH_PAGE_SIZE + total}', reply_markup=reply_markup)
+
+def more_button(cursor: str, offset: int) -> types.InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text='Ещё ▶️', callback_data=SearchMore(cursor=cursor, offset=offset))
+    return builder.as_markup()
+
+async def send_search_results(message: types.Message, results: list):
+    """Forward the found notes and send the found fragments of imported chats."""
 
     sent_messages = set()
 
-    for result in search_results:
+    for result in results:
 
         try:
             message_id = result.metadata['source']
@@ -610,29 +912,91 @@ async def process_search_query(message: types.Message, state: FSMContext):
             message_id=message_id
         )
 
-    for result in search_results:
-        try:
-            date = result.metadata['date']
-        except KeyError:
+    for result in results:
+        if 'date' not in result.metadata:
             continue
-        message_from_imported_chat = result.page_content
-        message_from_imported_chat += f'\n\nDate: {date.split('T')[0]}'
+        message_from_imported_chat = imported_chat_message(result)
         if message_from_imported_chat in sent_messages:
             continue
         sent_messages.add(message_from_imported_chat)
 
-        messages_parts = message_from_imported_chat.split('From the chat: ')
-        part_monospace = f'```\n{messages_parts[0]}```'
-        part_info = f'From the chat: {messages_parts[1]}'
-        message_from_imported_chat = part_monospace + part_info
-
         await message.answer(message_from_imported_chat, parse_mode=ParseMode.MARKDOWN)
 
-    if not search_results:
-        await message.answer('Ничего не найдено😕 Попробуй другой запрос')
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+
+    started = time.monotonic()
+    user_id = inline_query.from_user.id
+    query = normalize_query(inline_query.query)
+    if len(query) < INLINE_MIN_CHARS:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
         return
 
-    await state.clear()
+    # Cached results are notes too, they are only shown while the subscription lasts
+    user = await TelegramUser.get_or_none(telegram_id=user_id)
+    if user is None or not await check_subscription(user):
+        button = types.InlineQueryResultsButton(text='Поиск по заметкам доступен по подписке', start_parameter='inline')
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True, button=button)
+        return
+
+    cached, fallback = await INLINE_SEARCH.start(user_id, inline_query.id, query)
+    if cached is not None:
+        await inline_query.answer(inline_results(cached), cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    # Every keystroke is a query, only the one the user stopped typing at is searched
+    if not await INLINE_SEARCH.settled(user_id, inline_query.id):
+        return
+
+    if not await user.limmits_not_exceeded:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    try:
+        text, filters = parse_filters(inline_query.query)
+        inline_filter = await asyncio.to_thread(metadata_filter, filters, user_id) if filters else None
+    except (ValueError, LookupError):
+        text = ''
+    if not text:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    found = await INLINE_SEARCH.search(
+        user_id,
+        inline_query.id,
+        query,
+        lambda: search_notes(user, text, k=INLINE_RESULTS, metadata_filter=inline_filter),
+        deadline=started + INLINE_DEADLINE,
+        fallback=fallback,
+    )
+    if found is None:
+        # Superseded while the previous search of the user was running
+        return
+
+    documents, complete = found
+    # Results of a prefix stand in for the running search, Telegram should ask again
+    await inline_query.answer(inline_results(documents), cache_time=INLINE_CACHE_TIME if complete else 0, is_personal=True)
+
+def inline_results(documents: list) -> list[types.InlineQueryResultArticle]:
+    """Found notes as their text, found fragments of imported chats as in the search results."""
+
+    results = []
+    for i, doc in enumerate(documents):
+        if 'date' in doc.metadata:
+            body, _, chat_name = doc.page_content.partition('\nFrom the chat: ')
+            title = chat_name or doc.metadata.get('chat_name') or doc.metadata['date'].split('T')[0]
+            content = types.InputTextMessageContent(message_text=imported_chat_message(doc)[:4096], parse_mode=ParseMode.MARKDOWN)
+        else:
+            body = doc.page_content
+            title, _, _ = body.strip().partition('\n')
+            content = types.InputTextMessageContent(message_text=body[:4096], parse_mode=None)
+        results.append(types.InlineQueryResultArticle(
+            id=str(i),
+            title=title[:64] or '…',
+            description=' '.join(body.split())[:128],
+            input_message_content=content,
+        ))
+    return results
 
 async def scheduled_pinecone_update():
 
@@ -643,20 +1007,40 @@ async def scheduled_pinecone_update():
 
     logging.info('Updated Pinecone')
 
-async def main() -> None:
+async def on_startup(run_scheduler: bool = True, metrics_port: int = METRICS_PORT) -> None:
 
     # Initialize Tortoise ORM
     await init()
 
+    await start_metrics_server(metrics_port)
+    LOOP_MONITOR.start()
+
+    # Heavy dependencies are imported lazily, load them while the bot already takes updates
+    asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+    # With several webhook workers only one of them should run the scheduled jobs
+    if run_scheduler:
+        scheduler.start()
+        scheduler.add_job(scheduled_pinecone_update, 'interval', minutes=UPDATE_INTERVAL, id='pinecone_update', replace_existing=True)
+
+async def main() -> None:
+
+    await on_startup()
+
     # Initialize Bot instance with default bot properties which will be passed to all API calls
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    instrument_bot(bot)
 
-    scheduler.start()
-    scheduler.add_job(scheduled_pinecone_update, 'interval', minutes=UPDATE_INTERVAL, id='pinecone_update', replace_existing=True)
+    # Drop a webhook left over from the webhook mode, otherwise getUpdates is rejected
+    await bot.delete_webhook()
 
     # And the run events dispatching
     await dp.start_polling(bot)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    asyncio.run(main())
\ No newline at end of file
+    if os.getenv('WEBHOOK_URL'):
+        from webhook import run
+        run()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,178 @@
+import html
+
+import polars as pl
+
+from import_archive import typed_chat_frame
+
+MAX_REPLY_DEPTH = 5
+TOP_SENDERS = 5
+
+WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+SPARKS = '▁▂▃▄▅▆▇█'
+
+RESPONSE_BUCKETS = (
+    (60, '< 1 мин'),
+    (5 * 60, '< 5 мин'),
+    (60 * 60, '< 1 ч'),
+    (24 * 60 * 60, '< 1 д'),
+)
+
+
+def _response_bucket() -> pl.Expr:
+    expr = pl.when(pl.col('response_s') < RESPONSE_BUCKETS[0][0]).then(pl.lit(RESPONSE_BUCKETS[0][1]))
+    for limit, label in RESPONSE_BUCKETS[1:]:
+        expr = expr.when(pl.col('response_s') < limit).then(pl.lit(label))
+    return expr.otherwise(pl.lit('≥ 1 д'))
+
+
+def analyze_chat(df: pl.DataFrame) -> dict[str, pl.DataFrame]:
+    """All statistics of a parsed chat as one lazy plan, collected together.
+
+    collect_all shares the common typed base between the queries, so the data
+    is cast and scanned once however many statistics are computed.
+    """
+
+    base = typed_chat_frame(df).lazy().with_columns(
+        pl.col('date').dt.hour().alias('hour'),
+        pl.col('date').dt.weekday().alias('weekday'),
+    )
+
+    links = base.select('msg_id', 'reply_to_msg_id', 'date_unixtime')
+
+    # Walk reply chains up to MAX_REPLY_DEPTH parents with self-joins
+    chains = links.select('msg_id', pl.col('reply_to_msg_id').alias('parent'), pl.lit(0).alias('depth'))
+    for _ in range(MAX_REPLY_DEPTH):
+        chains = (
+            chains
+            .with_columns((pl.col('depth') + pl.col('parent').is_not_null().cast(pl.Int32)).alias('depth'))
+            .join(
+                links.select(pl.col('msg_id').alias('parent'), pl.col('reply_to_msg_id').alias('next_parent')),
+                on='parent', how='left'
+            )
+            .select('msg_id', pl.col('next_parent').alias('parent'), 'depth')
+        )
+
+    responses = (
+        links
+        .filter(pl.col('reply_to_msg_id').is_not_null())
+        .join(
+            links.select(pl.col('msg_id').alias('reply_to_msg_id'), pl.col('date_unixtime').alias('parent_unixtime')),
+            on='reply_to_msg_id'
+        )
+        .select((pl.col('date_unixtime') - pl.col('parent_unixtime')).alias('response_s'))
+        .filter(pl.col('response_s') >= 0)
+    )
+
+    queries = {
+        'overview': base.select(
+            pl.len().alias('messages'),
+            pl.col('sender').n_unique().alias('senders'),
+            pl.col('date').min().alias('date_from'),
+            pl.col('date').max().alias('date_to'),
+            pl.col('reply_to_msg_id').is_not_null().sum().alias('replies'),
+            (pl.col('forwarded_from').fill_null('') != '').sum().alias('forwarded'),
+            pl.col('has_mention').sum().alias('mentions'),
+            pl.col('has_hashtag').sum().alias('hashtags'),
+        ),
+        'top_senders': (
+            base.group_by('sender').agg(pl.len().alias('messages'))
+            .sort('messages', descending=True).head(TOP_SENDERS)
+        ),
+        'hours': base.group_by('hour').agg(pl.len().alias('messages')).sort('hour'),
+        'weekdays': base.group_by('weekday').agg(pl.len().alias('messages')).sort('weekday'),
+        'media': base.group_by('msg_type').agg(pl.len().alias('messages')).sort('messages', descending=True),
+        'reply_depth': (
+            chains.filter(pl.col('depth') > 0)
+            .group_by('depth').agg(pl.len().alias('messages')).sort('depth')
+        ),
+        'response_time': responses.select(
+            pl.col('response_s').median().alias('median_s'),
+            pl.col('response_s').quantile(0.9).alias('p90_s'),
+        ),
+        'response_buckets': (
+            responses.group_by(_response_bucket().alias('bucket')).agg(pl.len().alias('replies'))
+        ),
+    }
+
+    frames = pl.collect_all(list(queries.values()))
+    return dict(zip(queries.keys(), frames))
+
+
+def _duration(seconds: float | None) -> str:
+    if seconds is None:
+        return '—'
+    if seconds < 60:
+        return f'{seconds:.0f} с'
+    if seconds < 60 * 60:
+        return f'{seconds / 60:.0f} мин'
+    if seconds < 24 * 60 * 60:
+        return f'{seconds / 3600:.1f} ч'
+    return f'{seconds / 86400:.1f} д'
+
+
+def _percent(part: int, total: int) -> str:
+    return f'{100 * part / total:.0f}%' if total else '0%'
+
+
+def render_report(stats: dict[str, pl.DataFrame], chat_name: str) -> str:
+    """Compact HTML report for a Telegram message."""
+
+    overview = stats['overview'].row(0, named=True)
+    total = overview['messages']
+
+    lines = [f'📊 <b>Статистика чата «{html.escape(chat_name)}»</b>']
+    date_from, date_to = overview['date_from'], overview['date_to']
+    period = f'{date_from.date()} — {date_to.date()}' if date_from and date_to else '—'
+    lines.append(f'Сообщений: {total}, участников: {overview["senders"]}, период: {period}')
+
+    senders = ', '.join(
+        f'{html.escape(str(row["sender"]))} {_percent(row["messages"], total)}'
+        for row in stats['top_senders'].iter_rows(named=True)
+    )
+    lines.append(f'👤 Топ отправителей: {senders}')
+
+    hours = dict(stats['hours'].filter(pl.col('hour').is_not_null()).iter_rows())
+    if hours:
+        peak = max(hours.values())
+        spark = ''.join(SPARKS[(len(SPARKS) - 1) * hours.get(hour, 0) // peak] for hour in range(24))
+        peak_hour = max(hours, key=hours.get)
+        lines.append(f'🕐 По часам: <code>{spark}</code> пик в {peak_hour}:00')
+
+    weekdays = dict(stats['weekdays'].filter(pl.col('weekday').is_not_null()).iter_rows())
+    if weekdays:
+        lines.append('📅 По дням: ' + ', '.join(
+            f'{WEEKDAYS[day - 1]} {_percent(weekdays.get(day, 0), total)}' for day in range(1, 8)
+        ))
+
+    media = ', '.join(
+        f'{html.escape(str(row["msg_type"]))} {_percent(row["messages"], total)}'
+        for row in stats['media'].head(5).iter_rows(named=True)
+    )
+    lines.append(f'🖼 Типы: {media}')
+
+    lines.append(
+        f'↩️ Ответы: {_percent(overview["replies"], total)}, пересланные: {_percent(overview["forwarded"], total)}, '
+        f'упоминания: {overview["mentions"]}, хэштеги: {overview["hashtags"]}'
+    )
+
+    depths = stats['reply_depth']
+    if not depths.is_empty():
+        lines.append('🧵 Глубина веток: ' + ', '.join(
+            f'{depth}{"+" if depth == MAX_REPLY_DEPTH else ""}: {messages}' for depth, messages in depths.iter_rows()
+        ))
+
+    response = stats['response_time'].row(0, named=True)
+    if response['median_s'] is not None:
+        buckets = dict(stats['response_buckets'].iter_rows())
+        replies = sum(buckets.values())
+        order = [label for _, label in RESPONSE_BUCKETS] + ['≥ 1 д']
+        lines.append(
+            f'⏱ Время ответа: медиана {_duration(response["median_s"])}, 90% за {_duration(response["p90_s"])} ('
+            + ', '.join(f'{label} {_percent(buckets.get(label, 0), replies)}' for label in order) + ')'
+        )
+
+    return '\n'.join(lines)
+
+
+def chat_report(df: pl.DataFrame, chat_name: str) -> str:
+    return render_report(analyze_chat(df), chat_name)
@@ -0,0 +1,179 @@
+"""Per-chat ordered, cross-chat parallel execution of updates.
+
+Each chat gets a lightweight FIFO queue drained by its own task, which exits
+as soon as the queue is empty. Updates of one chat therefore never overlap
+(two quick notes can't both see an empty notes list, a search can't overlap a
+state change), while different chats run concurrently up to a global limit.
+"""
+
+import time
+import asyncio
+import bisect
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.types.update import UpdateTypeLookupError
+
+from metrics import QUEUE_WAIT_SECONDS
+from tracing import trace
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the wait time histogram buckets, in seconds
+WAIT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float('inf'))
+SLOW_WAIT_WARNING = 10
+# Updates that touch no chat state run right away, inline queries are debounced by inline_search.py
+UNORDERED_UPDATES = frozenset({'inline_query', 'chosen_inline_result'})
+
+
+def update_chat_key(update: types.Update) -> int | None:
+    """Id of the chat (or user, for updates without a chat) the update belongs to, None for unordered updates."""
+
+    try:
+        event_type, event = update.event_type, update.event
+    except UpdateTypeLookupError:
+        return None
+    if event_type in UNORDERED_UPDATES:
+        return None
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    if user:
+        return user.id
+    return None
+
+
+def update_origin(update: types.Update) -> tuple[str, int | None]:
+    """Event type of the update and id of the user who sent it, for tracing."""
+
+    try:
+        event_type, user = update.event_type, getattr(update.event, 'from_user', None)
+    except UpdateTypeLookupError:
+        return 'unknown', None
+    return event_type, user.id if user else None
+
+
+class KeyedExecutor:
+    """Runs coroutines one at a time per key and at most `max_concurrency` at once overall."""
+
+    def __init__(self, max_concurrency: int = 100):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.queues: dict[Hashable, deque] = {}
+        self.drainers: set[asyncio.Task] = set()
+        self.running = 0
+
+        self.wait_buckets = [0] * len(WAIT_BUCKETS)
+        self.wait_sum = 0.0
+        self.wait_count = 0
+        self.wait_max = 0.0
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            drainer = asyncio.create_task(self._drain(key, queue))
+            self.drainers.add(drainer)
+            drainer.add_done_callback(self.drainers.discard)
+        queue.append((fn, future, time.monotonic()))
+
+        return await future
+
+    async def _drain(self, key: Hashable, queue: deque):
+
+        try:
+            while queue:
+                fn, future, enqueued_at = queue[0]
+                async with self.semaphore:
+                    queue.popleft()
+                    self._observe_wait(time.monotonic() - enqueued_at, key)
+                    if future.cancelled():
+                        continue
+
+                    self.running += 1
+                    try:
+                        result = await fn()
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        if asyncio.current_task().cancelling():
+                            raise
+                        # The handler was cancelled on its own (e.g. a task it awaited), the chat goes on
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    except BaseException as e:
+                        if not future.done():
+                            future.set_exception(e)
+                        raise
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                    finally:
+                        self.running -= 1
+        finally:
+            del self.queues[key]
+            # Left over only when the drainer itself was cancelled or interrupted, nothing would run them
+            for _, future, _ in queue:
+                future.cancel()
+
+    def _observe_wait(self, wait: float, key: Hashable):
+        self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS, wait)] += 1
+        self.wait_sum += wait
+        self.wait_count += 1
+        self.wait_max = max(self.wait_max, wait)
+        QUEUE_WAIT_SECONDS.observe(wait)
+        if wait > SLOW_WAIT_WARNING:
+            logger.warning(f'Update for {key} waited {wait:.1f}s in the queue')
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> dict:
+        return {
+            'active_keys': len(self.queues),
+            'running': self.running,
+            'queue_depth': self.queue_depth,
+            'max_key_depth': max((len(queue) for queue in self.queues.values()), default=0),
+            'wait_count': self.wait_count,
+            'wait_avg': self.wait_sum / self.wait_count if self.wait_count else 0.0,
+            'wait_max': self.wait_max,
+            'wait_buckets': dict(zip(WAIT_BUCKETS, self.wait_buckets)),
+        }
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher feeding every update through a KeyedExecutor keyed by chat.
+
+    Every update is traced from the moment it leaves the queue, including the
+    FSM state lookup of the outer middlewares. Ordering across processes is up
+    to the caller (see webhook.py).
+    """
+
+    def __init__(self, *args, max_concurrency: int = 100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = KeyedExecutor(max_concurrency)
+
+    async def feed_update(self, bot: Bot, update: types.Update, **kwargs: Any) -> Any:
+
+        key = update_chat_key(update)
+        event_type, user_id = update_origin(update)
+        if key is None:
+            with trace('update', user_id, update_id=update.update_id, type=event_type):
+                return await super().feed_update(bot, update, **kwargs)
+
+        enqueued_at = time.monotonic()
+
+        async def process():
+            # Runs in the drainer task of the chat, the trace is opened there
+            with trace('update', user_id, update_id=update.update_id, type=event_type) as root:
+                if root is not None:
+                    root.attributes['queue_wait_ms'] = round((time.monotonic() - enqueued_at) * 1000, 1)
+                return await Dispatcher.feed_update(self, bot, update, **kwargs)
+
+        return await self.executor.run(key, process)
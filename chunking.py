@@ -0,0 +1,248 @@
+import re
+import functools
+from dataclasses import dataclass
+
+import tiktoken
+import polars as pl
+from langchain_core.documents import Document
+
+# Tokenizer of text-embedding-3-small
+ENCODING_NAME = 'cl100k_base'
+
+CHUNK_MAX_TOKENS = 512
+CHUNK_OVERLAP_TOKENS = 32
+
+PARAGRAPH_PATTERN = re.compile(r'\n\s*\n')
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?…])\s+')
+
+
+@functools.cache
+def get_encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode_ordinary(text))
+
+
+@dataclass
+class ChunkStats:
+    documents: int = 0
+    chunks: int = 0
+    tokens: int = 0
+    split_documents: int = 0
+
+    def __str__(self):
+        return f'{self.documents} documents -> {self.chunks} chunks ({self.split_documents} split), {self.tokens} tokens'
+
+
+class TokenChunker:
+    """Splits documents by model tokens, only when they don't fit into one chunk.
+
+    Long texts are cut on paragraph, then sentence boundaries, and only if a
+    single sentence is still too long, on token boundaries. Consecutive chunks
+    share at most `overlap_tokens` tokens of whole sentences.
+    """
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def _units(self, text: str) -> list[tuple[str, int]]:
+        """Break text into (piece, tokens) pairs each fitting into max_tokens."""
+
+        units = []
+        for paragraph in PARAGRAPH_PATTERN.split(text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            tokens = count_tokens(paragraph)
+            if tokens <= self.max_tokens:
+                units.append((paragraph, tokens))
+                continue
+
+            for sentence in SENTENCE_PATTERN.split(paragraph):
+                tokens = get_encoding().encode_ordinary(sentence)
+                if len(tokens) <= self.max_tokens:
+                    units.append((sentence, len(tokens)))
+                    continue
+                for i in range(0, len(tokens), self.max_tokens):
+                    part = tokens[i:i + self.max_tokens]
+                    units.append((get_encoding().decode(part), len(part)))
+
+        return units
+
+    def split_text(self, text: str, tokens: int | None = None) -> list[str]:
+
+        if tokens is None:
+            tokens = count_tokens(text)
+        if tokens <= self.max_tokens:
+            return [text]
+
+        chunks = []
+        current: list[tuple[str, int]] = []
+        current_tokens = 0
+
+        for unit in self._units(text):
+            # +1 per unit for the separator joining it
+            if current and current_tokens + unit[1] + 1 > self.max_tokens:
+                chunks.append(' '.join(piece for piece, _ in current))
+
+                overlap, overlap_tokens = [], 0
+                for piece, piece_tokens in reversed(current):
+                    if overlap_tokens + piece_tokens > self.overlap_tokens:
+                        break
+                    overlap.insert(0, (piece, piece_tokens))
+                    overlap_tokens += piece_tokens + 1
+                if overlap_tokens + unit[1] + 1 > self.max_tokens:
+                    overlap, overlap_tokens = [], 0
+                current, current_tokens = overlap, overlap_tokens
+
+            current.append(unit)
+            current_tokens += unit[1] + 1
+
+        if current:
+            chunks.append(' '.join(piece for piece, _ in current))
+
+        return chunks
+
+    def split_documents(self, documents: list[Document]) -> tuple[list[Document], ChunkStats]:
+        """Split documents and record the number of tokens in each chunk's metadata."""
+
+        stats = ChunkStats(documents=len(documents))
+        token_counts = [len(tokens) for tokens in get_encoding().encode_ordinary_batch([doc.page_content for doc in documents])]
+
+        chunks = []
+        for doc, tokens in zip(documents, token_counts):
+            if tokens <= self.max_tokens:
+                texts, counts = [doc.page_content], [tokens]
+            else:
+                texts = self.split_text(doc.page_content, tokens)
+                counts = [count_tokens(text) for text in texts]
+                stats.split_documents += 1
+
+            for text, count in zip(texts, counts):
+                chunks.append(Document(page_content=text, metadata={**doc.metadata, 'tokens': count}))
+                stats.tokens += count
+
+        stats.chunks = len(chunks)
+        return chunks, stats
+
+
+WINDOW_MAX_TOKENS = 384
+WINDOW_MAX_GAP = 30 * 60  # seconds
+WINDOW_MAX_TURNS = 8
+
+
+def window_conversation(
+    df: pl.DataFrame,
+    chat_name: str,
+    max_tokens: int = WINDOW_MAX_TOKENS,
+    max_gap: int = WINDOW_MAX_GAP,
+    max_turns: int = WINDOW_MAX_TURNS,
+) -> pl.DataFrame:
+    """Group consecutive messages of a parsed chat into conversation windows.
+
+    A new window starts when a message
+    - comes more than `max_gap` seconds after the previous one, unless it replies into the window,
+    - replies to a message outside the current window,
+    - would make the window exceed `max_tokens` or `max_turns` changes of sender.
+
+    Returns one row per window with its text (one "sender: message" line per
+    message), the covered msg_ids and date range, and the structured metadata
+    search filters on (see search_filters.py).
+    """
+
+    date = pl.col('date')
+    if df.schema['date'] != pl.Utf8:
+        # Archived chats have typed dates, metadata keeps ISO strings
+        date = date.dt.strftime('%Y-%m-%dT%H:%M:%S')
+    chat_ids = df['chat_id'].drop_nulls() if 'chat_id' in df.columns else []
+    chat_id = str(chat_ids[0]) if len(chat_ids) else None
+
+    messages = (
+        df.lazy()
+        .with_columns(
+            date.alias('date'),
+            pl.col('date_unixtime').cast(pl.Int64, strict=False),
+            pl.col('reply_to_msg_id').cast(pl.Int64, strict=False),
+            pl.col('sender').cast(pl.Utf8).fill_null('Unknown'),
+            pl.col('forwarded_from').cast(pl.Utf8).fill_null(''),
+            pl.col('msg_content').cast(pl.Utf8).fill_null(''),
+            *(
+                (pl.col(name).cast(pl.Utf8) if name in df.columns else pl.lit(None, dtype=pl.Utf8)).replace('', None).alias(name)
+                for name in ('sender_id', 'msg_type')
+            ),
+        )
+        .filter(pl.col('msg_content').str.strip_chars() != '')
+        .with_columns(
+            pl.when(pl.col('forwarded_from') != '')
+            .then(pl.col('sender') + ' (forwarded from ' + pl.col('forwarded_from') + '): ' + pl.col('msg_content'))
+            .otherwise(pl.col('sender') + ': ' + pl.col('msg_content'))
+            .alias('line')
+        )
+        .collect()
+    )
+
+    lines = messages['line'].to_list()
+    token_counts = [len(tokens) for tokens in get_encoding().encode_ordinary_batch(lines)]
+    msg_ids = messages['msg_id'].to_list()
+    dates = messages['date_unixtime'].to_list()
+    senders = messages['sender'].to_list()
+    replies = messages['reply_to_msg_id'].to_list()
+
+    window_ids = []
+    window = -1
+    window_msg_ids = set()
+    window_tokens = 0
+    window_turns = 0
+
+    for i, tokens in enumerate(token_counts):
+        replies_into_window = replies[i] is not None and replies[i] in window_msg_ids
+
+        if window < 0:
+            new_window = True
+        else:
+            turn = senders[i] != senders[i - 1]
+            gap = dates[i] is not None and dates[i - 1] is not None and dates[i] - dates[i - 1] > max_gap
+            new_window = (
+                window_tokens + tokens > max_tokens
+                or window_turns + turn > max_turns
+                or (gap and not replies_into_window)
+                or (replies[i] is not None and not replies_into_window)
+            )
+
+        if new_window:
+            window += 1
+            window_msg_ids = set()
+            window_tokens = 0
+            window_turns = 0
+        elif turn:
+            window_turns += 1
+
+        window_msg_ids.add(msg_ids[i])
+        window_tokens += tokens
+        window_ids.append(window)
+
+    return (
+        messages.lazy()
+        .with_columns(pl.Series('window', window_ids, dtype=pl.Int64))
+        .group_by('window', maintain_order=True)
+        .agg(
+            pl.col('line').str.join('\n').alias('text'),
+            pl.col('date').first().alias('date'),
+            pl.col('date').last().alias('date_end'),
+            pl.col('msg_id').cast(pl.Utf8).alias('msg_ids'),
+            pl.col('date_unixtime').first().alias('date_unix'),
+            pl.col('date_unixtime').last().alias('date_end_unix'),
+            pl.col('sender_id').drop_nulls().unique(maintain_order=True).alias('sender_ids'),
+            pl.col('msg_type').drop_nulls().unique(maintain_order=True).alias('msg_types'),
+        )
+        .with_columns(
+            (pl.col('text') + f'\nFrom the chat: {chat_name}').alias('text'),
+            pl.lit(chat_name).alias('chat_name'),
+            pl.lit(chat_id, dtype=pl.Utf8).alias('chat_id'),
+        )
+        .drop('window')
+        .collect()
+    )
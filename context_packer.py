@@ -0,0 +1,164 @@
+"""Fitting retrieved documents into the token budget of the RAG prompt.
+
+The retriever returns up to CONTEXT_CANDIDATES (document, relevance) pairs,
+pack_context keeps them in the order of relevance and
+- stops at the first drop of relevance larger than CONTEXT_SCORE_GAP after
+  CONTEXT_MIN_K documents, a clear match is not padded with weaker ones,
+- drops sentences and message lines already given by a more relevant
+  document: chunks of a long note share CHUNK_OVERLAP_TOKENS, windows of
+  re-imported chats repeat messages; a document with nothing new is dropped,
+- if the rest is over CONTEXT_MAX_TOKENS, cuts the "From the chat: ..."
+  footers first (repeated ones, then all), then the least relevant
+  documents, then the end of the last one.
+
+Tokens are counted with the tokenizer of chunking.py, close enough to the
+chat model's to keep the prompt within the budget.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+
+from langchain_core.documents import Document
+
+from chunking import get_encoding
+
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', 2000))
+CONTEXT_CANDIDATES = 12
+CONTEXT_MIN_K = 2
+CONTEXT_SCORE_GAP = 0.05
+
+# Sentences and lines shorter than this ("Ok", "Thanks!") are not deduplicated
+MIN_DEDUP_CHARS = 24
+
+# Separators are kept by the split, so that a text can be put back together
+SEGMENT_PATTERN = re.compile(r'(\n+|(?<=[.!?…])\s+)')
+# Added to every conversation window by window_conversation
+FOOTER_PATTERN = re.compile(r'\nFrom the chat: [^\n]*$')
+# Documents are joined with "\n\n" in the prompt, one token
+SEPARATOR_TOKENS = 1
+
+
+@dataclass
+class PackedContext:
+    documents: list[Document]
+    candidates: int = 0
+    retrieved_tokens: int = 0
+    tokens: int = 0
+    below_gap: int = 0
+    duplicates: int = 0
+    over_budget: int = 0
+    footers_cut: int = 0
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.retrieved_tokens - self.tokens
+
+    def __str__(self):
+        return (
+            f'{self.candidates} documents, {self.retrieved_tokens} tokens -> {len(self.documents)} documents, '
+            f'{self.tokens} tokens ({self.saved_tokens} saved: {self.below_gap} below the score gap, '
+            f'{self.duplicates} duplicates, {self.over_budget} over the budget, {self.footers_cut} footers cut)'
+        )
+
+
+def adaptive_k(scores: list[float], min_k: int = CONTEXT_MIN_K, gap: float = CONTEXT_SCORE_GAP) -> int:
+    """Number of leading scores (sorted descending) before the first drop larger than `gap`."""
+
+    for i in range(max(min_k, 1), len(scores)):
+        if scores[i - 1] - scores[i] > gap:
+            return i
+    return len(scores)
+
+
+def remove_seen(text: str, seen: set[str]) -> str:
+    """Text without the sentences and lines in `seen`, which gets the new ones."""
+
+    parts = SEGMENT_PATTERN.split(text)
+    kept = []
+    for i in range(0, len(parts), 2):
+        segment = parts[i]
+        separator = parts[i + 1] if i + 1 < len(parts) else ''
+        key = ' '.join(segment.split()).casefold()
+        if len(key) >= MIN_DEDUP_CHARS:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(segment + separator)
+    return ''.join(kept).strip()
+
+
+def count_context_tokens(texts: list[str]) -> list[int]:
+    return [len(tokens) for tokens in get_encoding().encode_ordinary_batch(texts)]
+
+
+def _total(counts: list[int]) -> int:
+    return sum(counts) + SEPARATOR_TOKENS * max(len(counts) - 1, 0)
+
+
+def pack_context(
+    results: list[tuple[Document, float]],
+    max_tokens: int = CONTEXT_MAX_TOKENS,
+    min_k: int = CONTEXT_MIN_K,
+    score_gap: float = CONTEXT_SCORE_GAP,
+) -> PackedContext:
+    """Most relevant, non-overlapping documents fitting into `max_tokens`, most relevant first."""
+
+    results = sorted(results, key=lambda result: result[1], reverse=True)
+    # Without packing every distinct retrieved text went into the prompt
+    retrieved = list(dict.fromkeys(doc.page_content for doc, _ in results))
+    packed = PackedContext([], candidates=len(results), retrieved_tokens=_total(count_context_tokens(retrieved)))
+
+    k = adaptive_k([score for _, score in results], min_k, score_gap)
+    packed.below_gap = len(results) - k
+
+    seen: set[str] = set()
+    kept: list[tuple[Document, float, str, str]] = []
+    for doc, score in results[:k]:
+        footer = FOOTER_PATTERN.search(doc.page_content)
+        body = doc.page_content[:footer.start()] if footer else doc.page_content
+        body = remove_seen(body, seen)
+        if not body:
+            packed.duplicates += 1
+            continue
+        kept.append((doc, score, body, footer.group() if footer else ''))
+
+    texts = [body + footer for _, _, body, footer in kept]
+    counts = count_context_tokens(texts)
+
+    # Boilerplate goes first: footers repeating the chat of a more relevant document, then all of them
+    for repeated_only in (True, False):
+        if _total(counts) <= max_tokens:
+            break
+        chats = set()
+        for i, (_, _, body, footer) in enumerate(kept):
+            if not footer or texts[i] == body or (repeated_only and footer not in chats):
+                chats.add(footer)
+                continue
+            texts[i] = body
+            counts[i] = count_context_tokens([body])[0]
+
+    while len(texts) > 1 and _total(counts) > max_tokens:
+        texts.pop()
+        counts.pop()
+        kept.pop()
+        packed.over_budget += 1
+
+    # Dropping documents may have made room for some footers again
+    for i, (_, _, body, footer) in enumerate(kept):
+        if packed.over_budget and footer and texts[i] == body:
+            count = count_context_tokens([body + footer])[0]
+            if _total(counts) - counts[i] + count <= max_tokens:
+                texts[i], counts[i] = body + footer, count
+
+    if texts and counts[0] > max_tokens:
+        texts[0] = get_encoding().decode(get_encoding().encode_ordinary(texts[0])[:max_tokens])
+        counts[0] = max_tokens
+
+    packed.footers_cut = sum(1 for (_, _, _, footer), text in zip(kept, texts) if footer and not text.endswith(footer))
+    packed.documents = [
+        Document(page_content=text, metadata={**doc.metadata, 'score': score})
+        for (doc, score, _, _), text in zip(kept, texts)
+    ]
+    packed.tokens = _total(counts)
+    return packed
@@ -0,0 +1,93 @@
+"""Conversation memory of the knowledge base chat.
+
+A conversation is the packed knowledge base context of the first question,
+a summary of the older turns and the recent turns. It is kept in the FSM
+data of the user (Redis in production, see bot.py) and sent with every
+follow-up, so a follow-up is a single chat completion.
+
+When summary and turns grow over HISTORY_MAX_TOKENS the older turns are
+folded into the summary by the LLM, the last KEEP_TURNS stay verbatim. If
+summarizing fails, or the kept turns alone are over the budget, the oldest
+turns are dropped.
+"""
+
+import os
+import logging
+from dataclasses import dataclass, field
+
+from chunking import count_tokens
+from metrics import measure
+from tracing import langchain_config
+
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', 1500))
+KEEP_TURNS = 4
+SUMMARY_MAX_WORDS = 150
+
+SUMMARY_PROMPT = '''Summarize the conversation of a user with the assistant of their notes and chats below. \
+Keep the names, dates, facts and open questions the conversation relies on, at most {max_words} words, \
+in the language of the conversation.
+
+{summary}{turns}'''
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Conversation:
+    context: str = ''
+    summary: str = ''
+    # (role, text), role is 'human' or 'ai'
+    turns: list[tuple[str, str]] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {'context': self.context, 'summary': self.summary, 'turns': [list(turn) for turn in self.turns]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Conversation':
+        return cls(data.get('context', ''), data.get('summary', ''), [tuple(turn) for turn in data.get('turns', [])])
+
+    def add(self, question: str, answer: str):
+        self.turns += [('human', question), ('ai', answer)]
+
+    @property
+    def history_tokens(self) -> int:
+        return count_tokens(self.summary) + sum(count_tokens(text) for _, text in self.turns)
+
+    def messages(self, system_prompt: str, question: str) -> list:
+        """Chat messages for a follow-up question."""
+
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        system = f'{system_prompt}\n{self.context}'
+        if self.summary:
+            system += f'\n\nSummary of the earlier conversation:\n{self.summary}'
+        messages = [SystemMessage(system)]
+        for role, text in self.turns:
+            messages.append(HumanMessage(text) if role == 'human' else AIMessage(text))
+        messages.append(HumanMessage(question))
+        return messages
+
+    async def compact(self, llm, max_tokens: int = HISTORY_MAX_TOKENS) -> bool:
+        """Fold the older turns into the summary once the history is over `max_tokens`, True if it changed.
+
+        It costs a chat completion, so it runs after the answer has been sent.
+        """
+
+        if self.history_tokens <= max_tokens:
+            return False
+
+        older, self.turns = self.turns[:-KEEP_TURNS], self.turns[-KEEP_TURNS:]
+        if older:
+            summary = f'Summary so far:\n{self.summary}\n\n' if self.summary else ''
+            turns = '\n'.join(f"{'User' if role == 'human' else 'Assistant'}: {text}" for role, text in older)
+            prompt = SUMMARY_PROMPT.format(max_words=SUMMARY_MAX_WORDS, summary=summary, turns=turns)
+            try:
+                with measure('chat.summarize'):
+                    response = await llm.ainvoke(prompt, config=langchain_config())
+                self.summary = response.content
+            except Exception:
+                logger.exception(f'Failed to summarize {len(older)} messages, dropping them')
+
+        while len(self.turns) > 2 and self.history_tokens > max_tokens:
+            self.turns = self.turns[2:]
+        return True
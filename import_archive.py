@@ -0,0 +1,260 @@
+import os
+import re
+import hashlib
+import datetime
+
+import orjson
+import numpy as np
+import polars as pl
+
+ARCHIVE_DIR = os.getenv('IMPORT_ARCHIVE_DIR', 'import_archive')
+
+# Column types of an archived chat, the parser produces them loosely typed
+CHAT_SCHEMA = {
+    'chat_id': pl.Int64,
+    'msg_id': pl.Int64,
+    'sender': pl.Utf8,
+    'sender_id': pl.Utf8,
+    'reply_to_msg_id': pl.Int64,
+    'date': pl.Datetime('us'),
+    'date_unixtime': pl.Int64,
+    'msg_type': pl.Utf8,
+    'msg_content': pl.Utf8,
+    'forwarded_from': pl.Utf8,
+    'action': pl.Utf8,
+    'has_mention': pl.Boolean,
+    'has_email': pl.Boolean,
+    'has_phone': pl.Boolean,
+    'has_hashtag': pl.Boolean,
+    'is_bot_command': pl.Boolean,
+}
+
+
+def typed_chat_frame(df: pl.DataFrame) -> pl.DataFrame:
+    """Cast a parsed chat to CHAT_SCHEMA, values that don't fit (e.g. empty strings) become null."""
+
+    columns = []
+    for name, dtype in CHAT_SCHEMA.items():
+        if name not in df.columns:
+            columns.append(pl.lit(None, dtype=dtype).alias(name))
+        elif name == 'date' and df.schema[name] == pl.Utf8:
+            columns.append(pl.col(name).str.to_datetime('%Y-%m-%dT%H:%M:%S', time_unit='us', strict=False))
+        elif dtype == pl.Boolean:
+            columns.append(pl.col(name).cast(pl.Int8, strict=False).cast(pl.Boolean))
+        else:
+            columns.append(pl.col(name).cast(dtype, strict=False))
+
+    return df.select(columns)
+
+
+class ImportArchive:
+    """Per-user archive of imported chats: one zstd Parquet snapshot per chat plus a JSON manifest."""
+
+    def __init__(self, telegram_id: int, root: str = ARCHIVE_DIR):
+        self.path = os.path.join(root, f'user_{telegram_id}')
+        self.manifest_path = os.path.join(self.path, 'manifest.json')
+
+    def load_manifest(self) -> list[dict]:
+        if not os.path.exists(self.manifest_path):
+            return []
+        with open(self.manifest_path, 'rb') as f:
+            return orjson.loads(f.read())
+
+    def _save_manifest(self, manifest: list[dict]):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, self.manifest_path)
+
+    def add_chat(self, df: pl.DataFrame, chat_name: str) -> dict:
+        """Merge a parsed chat into its archived snapshot, re-exported messages replace the archived ones."""
+
+        os.makedirs(self.path, exist_ok=True)
+
+        typed = typed_chat_frame(df)
+        manifest = self.load_manifest()
+        previous = [e for e in manifest if e['chat_name'] == chat_name]
+        if previous:
+            # Archives written before snapshots were merged can hold several files of a chat
+            archived = pl.concat([pl.read_parquet(os.path.join(self.path, e['file'])) for e in previous])
+            typed = (
+                pl.concat([archived, typed])
+                .unique(subset='msg_id', keep='last', maintain_order=True)
+                .sort('msg_id', nulls_last=True)
+            )
+
+        imported_at = datetime.datetime.now()
+        slug = re.sub(r'[^\w-]+', '_', chat_name)[:64]
+        file_name = f"chat_{slug}_{imported_at.strftime('%Y-%m-%d_%H-%M-%S')}.parquet"
+        tmp_path = os.path.join(self.path, file_name + '.tmp')
+        typed.write_parquet(tmp_path, compression='zstd', statistics=True)
+        os.replace(tmp_path, os.path.join(self.path, file_name))
+
+        date_from, date_to = typed['date'].min(), typed['date'].max()
+        entry = {
+            'file': file_name,
+            'chat_name': chat_name,
+            'rows': typed.height,
+            'date_from': date_from.isoformat() if date_from else None,
+            'date_to': date_to.isoformat() if date_to else None,
+            'imported_at': imported_at.isoformat(),
+        }
+        self._save_manifest([e for e in manifest if e['chat_name'] != chat_name] + [entry])
+
+        for old in previous:
+            # A re-import within the same second reuses the file name
+            if old['file'] != file_name:
+                os.remove(os.path.join(self.path, old['file']))
+
+        return entry
+
+    def entries(self, chat_name: str | None = None, latest: bool = True) -> list[dict]:
+        """Manifest entries, by default only the newest import of every chat."""
+
+        entries = [e for e in self.load_manifest() if chat_name is None or e['chat_name'] == chat_name]
+        if latest:
+            newest = {}
+            for entry in entries:
+                newest[entry['chat_name']] = entry
+            entries = list(newest.values())
+        return entries
+
+    def scan(self, chat_name: str | None = None, latest: bool = True) -> pl.LazyFrame | None:
+        """Lazy frame over archived chats with a chat_name column, None if nothing is archived."""
+
+        frames = [
+            pl.scan_parquet(os.path.join(self.path, entry['file'])).with_columns(pl.lit(entry['chat_name']).alias('chat_name'))
+            for entry in self.entries(chat_name, latest)
+        ]
+        if not frames:
+            return None
+        return pl.concat(frames, how='vertical')
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def chat_key(df: pl.DataFrame, chat_name: str) -> str:
+    """Key of a chat in its vector ids: the chat id, a hash of the name for exports without one."""
+
+    chat_ids = df['chat_id'].drop_nulls() if 'chat_id' in df.columns else []
+    return str(chat_ids[0]) if len(chat_ids) else hashlib.md5(chat_name.encode()).hexdigest()[:12]
+
+
+def message_fingerprints(df: pl.DataFrame, chat_name: str) -> tuple[np.ndarray, np.ndarray]:
+    """(chat id, msg_id) keys and content hashes of parsed messages as uint64 arrays."""
+
+    chat_ids = df['chat_id'].to_list() if 'chat_id' in df.columns else [None] * df.height
+    keys = np.fromiter(
+        (_hash64(f'{chat_id if chat_id is not None else chat_name}:{msg_id}') for chat_id, msg_id in zip(chat_ids, df['msg_id'].to_list())),
+        dtype=np.uint64, count=df.height
+    )
+    hashes = np.fromiter(
+        (_hash64(content or '') for content in df['msg_content'].to_list()),
+        dtype=np.uint64, count=df.height
+    )
+    return keys, hashes
+
+
+class SeenIndex:
+    """Fingerprints of the messages a user already embedded, kept as sorted uint64 arrays on disk.
+
+    16 bytes per message, so even a few million messages take a few dozen megabytes.
+    """
+
+    def __init__(self, telegram_id: int, root: str = ARCHIVE_DIR):
+        self.path = os.path.join(root, f'user_{telegram_id}', 'seen.npz')
+        if os.path.exists(self.path):
+            with np.load(self.path) as data:
+                self.keys, self.hashes = data['keys'], data['hashes']
+        else:
+            self.keys = np.empty(0, dtype=np.uint64)
+            self.hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def classify(self, keys: np.ndarray, hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Boolean masks of new and edited messages."""
+
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+
+        edited = np.zeros(len(keys), dtype=bool)
+        edited[found] = self.hashes[positions[found]] != hashes[found]
+        return ~found, edited
+
+    def add(self, keys: np.ndarray, hashes: np.ndarray):
+
+        keys = np.concatenate([self.keys, keys])
+        hashes = np.concatenate([self.hashes, hashes])
+        # Stable sort keeps the newest hash last among equal keys
+        order = np.argsort(keys, kind='stable')
+        keys, hashes = keys[order], hashes[order]
+        last = np.append(keys[1:] != keys[:-1], True)
+        self.keys, self.hashes = keys[last], hashes[last]
+
+    def remove(self, keys: np.ndarray | None = None):
+        """Forget some messages, all of them by default, so that they are embedded again."""
+
+        if keys is None:
+            keep = np.zeros(len(self.keys), dtype=bool)
+        else:
+            keep = ~np.isin(self.keys, keys)
+        self.keys, self.hashes = self.keys[keep], self.hashes[keep]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, keys=self.keys, hashes=self.hashes)
+        os.replace(tmp_path, self.path)
+
+
+def window_fingerprint(text: str, msg_ids: list[str]) -> int:
+    """Content hash of an embedded conversation window chunk."""
+    return _hash64(f"{','.join(msg_ids)}\n{text}")
+
+
+class WindowIndex:
+    """Vector ids and content hashes of the embedded conversation windows of a user's chats.
+
+    Windows depend on neighbouring messages, so a re-import windows the whole
+    archived chat again and embeds only the windows whose hash changed.
+    """
+
+    SCHEMA = {'chat_key': pl.Utf8, 'id': pl.Utf8, 'hash': pl.UInt64}
+
+    def __init__(self, telegram_id: int, root: str = ARCHIVE_DIR):
+        self.path = os.path.join(root, f'user_{telegram_id}', 'windows.parquet')
+        if os.path.exists(self.path):
+            self.frame = pl.read_parquet(self.path)
+        else:
+            self.frame = pl.DataFrame(schema=self.SCHEMA)
+
+    def stored(self, chat_key: str) -> dict[str, int] | None:
+        """Hash of every stored vector id of a chat, None if the chat was never indexed."""
+
+        rows = self.frame.filter(pl.col('chat_key') == chat_key)
+        if not rows.height:
+            return None
+        return dict(zip(rows['id'].to_list(), rows['hash'].to_list()))
+
+    def replace(self, chat_key: str, ids: list[str], hashes: list[int]):
+        chat = pl.DataFrame({'chat_key': [chat_key] * len(ids), 'id': ids, 'hash': hashes}, schema=self.SCHEMA)
+        self.frame = pl.concat([self.frame.filter(pl.col('chat_key') != chat_key), chat])
+
+    def remove(self, chat_keys: set[str] | None = None):
+        """Forget some chats, all of them by default."""
+
+        if chat_keys is None:
+            self.frame = self.frame.clear()
+        else:
+            self.frame = self.frame.filter(~pl.col('chat_key').is_in(list(chat_keys)))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        self.frame.write_parquet(tmp_path)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,225 @@
+"""Inline mode search: `@bot query` from any chat.
+
+Telegram sends an inline query on every keystroke and drops answers that come
+too late, so a query is not simply searched:
+- it is answered from the cache right away when the user searched the same
+  normalized text (case, spaces and punctuation ignored) recently,
+- otherwise it waits INLINE_DEBOUNCE, a query superseded by a newer one of
+  the same user meanwhile is neither searched nor answered,
+- at most INLINE_MAX_SEARCHES searches of a user run at once in a worker,
+  a query superseded while waiting for its turn is dropped,
+- a search not done INLINE_DEADLINE after the query arrived is answered with
+  the cached results of the longest prefix of the query, what the user saw
+  while typing it. The search keeps running and fills the cache.
+
+Redis, shared by the webhook workers:
+- inline_search:{user}:latest   id of the last inline query of the user
+- inline_search:{user}:results  normalized query -> found documents, deleted
+                                by invalidate() when the knowledge base changes
+
+Without Redis the latest queries are kept in the process and nothing is cached.
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+import orjson
+from langchain_core.documents import Document
+from redis.exceptions import RedisError
+
+from metrics import INLINE_QUERIES
+
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', 0.4))
+INLINE_DEADLINE = float(os.getenv('INLINE_DEADLINE', 4.0))
+INLINE_MAX_SEARCHES = 1
+INLINE_RESULTS = 10
+# Shorter queries are not searched, their prefixes are not looked up
+INLINE_MIN_CHARS = 3
+INLINE_CACHE_TTL = 10 * 60
+INLINE_CACHE_MAX_ENTRIES = 200
+LATEST_TTL = 60
+
+WORD_PATTERN = re.compile(r'\w+')
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(WORD_PATTERN.findall(query.casefold()))
+
+
+def _keys(user_id: int) -> tuple[str, str]:
+    prefix = f'inline_search:{user_id}'
+    return f'{prefix}:latest', f'{prefix}:results'
+
+
+def _dump(documents: list[Document]) -> bytes:
+    return orjson.dumps([{'page_content': doc.page_content, 'metadata': doc.metadata} for doc in documents], default=str)
+
+
+def _load(value: bytes) -> list[Document]:
+    return [Document(**doc) for doc in orjson.loads(value)]
+
+
+class InlineSearch:
+
+    def __init__(self, redis=None, max_searches: int = INLINE_MAX_SEARCHES):
+        # redis.asyncio.Redis, None keeps the latest queries in the process and disables the cache
+        self.redis = redis
+        self.max_searches = max_searches
+        # Latest query of every user, without Redis
+        self.latest: dict[int, str] = {}
+        self.semaphores: dict[int, asyncio.Semaphore] = {}
+        # Queries of a user waiting for or holding a search slot, the semaphore goes with the last one
+        self.pending: dict[int, int] = {}
+        # Searches answered with a fallback, still filling the cache
+        self.tasks: set[asyncio.Task] = set()
+
+    async def start(self, user_id: int, query_id: str, query: str) -> tuple[list[Document] | None, list[Document] | None]:
+        """Mark the query as the latest of the user, its cached results and those of its longest cached prefix."""
+
+        if self.redis is None:
+            self.latest[user_id] = query_id
+            return None, None
+
+        latest_key, results_key = _keys(user_id)
+        prefixes = [query[:end] for end in range(len(query), INLINE_MIN_CHARS - 1, -1)]
+        try:
+            _, cached = await (
+                self.redis.pipeline(transaction=False)
+                .set(latest_key, query_id, ex=LATEST_TTL)
+                .hmget(results_key, prefixes)
+                .execute()
+            )
+        except RedisError:
+            logger.exception(f'Inline search cache lookup failed for user {user_id}')
+            return None, None
+
+        if cached[0] is not None:
+            INLINE_QUERIES.inc(result='cached')
+            return _load(cached[0]), None
+        fallback = next((value for value in cached if value is not None), None)
+        return None, _load(fallback) if fallback is not None else None
+
+    async def is_latest(self, user_id: int, query_id: str) -> bool:
+
+        if self.redis is None:
+            return self.latest.get(user_id) == query_id
+
+        latest_key, _ = _keys(user_id)
+        try:
+            latest = await self.redis.get(latest_key)
+        except RedisError:
+            logger.exception(f'Failed to read the latest inline query of user {user_id}')
+            return True
+        return latest is None or latest.decode() == query_id
+
+    async def settled(self, user_id: int, query_id: str) -> bool:
+        """Wait INLINE_DEBOUNCE, False if the user typed on meanwhile."""
+
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if await self.is_latest(user_id, query_id):
+            return True
+        INLINE_QUERIES.inc(result='superseded')
+        return False
+
+    async def search(
+        self,
+        user_id: int,
+        query_id: str,
+        query: str,
+        run: Callable[[], Awaitable[list[Document]]],
+        deadline: float,
+        fallback: list[Document] | None = None,
+    ) -> tuple[list[Document], bool] | None:
+        """Documents found by `run` and True, or the fallback and False once `deadline` (monotonic) passed.
+
+        None if the query was superseded while waiting for a search slot.
+        """
+
+        semaphore = self.semaphores.setdefault(user_id, asyncio.Semaphore(self.max_searches))
+        self.pending[user_id] = self.pending.get(user_id, 0) + 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            self._leave(user_id)
+            return self._fallback(fallback)
+
+        if not await self.is_latest(user_id, query_id):
+            semaphore.release()
+            self._leave(user_id)
+            INLINE_QUERIES.inc(result='superseded')
+            return None
+
+        task = asyncio.create_task(self._run(user_id, query, run, semaphore))
+        done, _ = await asyncio.wait({task}, timeout=max(deadline - time.monotonic(), 0))
+        if not done:
+            self.tasks.add(task)
+            task.add_done_callback(self._finished)
+            return self._fallback(fallback)
+
+        INLINE_QUERIES.inc(result='searched')
+        return task.result(), True
+
+    async def _run(self, user_id: int, query: str, run: Callable[[], Awaitable[list[Document]]], semaphore: asyncio.Semaphore) -> list[Document]:
+        try:
+            documents = await run()
+        finally:
+            semaphore.release()
+            self._leave(user_id)
+        await self.store(user_id, query, documents)
+        return documents
+
+    def _finished(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Inline search failed after its deadline', exc_info=task.exception())
+
+    def _leave(self, user_id: int):
+        self.pending[user_id] -= 1
+        if not self.pending[user_id]:
+            del self.pending[user_id], self.semaphores[user_id]
+
+    def _fallback(self, fallback: list[Document] | None) -> tuple[list[Document], bool]:
+        INLINE_QUERIES.inc(result='timeout' if fallback is None else 'prefix')
+        return fallback or [], False
+
+    async def store(self, user_id: int, query: str, documents: list[Document]):
+
+        if self.redis is None:
+            return
+
+        _, results_key = _keys(user_id)
+        try:
+            _, _, entries = await (
+                self.redis.pipeline(transaction=False)
+                .hset(results_key, query, _dump(documents))
+                .expire(results_key, INLINE_CACHE_TTL)
+                .hlen(results_key)
+                .execute()
+            )
+            if entries > INLINE_CACHE_MAX_ENTRIES:
+                # Keystrokes of a long session, starting over is cheaper than tracking their use
+                await self.redis.delete(results_key)
+        except RedisError:
+            logger.exception(f'Failed to cache inline search results of user {user_id}')
+
+    async def invalidate(self, user_id: int):
+        """Drop the cached results of a user, their knowledge base changed."""
+
+        if self.redis is None:
+            return
+
+        _, results_key = _keys(user_id)
+        try:
+            await self.redis.delete(results_key)
+        except RedisError:
+            logger.exception(f'Failed to invalidate the inline search cache of user {user_id}')
+
+
+# Connected to the bot's Redis in bot.py
+INLINE_SEARCH = InlineSearch()
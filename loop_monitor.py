@@ -0,0 +1,135 @@
+"""Event loop lag watchdog.
+
+A task on the loop wakes up every LOOP_LAG_INTERVAL_MS and records how late
+it woke up in saved_ai_loop_lag_seconds. Lag means that something ran on the
+loop thread without yielding: a Polars parse, TF-IDF, wordcloud rendering, a
+sync client. A watchdog thread checks the task's heartbeat; once the loop
+has been stuck for LOOP_LAG_THRESHOLD_MS it captures the stack of the loop
+thread. When the loop is back the stall is logged with its duration, the
+stack, and the handler and user of the blocking update, and counted in
+saved_ai_loop_stalls_total by the blocking code site (see blocking_site).
+The load test prints these counts per run.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+
+from metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+from tracing import current_span
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL_MS', 100)) / 1000
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD_MS', 250)) / 1000
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+STACK_LIMIT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def blocking_site(frame) -> str:
+    """`file:function` of the innermost frame of this project in the running callback.
+
+    Falls back to the frame the callback started in, e.g. the coroutine of a
+    task LangChain created, when the callback has no frame of this project.
+    """
+
+    entry = None
+    while frame is not None:
+        code = frame.f_code
+        # Handle._run calls the callback, frames above it are the loop
+        if code.co_name == '_run' and code.co_filename.endswith(os.path.join('asyncio', 'events.py')):
+            break
+        entry = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+        if code.co_filename.startswith(PROJECT_DIR) and code.co_filename != __file__ and 'site-packages' not in code.co_filename:
+            return entry
+        frame = frame.f_back
+    return entry or 'unknown'
+
+
+class LoopMonitor:
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        # (site, stack, handler, user) of the stall in progress, set by the watchdog
+        self.captured: tuple[str, str, str | None, int | None] | None = None
+        self.max_lag = 0.0
+        self.stalls: Counter[str] = Counter()
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread_id: int | None = None
+        self.task: asyncio.Task | None = None
+        self.watchdog: threading.Thread | None = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self._tick())
+        self.watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _tick(self):
+
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+
+            lag = max(0.0, now - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self._report(lag)
+
+    def _report(self, lag: float):
+
+        captured, self.captured = self.captured, None
+        if captured is None:
+            # Blocked for less than a watchdog period after crossing the threshold
+            site, stack, handler, user = 'unknown', '', None, None
+        else:
+            site, stack, handler, user = captured
+        self.stalls[site] += 1
+        LOOP_STALLS.inc(site=site)
+        logger.warning(f'Event loop blocked for {lag * 1000:.0f} ms at {site} (handler {handler}, user {user})\n{stack}')
+
+    def _watch(self):
+        """Watchdog thread: captures the loop thread's stack once per stall."""
+
+        while not self.stopped.wait(self.threshold / 2):
+            if self.captured is not None or time.monotonic() - self.heartbeat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+
+            handler = user = None
+            task = asyncio.current_task(self.loop)
+            span = task.get_context().get(current_span) if task is not None else None
+            if span is not None:
+                handler = span.trace.spans[0].attributes.get('handler')
+                user = span.trace.user_id
+
+            stack = ''.join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            self.captured = (blocking_site(frame), stack, handler, user)
+
+    def stats(self) -> dict:
+        return {'max_lag': self.max_lag, 'stalls': dict(self.stalls.most_common())}
+
+
+LOOP_MONITOR = LoopMonitor()
@@ -0,0 +1,445 @@
+"""In-process metrics of the bot, served in the Prometheus text format.
+
+- saved_ai_handler_seconds: time in each update handler
+- saved_ai_dependency_seconds: calls to Telegram, OpenAI, Pinecone, the database and Redis
+- saved_ai_operation_seconds: backend operations and import stages
+- saved_ai_openai_tokens_total / saved_ai_openai_cost_usd_total, per-user token use is logged
+- saved_ai_queue_depth and saved_ai_queue_wait_seconds: the per-chat update queues
+- saved_ai_loop_lag_seconds and saved_ai_loop_stalls_total: event loop blocking (see loop_monitor.py)
+- saved_ai_context_tokens_total: tokens retrieved and packed into the RAG prompt
+- saved_ai_answer_cache_lookups_total and saved_ai_answer_cache_evictions_total: the answer cache, its hit rate is hit / (hit + miss + stale)
+- saved_ai_inline_queries_total: inline queries by how they were answered (see inline_search.py)
+
+Recording a sample is a dict lookup, a bisect and a few additions, so the
+metrics stay on in production. The endpoint listens on METRICS_HOST:METRICS_PORT
+(/metrics), METRICS_PORT=0 disables it.
+"""
+
+import os
+import time
+import bisect
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterable
+
+import httpx
+import orjson
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from tracing import annotate, span, start_span
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+# Prometheus text exposition format
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# USD per million prompt and completion tokens, matched by model name prefix
+OPENAI_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'text-embedding-3-small': (0.02, 0.0),
+    'text-embedding-3-large': (0.13, 0.0),
+}
+
+# Telegram user the current update is handled for, OpenAI usage is attributed to them
+current_user: contextvars.ContextVar[int | None] = contextvars.ContextVar('current_user', default=None)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Iterable[str], values: Iterable[Any], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), registry: 'Registry | None' = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.values.items():
+            yield f'{self.name}{_labels(self.label_names, key)} {_number(value)}'
+
+
+class Gauge(Metric):
+    """Gauge set directly or read from callbacks at scrape time."""
+
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple, float] = {}
+        self.functions: dict[tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        self.functions[self._key(labels)] = fn
+
+    def samples(self) -> Iterable[str]:
+        values = dict(self.values)
+        for key, fn in self.functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                logger.exception(f'Failed to read gauge {self.name}')
+        for key, value in values.items():
+            yield f'{self.name}{_labels(self.label_names, key)} {_number(value)}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterable[str]:
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                yield f'{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.label_names, key)} {_number(state[-2])}'
+            yield f'{self.name}_count{_labels(self.label_names, key)} {state[-1]}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = Histogram('saved_ai_handler_seconds', 'Time spent in update handlers.', ['handler'])
+HANDLER_ERRORS = Counter('saved_ai_handler_errors_total', 'Exceptions raised by update handlers.', ['handler', 'error'])
+DEPENDENCY_SECONDS = Histogram('saved_ai_dependency_seconds', 'Latency of calls to external services.', ['dependency', 'operation'])
+DEPENDENCY_ERRORS = Counter('saved_ai_dependency_errors_total', 'Failed calls to external services.', ['dependency', 'operation'])
+OPERATION_SECONDS = Histogram('saved_ai_operation_seconds', 'Latency of backend operations and import stages.', ['operation'])
+OPENAI_TOKENS = Counter('saved_ai_openai_tokens_total', 'OpenAI tokens by model and kind (prompt or completion).', ['model', 'kind'])
+OPENAI_COST = Counter('saved_ai_openai_cost_usd_total', 'Estimated OpenAI spend in USD.', ['model'])
+QUEUE_DEPTH = Gauge('saved_ai_queue_depth', 'Items waiting or running per queue.', ['queue'])
+QUEUE_WAIT_SECONDS = Histogram('saved_ai_queue_wait_seconds', 'Time updates wait before their handler starts.')
+LOOP_LAG_SECONDS = Histogram('saved_ai_loop_lag_seconds', 'Delay of event loop wake-ups.', buckets=LAG_BUCKETS)
+LOOP_STALLS = Counter('saved_ai_loop_stalls_total', 'Event loop stalls over the threshold by blocking code site.', ['site'])
+CONTEXT_TOKENS = Counter('saved_ai_context_tokens_total', 'Tokens of retrieved documents and of the packed RAG context.', ['stage'])
+ANSWER_CACHE_LOOKUPS = Counter('saved_ai_answer_cache_lookups_total', 'Semantic answer cache lookups by result (hit, miss, stale).', ['result'])
+ANSWER_CACHE_EVICTIONS = Counter('saved_ai_answer_cache_evictions_total', 'Answers evicted over the per-user cap of the answer cache.')
+INLINE_QUERIES = Counter('saved_ai_inline_queries_total', 'Inline queries by result (cached, superseded, searched, prefix, timeout).', ['result'])
+
+
+@contextmanager
+def track(dependency: str, operation: str):
+    """Time a call to an external service, also counting failures. Traced as a span."""
+
+    started = time.perf_counter()
+    try:
+        with span(f'{dependency}.{operation}'):
+            yield
+    except Exception:
+        DEPENDENCY_ERRORS.inc(dependency=dependency, operation=operation)
+        raise
+    finally:
+        DEPENDENCY_SECONDS.observe(time.perf_counter() - started, dependency=dependency, operation=operation)
+
+
+@contextmanager
+def measure(operation: str):
+    """Time a backend operation or an import stage. Traced as a span."""
+
+    with OPERATION_SECONDS.time(operation=operation), span(operation):
+        yield
+
+
+def timed(operation: str):
+    """Decorator timing an async function as an operation."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with measure(operation):
+                return await fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def record_openai_usage(model: str | None, usage: dict | None):
+
+    if not model or not usage:
+        return
+    prompt = usage.get('prompt_tokens') or usage.get('input_tokens') or 0
+    completion = usage.get('completion_tokens') or usage.get('output_tokens') or 0
+
+    OPENAI_TOKENS.inc(prompt, model=model, kind='prompt')
+    if completion:
+        OPENAI_TOKENS.inc(completion, model=model, kind='completion')
+    # A series per user would grow with the user base, their use goes to the log
+    user = current_user.get()
+    if user is not None:
+        logger.info(f'OpenAI usage of user {user}: {prompt} prompt and {completion} completion tokens of {model}')
+
+    for prefix, (prompt_price, completion_price) in sorted(OPENAI_PRICES.items(), key=lambda item: -len(item[0])):
+        if model.startswith(prefix):
+            OPENAI_COST.inc((prompt * prompt_price + completion * completion_price) / 1_000_000, model=model)
+            break
+
+
+def openai_operation(path: str) -> str:
+    """Stable operation name of an OpenAI API path, ids stripped."""
+
+    parts = [part for part in path.split('/') if part and part != 'v1']
+    return '/'.join(part if not any(c.isdigit() for c in part) or part.startswith('v') and len(part) <= 3 else '{id}' for part in parts)
+
+
+class _UsageSniffingStream(httpx.AsyncByteStream):
+    """Passes a streamed (SSE) response through and records its usage chunk and duration at the end."""
+
+    TAIL_BYTES = 8192
+
+    def __init__(self, stream: httpx.AsyncByteStream, operation: str, started: float, trace_span=None):
+        self.stream = stream
+        self.operation = operation
+        self.started = started
+        self.trace_span = trace_span
+        self.tail = b''
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.tail = (self.tail + chunk)[-self.TAIL_BYTES:]
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+        DEPENDENCY_SECONDS.observe(time.perf_counter() - self.started, dependency='openai', operation=self.operation)
+        if self.trace_span is not None:
+            self.trace_span.finish()
+        for line in reversed(self.tail.split(b'\n')):
+            if line.startswith(b'data: {') and b'"usage"' in line:
+                try:
+                    data = orjson.loads(line[len(b'data: '):])
+                except orjson.JSONDecodeError:
+                    break
+                record_openai_usage(data.get('model'), data.get('usage'))
+                break
+
+
+class OpenAIMetricsTransport(httpx.AsyncBaseTransport):
+    """httpx transport of the OpenAI clients timing every call and counting the tokens it used."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+
+        operation = openai_operation(request.url.path)
+        # Finished when the body is read, that is after the stream ends for SSE responses
+        trace_span = start_span(f'openai.{operation}')
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            DEPENDENCY_ERRORS.inc(dependency='openai', operation=operation)
+            DEPENDENCY_SECONDS.observe(time.perf_counter() - started, dependency='openai', operation=operation)
+            if trace_span is not None:
+                trace_span.finish(e)
+            raise
+
+        if response.status_code >= 400:
+            DEPENDENCY_ERRORS.inc(dependency='openai', operation=operation)
+
+        content_type = response.headers.get('content-type', '')
+        if content_type.startswith('text/event-stream'):
+            response.stream = _UsageSniffingStream(response.stream, operation, started, trace_span)
+            return response
+
+        raw = b''.join([chunk async for chunk in response.stream])
+        await response.stream.aclose()
+        DEPENDENCY_SECONDS.observe(time.perf_counter() - started, dependency='openai', operation=operation)
+        if trace_span is not None:
+            trace_span.attributes['status'] = response.status_code
+            trace_span.finish()
+
+        response = httpx.Response(
+            response.status_code, headers=response.headers, content=raw,
+            request=request, extensions=response.extensions,
+        )
+        if content_type.startswith('application/json') and response.status_code < 400:
+            try:
+                data = orjson.loads(response.read())
+            except orjson.JSONDecodeError:
+                data = None
+            if isinstance(data, dict):
+                record_openai_usage(data.get('model'), data.get('usage'))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def openai_http_client() -> httpx.AsyncClient:
+    """Async httpx client for the OpenAI SDK with the SDK's defaults and the metrics transport."""
+
+    import openai
+    return openai.DefaultAsyncHttpxClient(transport=OpenAIMetricsTransport())
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware timing every handler by its function name.
+
+    It also sets `current_user` for the handler, so tokens spent while
+    handling the update are attributed to its sender.
+    """
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event: Any, data: dict) -> Any:
+
+        callback = getattr(data.get('handler'), 'callback', None)
+        name = getattr(callback, '__name__', 'unknown')
+        user = getattr(event, 'from_user', None)
+        token = current_user.set(user.id if user else None)
+        annotate(handler=name)
+        started = time.perf_counter()
+        try:
+            with span(f'handler.{name}'):
+                return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+            current_user.reset(token)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing every Bot API method."""
+
+    async def __call__(self, make_request, bot, method):
+        with track('telegram', method.__api_method__):
+            return await make_request(bot, method)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(TelegramMetricsMiddleware())
+
+
+def instrument_redis(redis):
+    """Time every command of an asyncio Redis client (FSM storage, locks, dedup)."""
+
+    execute_command = redis.execute_command
+
+    async def timed_execute_command(*args, **options):
+        with track('redis', str(args[0]).lower() if args else 'unknown'):
+            return await execute_command(*args, **options)
+
+    redis.execute_command = timed_execute_command
+
+
+DB_METHODS = ('execute_query', 'execute_query_dict', 'execute_insert', 'execute_many', 'execute_script')
+
+
+def instrument_db(connection):
+    """Time the queries of a Tortoise connection, labelled with its dialect (sqlite, postgres)."""
+
+    dialect = getattr(getattr(connection, 'capabilities', None), 'dialect', 'db')
+    for method_name in DB_METHODS:
+        method = getattr(connection, method_name, None)
+        if method is None:
+            continue
+
+        def wrap(method, operation):
+            async def timed_method(*args, **kwargs):
+                with track(dialect, operation):
+                    return await method(*args, **kwargs)
+            return timed_method
+
+        setattr(connection, method_name, wrap(method, method_name.removeprefix('execute_')))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode('utf-8'), headers={'Content-Type': EXPOSITION_CONTENT_TYPE})
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> web.AppRunner | None:
+
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f'Metrics on http://{host}:{port}/metrics')
+    return runner
@@ -18,6 +18,7 @@ class TelegramChatParser:
             Maximum number of messages to retain, by default 50000
         """
         self.columns = [
+            "chat_id",
             "msg_id",
             "sender",
             "sender_id",
@@ -70,7 +71,7 @@ class TelegramChatParser:
         """
         print(f"DEBUG | {TelegramChatParser.timestamp()} | {msg}")
 
-    def process_message(self, message: Dict, chat_name: str) -> Dict:
+    def process_message(self, message: Dict, chat_name: str, chat_id: int = None) -> Dict:
         """Parse a single message from the chat.
 
         Parameters
@@ -79,6 +80,8 @@ class TelegramChatParser:
             A message object from the chat JSON.
         chat_name : str
             The name of the chat the message belongs to.
+        chat_id : int, optional
+            The id of the chat the message belongs to, by default None
 
         Returns
         -------
@@ -153,6 +156,7 @@ class TelegramChatParser:
         msg_content = str(msg_content).replace("\n", " ")
 
         parsed_row = {
+            "chat_id": chat_id,
             "msg_id": msg_id,
             "sender": sender,
             "sender_id": sender_id,
@@ -188,10 +192,11 @@ class TelegramChatParser:
         None
         """
         chat_name = chat_data.get("name", "Unknown Chat")
+        chat_id = chat_data.get("id")
         messages = chat_data.get("messages", [])
 
         for message in messages:
-            parsed_row = self.process_message(message, chat_name)
+            parsed_row = self.process_message(message, chat_name, chat_id)
             if parsed_row:
                 chats_deque.append(parsed_row)
 
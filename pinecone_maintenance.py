@@ -0,0 +1,506 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import polars as pl
+from dotenv import load_dotenv
+from pinecone import Pinecone
+from backend import INDEX_NAMES, note_unix
+
+load_dotenv()
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+
+FETCH_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+# 1536 dimensions and a window text per vector, well under the 2 MB limit of an upsert request
+UPSERT_BATCH_SIZE = 50
+
+NAMESPACE_PATTERN = re.compile(r'^user_(\d+)_notes$')
+# Ids of imported chat vectors: chat_{chat id or name hash}_{first msg_id}_{chunk}
+CHAT_VECTOR_PATTERN = re.compile(r'^chat_(-?\d+)_\d+_\d+$')
+
+logger = logging.getLogger(__name__)
+
+
+def user_namespace(telegram_id: int) -> str:
+    """Same naming scheme as TelegramUser.vector_storage_namespace."""
+    return f'user_{telegram_id}_notes'
+
+
+def batched(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing out Pinecone requests to at most `rate` per second."""
+
+    def __init__(self, rate: float | None):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+@dataclass
+class Stats:
+    requests: int = 0
+    vectors: int = 0
+    started: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, requests: int = 0, vectors: int = 0):
+        with self.lock:
+            self.requests += requests
+            self.vectors += vectors
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started
+        return (
+            f'{self.vectors} vectors, {self.requests} requests in {elapsed:.1f}s '
+            f'({self.vectors / elapsed if elapsed else 0:.0f} vectors/s, '
+            f'{self.requests / elapsed if elapsed else 0:.1f} req/s)'
+        )
+
+
+@dataclass
+class Target:
+    index_name: str
+    namespace: str
+    vector_count: int
+
+
+class PineconeMaintenance:
+    """Bulk operations over user namespaces with bounded parallelism."""
+
+    def __init__(self, workers: int = 8, rate: float | None = None, dry_run: bool = False):
+        self.pc = Pinecone(api_key=PINECONE_API_KEY)
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+        self.stats = Stats()
+        self.indexes = {}
+
+    def index(self, index_name: str):
+        if index_name not in self.indexes:
+            self.indexes[index_name] = self.pc.Index(index_name)
+        return self.indexes[index_name]
+
+    def call(self, fn, *args, **kwargs):
+        self.limiter.wait()
+        self.stats.add(requests=1)
+        return fn(*args, **kwargs)
+
+    def map(self, fn, items):
+        # The only pool: functions run by map make their requests directly, never through map again
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fn, items))
+
+    def resolve_targets(self, index_names, user_ids=None) -> list[Target]:
+        """Find the namespaces to operate on, optionally restricted to some users."""
+
+        wanted = {user_namespace(user_id) for user_id in user_ids} if user_ids else None
+
+        def describe(index_name):
+            stats = self.call(self.index(index_name).describe_index_stats)
+            return [
+                Target(index_name, namespace, summary['vector_count'])
+                for namespace, summary in stats['namespaces'].items()
+                if wanted is None or namespace in wanted
+            ]
+
+        return [target for targets in self.map(describe, index_names) for target in targets]
+
+    def list_ids(self, target: Target, prefix: str | None = None) -> list[str]:
+        index = self.index(target.index_name)
+        ids = []
+        pages = index.list(prefix=prefix, namespace=target.namespace) if prefix else index.list(namespace=target.namespace)
+        while True:
+            self.limiter.wait()
+            try:
+                page = next(pages)
+            except StopIteration:
+                break
+            self.stats.add(requests=1)
+            ids.extend(page)
+        return ids
+
+    def list_all(self, targets: list[Target], chat_names: set[str] | None = None) -> list[list[str]]:
+        """Ids of every target, only of the chats in `chat_names` if given, one listing per worker."""
+
+        if not chat_names:
+            return self.map(self.list_ids, targets)
+
+        jobs = [(i, target, prefix) for i, target in enumerate(targets) for prefix in chat_prefixes(target, chat_names)]
+        ids = [[] for _ in targets]
+        for (i, _, _), listed in zip(jobs, self.map(lambda job: self.list_ids(job[1], job[2]), jobs)):
+            ids[i].extend(listed)
+        return ids
+
+    def fetch(self, targets: list[Target], id_lists: list[list[str]]) -> list[dict]:
+        """Vectors (metadata and values) of the ids of every target, FETCH_BATCH_SIZE ids per request."""
+
+        jobs = [(i, target, batch) for i, (target, ids) in enumerate(zip(targets, id_lists)) for batch in batched(ids, FETCH_BATCH_SIZE)]
+
+        def fetch_batch(job):
+            _, target, batch = job
+            response = self.call(self.index(target.index_name).fetch, ids=batch, namespace=target.namespace)
+            self.stats.add(vectors=len(response.vectors))
+            return response.vectors
+
+        vectors = [{} for _ in targets]
+        for (i, _, _), fetched in zip(jobs, self.map(fetch_batch, jobs)):
+            vectors[i].update(fetched)
+        return vectors
+
+    def delete(self, targets: list[Target], chat_names: set[str] | None = None):
+
+        if not chat_names:
+            def delete_target(target):
+                logger.info(f'{target.index_name}/{target.namespace}: delete {target.vector_count} vectors')
+                if not self.dry_run:
+                    self.call(self.index(target.index_name).delete, namespace=target.namespace, delete_all=True)
+                    forget_embedded(target)
+                self.stats.add(vectors=target.vector_count)
+
+            self.map(delete_target, targets)
+            return
+
+        id_lists = self.list_all(targets, chat_names)
+        jobs = []
+        for target, ids in zip(targets, id_lists):
+            logger.info(f'{target.index_name}/{target.namespace}: delete {len(ids)} vectors of chats {sorted(chat_names)}')
+            jobs += [(target, batch) for batch in batched(ids, DELETE_BATCH_SIZE)]
+
+        def delete_batch(job):
+            target, batch = job
+            if not self.dry_run:
+                self.call(self.index(target.index_name).delete, ids=batch, namespace=target.namespace)
+            self.stats.add(vectors=len(batch))
+
+        self.map(delete_batch, jobs)
+        if not self.dry_run:
+            for target in targets:
+                forget_embedded(target, chat_names)
+
+    def count(self, targets: list[Target], chat_names: set[str] | None = None) -> dict:
+
+        if chat_names:
+            counts = [len(ids) for ids in self.list_all(targets, chat_names)]
+        else:
+            counts = [target.vector_count for target in targets]
+        return {(t.index_name, t.namespace): c for t, c in zip(targets, counts)}
+
+    def export(self, targets: list[Target], output_path: str, chat_names: set[str] | None = None, with_values: bool = False):
+
+        results = []
+        for target, vectors in zip(targets, self.fetch(targets, self.list_all(targets, chat_names))):
+            for vector_id, vector in vectors.items():
+                row = {
+                    'index_name': target.index_name,
+                    'namespace': target.namespace,
+                    'id': vector_id,
+                    'metadata': vector.metadata or {},
+                }
+                if with_values:
+                    row['values'] = list(vector.values)
+                results.append(orjson.dumps(row))
+
+        if self.dry_run:
+            logger.info(f'Would export {len(results)} vectors to {output_path}')
+            return len(results)
+
+        with open(output_path, 'wb') as f:
+            for row in results:
+                f.write(row + b'\n')
+        return len(results)
+
+    def backfill(self, targets: list[Target]) -> int:
+        """Add the metadata of search filters (see search_filters.py) to vectors uploaded before it existed.
+
+        Notes get their date from the database, chat windows their chat,
+        senders and message types from the user's import archive. Windows of
+        chats missing from the archive only get dates, from their ISO dates.
+
+        Pinecone updates one vector per request, so the vectors are written
+        back whole (fetched values, merged metadata) in upserts of
+        UPSERT_BATCH_SIZE. Every step is one flat map over the requests of all
+        namespaces, so no pool waits on another.
+        """
+
+        from import_archive import ImportArchive
+        from search_filters import NOTE_TYPE
+
+        user_targets = [t for t in targets if NAMESPACE_PATTERN.match(t.namespace)]
+        outdated = {
+            (target.index_name, target.namespace): {
+                vector_id: vector for vector_id, vector in vectors.items() if 'date_unix' not in (vector.metadata or {})
+            }
+            for target, vectors in zip(user_targets, self.fetch(user_targets, self.list_all(user_targets)))
+        }
+        note_dates = asyncio.run(load_note_dates(
+            [int(NAMESPACE_PATTERN.match(t.namespace).group(1)) for t in user_targets]
+        ))
+
+        upserts = []
+        for target in user_targets:
+            telegram_id = int(NAMESPACE_PATTERN.match(target.namespace).group(1))
+            vectors = outdated[(target.index_name, target.namespace)]
+            messages = archived_messages(ImportArchive(telegram_id), [vector.metadata or {} for vector in vectors.values()])
+
+            records = []
+            for vector_id, vector in vectors.items():
+                metadata = vector.metadata or {}
+                if 'source' in metadata:
+                    date = note_dates.get(telegram_id, {}).get(int(metadata['source']))
+                    if date is None:
+                        continue
+                    update = {'date_unix': date, 'date_end_unix': date, 'msg_types': [NOTE_TYPE]}
+                elif metadata.get('msg_ids'):
+                    update = window_metadata(vector_id, metadata, messages)
+                else:
+                    continue
+                records.append({'id': vector_id, 'values': list(vector.values), 'metadata': {**metadata, **update}})
+
+            logger.info(f'{target.index_name}/{target.namespace}: backfill {len(records)} of {len(vectors)} vectors')
+            upserts += [(target, batch) for batch in batched(records, UPSERT_BATCH_SIZE)]
+
+        if not self.dry_run:
+            self.map(
+                lambda job: self.call(self.index(job[0].index_name).upsert, vectors=job[1], namespace=job[0].namespace, show_progress=False),
+                upserts
+            )
+        return sum(len(batch) for _, batch in upserts)
+
+    def verify(self, targets: list[Target]) -> dict:
+        """Compare note sources stored in Pinecone with vectorized notes in SQLite."""
+
+        user_targets = [t for t in targets if NAMESPACE_PATTERN.match(t.namespace)]
+        in_pinecone = {
+            (target.index_name, target.namespace): {
+                int(vector.metadata['source'])
+                for vector in vectors.values()
+                if vector.metadata and 'source' in vector.metadata
+            }
+            for target, vectors in zip(user_targets, self.fetch(user_targets, self.list_all(user_targets)))
+        }
+        in_db = asyncio.run(load_vectorized_notes(
+            [int(NAMESPACE_PATTERN.match(t.namespace).group(1)) for t in user_targets]
+        ))
+
+        report = {}
+        for target in user_targets:
+            telegram_id = int(NAMESPACE_PATTERN.match(target.namespace).group(1))
+            pinecone_sources = in_pinecone[(target.index_name, target.namespace)]
+            db_sources = in_db.get(telegram_id, set())
+            report[(target.index_name, target.namespace)] = {
+                'missing_in_pinecone': sorted(db_sources - pinecone_sources),
+                'orphaned_in_pinecone': sorted(pinecone_sources - db_sources),
+            }
+        return report
+
+
+async def load_vectorized_notes(telegram_ids: list[int]) -> dict[int, set[int]]:
+
+    from generate_schema import init, shutdown
+    from models import TelegramUser
+
+    await init()
+    try:
+        result = {}
+        for user in await TelegramUser.filter(telegram_id__in=telegram_ids):
+            notes = await user.notes.filter(is_vectorized=True).values_list('telegram_message_id', flat=True)
+            result[user.telegram_id] = set(notes)
+        return result
+    finally:
+        await shutdown()
+
+
+def chat_prefixes(target: Target, chat_names: set[str], root: str | None = None) -> list[str]:
+    """Id prefixes of the vectors of imported chats, chat_{chat key}_ (see backend.upload_exported_chat_to_pinecone)."""
+
+    from import_archive import ARCHIVE_DIR, ImportArchive, chat_key
+
+    match = NAMESPACE_PATTERN.match(target.namespace)
+    if not match:
+        return []
+
+    archive = ImportArchive(int(match.group(1)), root or ARCHIVE_DIR)
+    prefixes = []
+    for chat_name in sorted(chat_names):
+        # A chat missing from the archive is keyed by its name, like an export without a chat id
+        chat = archive.scan(chat_name, latest=False)
+        df = chat.select('chat_id').collect() if chat is not None else pl.DataFrame()
+        prefixes.append(f'chat_{chat_key(df, chat_name)}_')
+    return list(dict.fromkeys(prefixes))
+
+
+def forget_embedded(target: Target, chat_names: set[str] | None = None, root: str | None = None):
+    """Drop the fingerprints of a user's deleted chats, all of them by default, so that a re-import embeds them again."""
+
+    from import_archive import ARCHIVE_DIR, ImportArchive, SeenIndex, WindowIndex, chat_key, message_fingerprints
+
+    match = NAMESPACE_PATTERN.match(target.namespace)
+    if not match:
+        return
+    telegram_id, root = int(match.group(1)), root or ARCHIVE_DIR
+    seen, windows = SeenIndex(telegram_id, root), WindowIndex(telegram_id, root)
+
+    if not chat_names:
+        seen.remove()
+        windows.remove()
+    else:
+        archive = ImportArchive(telegram_id, root)
+        for chat_name in chat_names:
+            chat = archive.scan(chat_name, latest=False)
+            if chat is None:
+                continue
+            df = chat.collect()
+            keys, _ = message_fingerprints(df, chat_name)
+            seen.remove(keys)
+            windows.remove({chat_key(df, chat_name)})
+
+    seen.save()
+    windows.save()
+
+
+async def load_note_dates(telegram_ids: list[int]) -> dict[int, dict[int, int]]:
+    """Unix time every vectorized note was saved at, by user and message id."""
+
+    from generate_schema import init, shutdown
+    from models import TelegramUser
+
+    await init()
+    try:
+        result = {}
+        for user in await TelegramUser.filter(telegram_id__in=telegram_ids):
+            notes = await user.notes.filter(is_vectorized=True).values_list('telegram_message_id', 'created_at')
+            result[user.telegram_id] = {message_id: note_unix(created_at) for message_id, created_at in notes}
+        return result
+    finally:
+        await shutdown()
+
+
+def archived_messages(archive, vectors) -> dict[tuple[str, str], dict]:
+    """Archived messages covered by chat window vectors, by chat name and msg_id."""
+
+    chats = archive.scan(latest=False)
+    msg_ids = {int(msg_id) for metadata in vectors for msg_id in metadata.get('msg_ids', [])}
+    if chats is None or not msg_ids:
+        return {}
+
+    rows = (
+        chats
+        .filter(pl.col('msg_id').is_in(list(msg_ids)))
+        .select('chat_name', pl.col('msg_id').cast(pl.Utf8), pl.col('chat_id').cast(pl.Utf8), 'sender_id', 'msg_type', 'date_unixtime')
+        .collect()
+        .to_dicts()
+    )
+    # Later imports of a chat win
+    return {(row['chat_name'], row['msg_id']): row for row in rows}
+
+
+def window_metadata(vector_id: str, metadata: dict, messages: dict[tuple[str, str], dict]) -> dict:
+    """Metadata window_conversation gives new windows, from the archived messages of a window."""
+
+    rows = [messages[key] for key in ((metadata.get('chat_name'), msg_id) for msg_id in metadata['msg_ids']) if key in messages]
+    if not rows:
+        # Dates of the export, the local time of the user, close enough for day filters
+        dates = [datetime.datetime.fromisoformat(metadata[key]) for key in ('date', 'date_end') if metadata.get(key)]
+        update = {'date_unix': int(dates[0].replace(tzinfo=datetime.timezone.utc).timestamp())} if dates else {}
+        if dates:
+            update['date_end_unix'] = int(dates[-1].replace(tzinfo=datetime.timezone.utc).timestamp())
+        chat_id = CHAT_VECTOR_PATTERN.match(vector_id)
+        if chat_id:
+            update['chat_id'] = chat_id.group(1)
+        return update
+
+    dates = [row['date_unixtime'] for row in rows if row['date_unixtime'] is not None]
+    update = {
+        'sender_ids': list(dict.fromkeys(row['sender_id'] for row in rows if row['sender_id'])),
+        'msg_types': list(dict.fromkeys(row['msg_type'] for row in rows if row['msg_type'])),
+    }
+    if dates:
+        update['date_unix'], update['date_end_unix'] = min(dates), max(dates)
+    if rows[0]['chat_id']:
+        update['chat_id'] = rows[0]['chat_id']
+    return update
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="pinecone_maintenance.py",
+        description="Bulk maintenance of the Pinecone indexes: list, count, export, verify, backfill metadata and delete vectors.",
+        usage="python3 pinecone_maintenance.py delete --user 123 --chat 'My chat' --dry-run"
+    )
+    parser.add_argument("command", choices=["list", "count", "delete", "export", "verify", "backfill"])
+    parser.add_argument("--index", action="append", dest="indexes", help="Index name, repeatable (default: all bot indexes)")
+    parser.add_argument("--user", action="append", type=int, dest="users", help="Telegram user id, repeatable (default: all namespaces)")
+    parser.add_argument("--chat", action="append", dest="chats", help="Imported chat name, repeatable")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel requests to Pinecone")
+    parser.add_argument("--rate", type=float, default=None, help="Max requests per second")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be done")
+    parser.add_argument("--output", default="pinecone_export.jsonl", help="Export file path")
+    parser.add_argument("--with-values", action="store_true", help="Include embeddings in the export")
+    parser.add_argument("--all", action="store_true", help="Confirm deleting from every namespace when no --user is given")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    if args.command == "delete" and not args.users and not args.all:
+        parser.error("delete without --user requires --all")
+
+    maintenance = PineconeMaintenance(workers=args.workers, rate=args.rate, dry_run=args.dry_run)
+    targets = maintenance.resolve_targets(args.indexes or INDEX_NAMES, args.users)
+    chat_names = set(args.chats) if args.chats else None
+
+    if args.command == "list":
+        for target in targets:
+            print(f"{target.index_name}\t{target.namespace}\t{target.vector_count}")
+    elif args.command == "count":
+        counts = maintenance.count(targets, chat_names)
+        for (index_name, namespace), count in counts.items():
+            print(f"{index_name}\t{namespace}\t{count}")
+        print(f"total\t\t{sum(counts.values())}")
+    elif args.command == "delete":
+        maintenance.delete(targets, chat_names)
+    elif args.command == "export":
+        exported = maintenance.export(targets, args.output, chat_names, with_values=args.with_values)
+        print(f"Exported {exported} vectors to {args.output}")
+    elif args.command == "verify":
+        report = maintenance.verify(targets)
+        for (index_name, namespace), diff in report.items():
+            print(
+                f"{index_name}\t{namespace}\t"
+                f"missing={len(diff['missing_in_pinecone'])}\torphaned={len(diff['orphaned_in_pinecone'])}"
+            )
+
+    elif args.command == "backfill":
+        updated = maintenance.backfill(targets)
+        print(f"Backfilled the metadata of {updated} vectors")
+
+    prefix = "[dry-run] " if args.dry_run else ""
+    logger.info(f"{prefix}{args.command}: {maintenance.stats.report()}")
+
+
+if __name__ == "__main__":
+    main()
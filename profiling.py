@@ -0,0 +1,219 @@
+"""On-demand CPU and memory profiling of the updates of chosen users.
+
+An admin arms the profiler for a user with /profile (or PROFILE_USER_IDS at
+startup), the next PROFILE_UPDATES updates of that user are then profiled:
+
+- a thread samples the stack of the event loop thread every
+  PROFILE_INTERVAL_MS while a task of the profiled update is running, other
+  users' updates handled meanwhile are not sampled; the stacks are saved in
+  the collapsed format of flamegraph.pl and speedscope (`<name>.collapsed`)
+- tracemalloc runs during the update, the allocation sites still holding
+  memory at its end and the peak are saved to `<name>.alloc.txt`; unlike
+  the CPU samples these include anything allocated concurrently
+
+Files go to PROFILE_DIR. The profiler is per process: with several webhook
+workers /profile arms only the worker that got the command, PROFILE_USER_IDS
+arms all of them. Snapshots take a while on a large heap and block
+the loop, profile only as many updates as needed.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import tracemalloc
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterator
+
+from aiogram import BaseMiddleware
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000
+PROFILE_UPDATES = int(os.getenv('PROFILE_UPDATES', 5))
+# Users armed at startup, comma separated Telegram ids
+PROFILE_USER_IDS = [int(user_id) for user_id in os.getenv('PROFILE_USER_IDS', '').split(',') if user_id.strip()]
+
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 30
+TOP_TRACEBACKS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileSession:
+
+    def __init__(self, user_id: int, update_id: int):
+        self.user_id = user_id
+        self.update_id = update_id
+        self.name = f"{user_id}_{update_id}_{time.strftime('%Y%m%d-%H%M%S')}"
+        self.stacks: Counter[str] = Counter()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+
+
+# Session of the update the current task belongs to, inherited by the tasks it creates
+current_session: contextvars.ContextVar[ProfileSession | None] = contextvars.ContextVar('current_session', default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if 'site-packages' in filename:
+        filename = filename.rsplit('site-packages' + os.sep, 1)[-1]
+    else:
+        filename = os.path.relpath(filename) if filename.startswith(os.getcwd()) else os.path.basename(filename)
+    return f'{code.co_qualname} ({filename}:{code.co_firstlineno})'
+
+
+def collapse_stack(frame) -> str:
+    """Stack as `outer;...;inner`, starting below the event loop machinery."""
+
+    labels = []
+    while frame is not None:
+        # Handle._run calls into the task step, frames above it are the loop
+        if frame.f_code.co_name == '_run' and frame.f_code.co_filename.endswith(os.path.join('asyncio', 'events.py')):
+            break
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Profiler:
+
+    def __init__(self, directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        # Telegram user id -> updates left to profile
+        self.armed: dict[int, int] = {}
+        self.active: set[ProfileSession] = set()
+        self.saved: list[str] = []
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread_id: int | None = None
+        self.sampler: threading.Thread | None = None
+        self.started_tracemalloc = False
+
+    def arm(self, user_id: int, updates: int = PROFILE_UPDATES):
+        self.armed[user_id] = updates
+        logger.info(f'Profiling the next {updates} updates of user {user_id}')
+
+    def disarm(self, user_id: int):
+        self.armed.pop(user_id, None)
+
+    def take(self, user_id: int) -> bool:
+        """Whether to profile an update of the user, counting it against the armed updates."""
+
+        left = self.armed.get(user_id)
+        if not left:
+            return False
+        if left == 1:
+            del self.armed[user_id]
+        else:
+            self.armed[user_id] = left - 1
+        return True
+
+    @contextmanager
+    def profile(self, user_id: int, update_id: int) -> Iterator[ProfileSession]:
+
+        session = ProfileSession(user_id, update_id)
+        token = current_session.set(session)
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+
+        self.active.add(session)
+        self._start_sampler()
+        try:
+            yield session
+        finally:
+            self.active.discard(session)
+            current_session.reset(token)
+            session.duration = time.perf_counter() - session.started
+
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not self.active and self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+            self.save(session, before, after, peak)
+
+    def _start_sampler(self):
+        if self.sampler is not None and self.sampler.is_alive():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self.sampler.start()
+
+    def _sample(self):
+        """Sampler thread, runs while there are sessions."""
+
+        while self.active:
+            time.sleep(self.interval)
+            task = asyncio.current_task(self.loop)
+            if task is None:
+                continue
+            session = task.get_context().get(current_session)
+            if session is None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                session.stacks[collapse_stack(frame)] += 1
+
+    def save(self, session: ProfileSession, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, peak: int):
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, session.name)
+
+        with open(base + '.collapsed', 'w', encoding='utf-8') as f:
+            for stack, count in session.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        # The profiler's own frames are not interesting
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        before, after = before.filter_traces(filters), after.filter_traces(filters)
+        lines = [
+            f'User {session.user_id}, update {session.update_id}: {session.duration:.2f} s, '
+            f'{sum(session.stacks.values())} CPU samples every {self.interval * 1000:.0f} ms, '
+            f'traced memory peak {peak / 1024 / 1024:.1f} MB',
+            '',
+            f'Top {TOP_ALLOCATIONS} allocation sites still holding memory at the end of the update:',
+        ]
+        lines += [str(stat) for stat in after.compare_to(before, 'lineno')[:TOP_ALLOCATIONS]]
+        for stat in after.compare_to(before, 'traceback')[:TOP_TRACEBACKS]:
+            lines += ['', f'{stat.size_diff / 1024:.1f} KiB in {stat.count_diff} blocks allocated at:']
+            lines += stat.traceback.format(limit=TRACEMALLOC_FRAMES)
+
+        with open(base + '.alloc.txt', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        self.saved = (self.saved + [base])[-20:]
+        logger.info(f'Saved profile of update {session.update_id} of user {session.user_id} to {base}.*')
+
+
+PROFILER = Profiler()
+for _user_id in PROFILE_USER_IDS:
+    PROFILER.arm(_user_id)
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Outer update middleware profiling the updates of armed users."""
+
+    def __init__(self, profiler: Profiler = PROFILER):
+        self.profiler = profiler
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event: Any, data: dict) -> Any:
+
+        user = data.get('event_from_user')
+        if user is None or not self.profiler.take(user.id):
+            return await handler(event, data)
+
+        with self.profiler.profile(user.id, event.update_id):
+            return await handler(event, data)
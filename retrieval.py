@@ -0,0 +1,132 @@
+"""Assembling retrieved chunks into distinct results.
+
+The top hits of a query are often the same text several times: chunks of
+one note share their overlap, chunks of one conversation window share its
+messages, forwards repeat a message under another source. fetch_candidates
+gets FETCH_K_FACTOR times more candidates than needed with their vectors in
+the one Pinecone query, select_distinct picks k of them by maximal marginal
+relevance (MMR), collapsing every candidate of the same note or window
+(collapse_key) and every near copy (DUPLICATE_SIMILARITY) of a picked one.
+"""
+
+import asyncio
+
+import numpy as np
+from langchain_core.documents import Document
+
+FETCH_K_FACTOR = 3
+# Metadata key the LangChain vector store keeps the text of a document under
+TEXT_KEY = 'text'
+# 1 ranks by relevance only, 0 by novelty only
+MMR_LAMBDA = 0.7
+# Candidates this similar to a picked one are copies of it
+DUPLICATE_SIMILARITY = 0.97
+
+
+def collapse_key(doc: Document) -> tuple:
+    """Results with the same key are one result: chunks of a note or of a conversation window."""
+
+    metadata = doc.metadata
+    if 'source' in metadata:
+        return ('note', metadata['source'])
+    if metadata.get('msg_ids'):
+        return ('window', metadata.get('chat_name'), metadata['msg_ids'][0])
+    return ('text', ' '.join(doc.page_content.split()).casefold())
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def mmr(
+    query: np.ndarray,
+    vectors: np.ndarray,
+    k: int,
+    lambda_mult: float = MMR_LAMBDA,
+    groups: np.ndarray | None = None,
+    duplicate_similarity: float = DUPLICATE_SIMILARITY,
+) -> list[int]:
+    """Indices of up to k vectors by maximal marginal relevance, in the order picked.
+
+    A pick removes the vectors of its group and those at least
+    `duplicate_similarity` similar to it from the candidates, so fewer than
+    k are returned only when there are fewer than k distinct candidates.
+    """
+
+    if not len(vectors) or k <= 0:
+        return []
+
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    relevance = vectors @ _normalize(np.asarray(query, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    if groups is None:
+        groups = np.arange(len(vectors))
+
+    available = np.ones(len(vectors), dtype=bool)
+    # Highest similarity of each candidate to the picked ones
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    selected = []
+    while len(selected) < k and available.any():
+        scores = relevance if not selected else lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        i = int(np.argmax(np.where(available, scores, -np.inf)))
+        selected.append(i)
+        redundancy = np.maximum(redundancy, similarity[i])
+        available &= (groups != groups[i]) & (similarity[i] < duplicate_similarity)
+
+    return selected
+
+
+async def fetch_candidates(
+    index,
+    namespace: str,
+    embedding: list[float],
+    fetch_k: int,
+    metadata_filter: dict | None = None,
+) -> tuple[list[Document], np.ndarray, np.ndarray]:
+    """Documents, relevance scores (0..1) and vectors of the top `fetch_k` matches of an embedded query.
+
+    `index` is a pinecone Index, the vector store has no public query returning
+    vectors and scores together. `metadata_filter` is applied by Pinecone,
+    before the top matches are taken.
+    """
+
+    response = await asyncio.to_thread(
+        index.query,
+        vector=embedding,
+        top_k=fetch_k,
+        include_values=True,
+        include_metadata=True,
+        namespace=namespace,
+        filter=metadata_filter,
+    )
+
+    docs, scores, vectors = [], [], []
+    for match in response.matches:
+        metadata = dict(match.metadata or {})
+        text = metadata.pop(TEXT_KEY, None)
+        if text is None:
+            continue
+        docs.append(Document(id=match.id, page_content=text, metadata=metadata))
+        # Cosine similarity to a relevance score, as the vector store does
+        scores.append((match.score + 1) / 2)
+        vectors.append(match.values)
+
+    return docs, np.asarray(scores, dtype=np.float32), np.asarray(vectors, dtype=np.float32)
+
+
+def select_distinct(
+    docs: list[Document],
+    scores: np.ndarray,
+    vectors: np.ndarray,
+    query: list[float],
+    k: int,
+    score_threshold: float = 0.0,
+) -> list[tuple[Document, float]]:
+    """k distinct (document, relevance) pairs of the candidates over `score_threshold`, by MMR."""
+
+    keep = np.flatnonzero(scores >= score_threshold)
+    keys: dict[tuple, int] = {}
+    groups = np.array([keys.setdefault(collapse_key(docs[i]), len(keys)) for i in keep], dtype=np.int64)
+    picked = mmr(np.asarray(query, dtype=np.float32), vectors[keep], k, groups=groups)
+    return [(docs[keep[i]], float(scores[keep[i]])) for i in picked]
@@ -0,0 +1,142 @@
+"""Filters of search and chat by date, chat, sender and message type.
+
+Every vector carries structured metadata next to its text:
+- date_unix, date_end_unix  first and last message of a conversation window,
+                            the time a note was saved
+- chat_id, chat_name        id of the imported chat as a string, and its name,
+                            chats exported without an id are matched by name
+- sender_ids, msg_types     senders and message types of the window's messages,
+                            notes have msg_types ['note']
+
+Filters use the syntax of /cloud, as command arguments or anywhere in the
+query: chat="Название чата" sender=Имя from=2024-03-01 to=2024-03-31 type=photo.
+Chat and sender names are matched case-insensitively against the user's
+import archive and sent to Pinecone as ids, so the index returns only
+matching candidates instead of the search dropping them afterwards.
+"""
+
+import re
+import datetime
+from dataclasses import dataclass
+
+import polars as pl
+
+from import_archive import ARCHIVE_DIR, ImportArchive
+from term_stats import NOTES_SOURCE
+
+FILTER_PATTERN = re.compile(r'(?<!\S)(chat|sender|from|to|type)=(?:"([^"]*)"|(\S+))')
+
+NOTE_TYPE = 'note'
+
+
+@dataclass
+class SearchFilters:
+    chat: str | None = None
+    sender: str | None = None
+    date_from: datetime.date | None = None
+    date_to: datetime.date | None = None
+    msg_type: str | None = None
+
+    def __bool__(self):
+        return any(value is not None for value in vars(self).values())
+
+
+def parse_filters(text: str) -> tuple[str, SearchFilters]:
+    """Text without the filters and the filters, ValueError on a malformed date."""
+
+    filters = SearchFilters()
+    for match in FILTER_PATTERN.finditer(text):
+        key, value = match.group(1), match.group(2) if match.group(2) is not None else match.group(3)
+        if key == 'chat':
+            filters.chat = value
+        elif key == 'sender':
+            filters.sender = value
+        elif key == 'from':
+            filters.date_from = datetime.date.fromisoformat(value)
+        elif key == 'to':
+            filters.date_to = datetime.date.fromisoformat(value)
+        else:
+            filters.msg_type = value.lower()
+
+    return ' '.join(FILTER_PATTERN.sub(' ', text).split()), filters
+
+
+def _unix(day: datetime.date) -> int:
+    return int(datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc).timestamp())
+
+
+def _matching_ids(archive: ImportArchive, name_column: str, id_column: str, name: str) -> list[str]:
+    chats = archive.scan()
+    if chats is None:
+        return []
+    return (
+        chats
+        .filter(pl.col(name_column).str.to_lowercase().str.contains(name.lower(), literal=True))
+        .select(pl.col(id_column).cast(pl.Utf8).drop_nulls().unique())
+        .collect()[id_column]
+        .to_list()
+    )
+
+
+def _chat_condition(archive: ImportArchive, name: str) -> dict | None:
+    """Condition on the chats whose name contains `name`, by id or by name for chats without an id."""
+
+    chats = archive.scan()
+    if chats is None:
+        return None
+    matching = (
+        chats
+        .filter(pl.col('chat_name').str.to_lowercase().str.contains(name.lower(), literal=True))
+        .select('chat_name', pl.col('chat_id').cast(pl.Utf8))
+        .unique()
+        .collect()
+    )
+    conditions = []
+    chat_ids = matching['chat_id'].drop_nulls().unique().sort().to_list()
+    if chat_ids:
+        conditions.append({'chat_id': {'$in': chat_ids}})
+    chat_names = matching.filter(pl.col('chat_id').is_null())['chat_name'].unique().sort().to_list()
+    if chat_names:
+        conditions.append({'chat_name': {'$in': chat_names}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {'$or': conditions}
+
+
+def metadata_filter(filters: SearchFilters, telegram_id: int, root: str = ARCHIVE_DIR) -> dict:
+    """Pinecone metadata filter of the filters.
+
+    Reads the import archive to resolve names, raises LookupError with the
+    name when no chat or sender of the user matches it.
+    """
+
+    archive = ImportArchive(telegram_id, root)
+    conditions = []
+
+    if filters.chat and filters.chat.lower() == NOTES_SOURCE:
+        conditions.append({'msg_types': {'$in': [NOTE_TYPE]}})
+    elif filters.chat:
+        chat_condition = _chat_condition(archive, filters.chat)
+        if chat_condition is None:
+            raise LookupError(filters.chat)
+        conditions.append(chat_condition)
+
+    if filters.sender:
+        sender_ids = _matching_ids(archive, 'sender', 'sender_id', filters.sender)
+        if not sender_ids:
+            raise LookupError(filters.sender)
+        conditions.append({'sender_ids': {'$in': sender_ids}})
+
+    # A window matches a period it overlaps
+    if filters.date_from:
+        conditions.append({'date_end_unix': {'$gte': _unix(filters.date_from)}})
+    if filters.date_to:
+        conditions.append({'date_unix': {'$lt': _unix(filters.date_to + datetime.timedelta(days=1))}})
+
+    if filters.msg_type:
+        conditions.append({'msg_types': {'$in': [filters.msg_type]}})
+
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
@@ -0,0 +1,71 @@
+"""Pages of search results kept in Redis behind a short-lived cursor.
+
+A search fetches SEARCH_RESULTS distinct results at once. The first
+SEARCH_PAGE_SIZE are sent right away, the rest is stored under a cursor that
+the "More" button of the results message carries, so paging costs no
+embedding or Pinecone call. A cursor expires SEARCH_CURSOR_TTL after the
+search, the user then has to search again.
+
+- search:{user}:{cursor}  list of the results not sent yet, as JSON
+"""
+
+import uuid
+import logging
+
+import orjson
+from langchain_core.documents import Document
+from redis.exceptions import RedisError
+
+SEARCH_RESULTS = 20
+SEARCH_PAGE_SIZE = 5
+SEARCH_CURSOR_TTL = 15 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class SearchPages:
+
+    def __init__(self, redis=None, ttl: int = SEARCH_CURSOR_TTL):
+        # redis.asyncio.Redis, None disables paging
+        self.redis = redis
+        self.ttl = ttl
+
+    async def save(self, user_id: int, documents: list[Document]) -> str | None:
+        """Cursor of the documents, None if there are none or they could not be stored."""
+
+        if self.redis is None or not documents:
+            return None
+
+        cursor = uuid.uuid4().hex[:12]
+        key = f'search:{user_id}:{cursor}'
+        try:
+            await (
+                self.redis.pipeline(transaction=False)
+                .rpush(key, *(orjson.dumps({'page_content': doc.page_content, 'metadata': doc.metadata}, default=str) for doc in documents))
+                .expire(key, self.ttl)
+                .execute()
+            )
+        except RedisError:
+            logger.exception(f'Failed to store search results of user {user_id}')
+            return None
+        return cursor
+
+    async def page(self, user_id: int, cursor: str, offset: int, size: int = SEARCH_PAGE_SIZE) -> tuple[list[Document], int] | None:
+        """Documents from `offset` and the number of documents behind the cursor, None once it expired."""
+
+        if self.redis is None:
+            return None
+
+        key = f'search:{user_id}:{cursor}'
+        try:
+            items, total = await self.redis.pipeline(transaction=False).lrange(key, offset, offset + size - 1).llen(key).execute()
+        except RedisError:
+            logger.exception(f'Failed to read search results of user {user_id}')
+            return None
+        if not total:
+            return None
+        return [Document(**orjson.loads(item)) for item in items], total
+
+
+# Connected to the bot's Redis in bot.py
+SEARCH_PAGES = SearchPages()
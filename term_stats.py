@@ -0,0 +1,219 @@
+import os
+import glob
+import uuid
+import shutil
+import datetime
+import threading
+
+import polars as pl
+
+from import_archive import ARCHIVE_DIR
+from text_tools import STOPWORDS, MAX_TERMS, terms_expr
+
+# Number of part files after which an index is merged into one
+COMPACT_AFTER_PARTS = 32
+
+# What `source=` matches for the notes, chats are matched by name
+NOTES_SOURCE = 'notes'
+# Kinds of sources, a chat named like NOTES_SOURCE stays a chat
+CHAT_KIND = 'chat'
+NOTES_KIND = 'notes'
+
+KEYS = {'docs': ['kind', 'source', 'sender', 'day'], 'terms': ['kind', 'source', 'sender', 'day', 'term']}
+VALUES = {'docs': ['n_docs'], 'terms': ['count', 'docs']}
+
+# One lock per index path, shared by every TermStatsIndex of the process
+_LOCKS: dict[str, threading.RLock] = {}
+
+
+def day_expr(column: str = 'date') -> pl.Expr:
+    """Day of ISO date strings from the parser, or of already typed dates."""
+    return pl.col(column).cast(pl.Utf8).str.slice(0, 10).str.to_date('%Y-%m-%d', strict=False)
+
+
+def _aggregate(messages: pl.LazyFrame) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """docs and terms aggregates of messages with kind, source, sender, day, term and sign columns."""
+
+    messages = messages.with_row_index('doc')
+    docs = (
+        messages
+        .group_by(KEYS['docs'])
+        .agg(pl.col('sign').sum().cast(pl.Int32).alias('n_docs'))
+        .collect()
+    )
+    terms = (
+        messages
+        .explode('term')
+        .filter(pl.col('term').is_not_null())
+        .group_by(KEYS['terms'])
+        .agg(
+            pl.col('sign').sum().cast(pl.Int32).alias('count'),
+            (pl.col('doc').n_unique() * pl.col('sign').first()).cast(pl.Int32).alias('docs'),
+        )
+        .collect()
+    )
+    return docs, terms
+
+
+def _messages(df: pl.DataFrame | pl.LazyFrame, kind: str, source: pl.Expr, sign: int) -> pl.LazyFrame:
+    return df.lazy().select(
+        pl.lit(kind).alias('kind'),
+        source.cast(pl.Utf8).alias('source'),
+        pl.col('sender').cast(pl.Utf8).fill_null('Unknown').alias('sender'),
+        day_expr().alias('day'),
+        terms_expr().alias('term'),
+        pl.lit(sign, dtype=pl.Int32).alias('sign'),
+    )
+
+
+class TermStatsIndex:
+    """Per-user term statistics, aggregated by source (a chat or the notes), sender and day.
+
+    `terms` parts hold, per group and term, how many times the term occurs and
+    in how many messages, `docs` parts hold the number of messages per group.
+    Every ingest appends a pair of small Parquet parts, so a wordcloud over any
+    chat, sender or date range is a filter and a group-by over aggregates.
+    An edited message is ingested again after its old version was removed,
+    removing appends parts with negative counts.
+
+    The index is derived data: it is built from the import archive and the
+    notes by `build`, and ingests into an index that wasn't built are skipped.
+
+    Imports and note uploads ingest from threads. Building, ingesting,
+    compacting and reading hold the index's lock, so a compaction never merges
+    parts twice or deletes parts under a running ingest or read.
+    """
+
+    def __init__(self, telegram_id: int, root: str = ARCHIVE_DIR):
+        self.root = os.path.join(root, f'user_{telegram_id}')
+        self.path = os.path.join(self.root, 'term_stats')
+        self.lock = _LOCKS.setdefault(os.path.abspath(self.path), threading.RLock())
+
+    @property
+    def exists(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def _parts(self, kind: str) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.path, f'{kind}-*.parquet')))
+
+    def _write_part(self, kind: str, df: pl.DataFrame, path: str | None = None):
+        path = path or self.path
+        name = f"{kind}-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(path, f'.{name}.tmp')
+        df.write_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, os.path.join(path, name))
+
+    def build(self, chats: pl.LazyFrame | None, notes: pl.DataFrame):
+        """Replace the index with the statistics of archived chats (with a chat_name column) and notes."""
+
+        frames = [_messages(notes, NOTES_KIND, pl.lit(''), 1)]
+        if chats is not None:
+            frames.append(_messages(chats, CHAT_KIND, pl.col('chat_name'), 1))
+        docs, terms = _aggregate(pl.concat(frames))
+
+        tmp_path = f'{self.path}.{uuid.uuid4().hex[:8]}.tmp'
+        os.makedirs(tmp_path)
+        self._write_part('docs', docs, tmp_path)
+        self._write_part('terms', terms, tmp_path)
+        with self.lock:
+            if self.exists:
+                shutil.rmtree(self.path)
+            os.replace(tmp_path, self.path)
+        # Written before chats and notes had kinds, a chat named "notes" was counted as notes
+        shutil.rmtree(os.path.join(self.root, 'terms'), ignore_errors=True)
+
+    def add(self, df: pl.DataFrame, kind: str, source: str = ''):
+        """Ingest messages with msg_content, sender and date columns."""
+        self._ingest(df, kind, source, 1)
+
+    def remove(self, df: pl.DataFrame, kind: str, source: str = ''):
+        """Take back messages ingested before, e.g. the old versions of edited messages."""
+        self._ingest(df, kind, source, -1)
+
+    def _ingest(self, df: pl.DataFrame, kind: str, source: str, sign: int):
+
+        if df.is_empty():
+            return
+
+        docs, terms = _aggregate(_messages(df, kind, pl.lit(source), sign))
+        with self.lock:
+            if not self.exists:
+                return
+            self._write_part('docs', docs)
+            self._write_part('terms', terms)
+
+            if len(self._parts('terms')) > COMPACT_AFTER_PARTS:
+                self.compact()
+
+    def compact(self):
+        """Merge all parts into one per kind."""
+
+        with self.lock:
+            for kind in ('docs', 'terms'):
+                parts = self._parts(kind)
+                if len(parts) < 2:
+                    continue
+                value = VALUES[kind][0]
+                merged = (
+                    pl.scan_parquet(parts)
+                    .group_by(KEYS[kind])
+                    .agg(pl.col(column).sum().cast(pl.Int32) for column in VALUES[kind])
+                    # Groups whose messages were all removed
+                    .filter(pl.col(value) != 0)
+                    .collect()
+                )
+                self._write_part(kind, merged)
+                for part in parts:
+                    os.remove(part)
+
+    def frequencies(
+        self,
+        source: str | None = None,
+        sender: str | None = None,
+        date_from: datetime.date | None = None,
+        date_to: datetime.date | None = None,
+        max_terms: int = MAX_TERMS,
+    ) -> dict[str, float]:
+        """TF-IDF-like weights (count * smooth idf) of terms matching the filters.
+
+        `source` is NOTES_SOURCE for the notes or a part of a chat name, like
+        `sender` it is matched case-insensitively.
+        """
+
+        with self.lock:
+            doc_parts, term_parts = self._parts('docs'), self._parts('terms')
+            if not doc_parts or not term_parts:
+                return {}
+
+            condition = pl.lit(True)
+            if source and source.lower() == NOTES_SOURCE:
+                condition &= pl.col('kind') == NOTES_KIND
+            elif source:
+                condition &= (pl.col('kind') == CHAT_KIND) & pl.col('source').str.to_lowercase().str.contains(source.lower(), literal=True)
+            if sender:
+                condition &= pl.col('sender').str.to_lowercase().str.contains(sender.lower(), literal=True)
+            if date_from:
+                condition &= pl.col('day') >= date_from
+            if date_to:
+                condition &= pl.col('day') <= date_to
+
+            n_docs = pl.scan_parquet(doc_parts).filter(condition).select(pl.col('n_docs').sum()).collect().item()
+            if not n_docs:
+                return {}
+
+            weights = (
+                pl.scan_parquet(term_parts)
+                .filter(condition & ~pl.col('term').is_in(pl.Series(list(STOPWORDS)).implode()))
+                .group_by('term')
+                .agg(pl.col('count').sum(), pl.col('docs').sum())
+                .filter(pl.col('count') > 0)
+                .select(
+                    'term',
+                    (pl.col('count') * (((1 + n_docs) / (1 + pl.col('docs'))).log() + 1)).alias('weight'),
+                )
+                .sort('weight', descending=True)
+                .head(max_terms)
+                .collect()
+            )
+
+        return dict(zip(weights['term'].to_list(), weights['weight'].to_list()))
@@ -0,0 +1,236 @@
+import os
+import sys
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+from redis.exceptions import ConnectionError, LockNotOwnedError
+
+# Add the parent directory to the sys.path to allow importing the bot's modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Scripts run against the live database, OpenAI and Pinecone: python tests/test_backend_search.py
+collect_ignore = [
+    'test_backend_search.py',
+    'test_backend_upload.py',
+    'test_schema.py',
+    'test_start_kb_chat.py',
+]
+
+
+class FakePipeline:
+    """Queues commands of a FakeRedis and runs them in order on execute()."""
+
+    def __init__(self, redis):
+        self.redis, self.commands = redis, []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        return [await command(*args, **kwargs) for command, args, kwargs in self.commands]
+
+
+class FakeLock:
+    """redis.asyncio.lock.Lock over an asyncio.Lock per name, shared by every user of the FakeRedis."""
+
+    def __init__(self, redis, name: str, timeout: float | None = None, blocking_timeout: float | None = None):
+        self.redis, self.name, self.timeout, self.blocking_timeout = redis, name, timeout, blocking_timeout
+        self.owned = False
+
+    async def acquire(self) -> bool:
+        try:
+            await asyncio.wait_for(self.redis.locks.setdefault(self.name, asyncio.Lock()).acquire(), self.blocking_timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.owned = True
+        return True
+
+    async def release(self):
+        if not self.owned:
+            raise LockNotOwnedError('not owned')
+        self.owned = False
+        self.redis.locks[self.name].release()
+
+    async def reacquire(self):
+        if not self.owned:
+            raise LockNotOwnedError('not owned')
+        self.redis.extensions[self.name] = self.redis.extensions.get(self.name, 0) + 1
+
+
+class FakeRedis:
+    """In-memory stand-in for redis.asyncio.Redis: strings, hashes, sorted sets, lists and locks, values as bytes."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls: dict[str, int] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.extensions: dict[str, int] = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def lock(self, name, timeout=None, blocking_timeout=None):
+        return FakeLock(self, name, timeout, blocking_timeout)
+
+    @staticmethod
+    def _bytes(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self._bytes(value)
+        if ex:
+            self.ttls[key] = ex
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def incr(self, key):
+        self.data[key] = self._bytes(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    async def expire(self, key, seconds):
+        self.ttls[key] = seconds
+        return key in self.data
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    async def hset(self, key, field, value):
+        self.data.setdefault(key, {})[self._bytes(field)] = self._bytes(value)
+
+    async def hget(self, key, field):
+        return self.data.get(key, {}).get(self._bytes(field))
+
+    async def hmget(self, key, fields):
+        return [self.data.get(key, {}).get(self._bytes(field)) for field in fields]
+
+    async def hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    async def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    async def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(self._bytes(field), None)
+
+    async def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update({self._bytes(member): score for member, score in mapping.items()})
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.data.get(key, {}).pop(self._bytes(member), None)
+
+    async def zrange(self, key, start, end):
+        members = sorted(self.data.get(key, {}), key=self.data.get(key, {}).get)
+        return members[start:end + 1 if end != -1 else None]
+
+    async def zpopmin(self, key):
+        members = self.data.get(key)
+        if not members:
+            return []
+        member = min(members, key=members.get)
+        return [(member, members.pop(member))]
+
+    async def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+
+    async def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:end + 1]
+
+    async def llen(self, key):
+        return len(self.data.get(key, []))
+
+
+class BrokenRedis:
+    """Redis that is down, every command fails."""
+
+    def pipeline(self, transaction=True):
+        raise ConnectionError('redis is down')
+
+    def __getattr__(self, name):
+        async def command(*args, **kwargs):
+            raise ConnectionError('redis is down')
+        return command
+
+
+@pytest.fixture
+def redis() -> FakeRedis:
+    return FakeRedis()
+
+
+@pytest.fixture
+def broken_redis() -> BrokenRedis:
+    return BrokenRedis()
+
+
+class FakeIndex:
+    """One namespace of a Pinecone index in memory, for the sync Index API and Pinecone.afrom_documents."""
+
+    def __init__(self):
+        self.vectors: dict[str, SimpleNamespace] = {}
+        self.upserted: list[str] = []
+        self.upserts: list[list[dict]] = []
+        self.queries: list[dict] = []
+        self.lock = threading.Lock()
+
+    def add(self, vector_id: str, metadata: dict | None, values: list[float] | None = None, score: float | None = None):
+        """Store a vector, `score` fixes its query score instead of the dot product with the query."""
+
+        values = [float(len(self.vectors))] if values is None else values
+        self.vectors[vector_id] = SimpleNamespace(id=vector_id, values=values, metadata=metadata, score=score)
+
+    def add_many(self, vectors: dict[str, dict]):
+        for vector_id, metadata in vectors.items():
+            self.add(vector_id, metadata)
+
+    def list(self, namespace, prefix=None):
+        yield [vector_id for vector_id in self.vectors if vector_id.startswith(prefix or '')]
+
+    def fetch(self, ids, namespace):
+        return SimpleNamespace(vectors={vector_id: self.vectors[vector_id] for vector_id in ids if vector_id in self.vectors})
+
+    def delete(self, ids=None, namespace=None, delete_all=False):
+        with self.lock:
+            for vector_id in list(self.vectors) if delete_all else ids:
+                self.vectors.pop(vector_id, None)
+
+    def upsert(self, vectors, namespace, show_progress=True):
+        with self.lock:
+            self.upserts.append(vectors)
+            for record in vectors:
+                self.upserted.append(record['id'])
+                self.add(record['id'], record['metadata'], record['values'])
+
+    def update(self, **kwargs):
+        raise AssertionError('vectors are upserted in batches')
+
+    def query(self, **kwargs):
+        self.queries.append(kwargs)
+        matches = [
+            SimpleNamespace(
+                id=vector.id, values=vector.values, metadata=vector.metadata,
+                score=sum(a * b for a, b in zip(vector.values, kwargs['vector'])) if vector.score is None else vector.score,
+            )
+            for vector in self.vectors.values()
+        ]
+        return SimpleNamespace(matches=sorted(matches, key=lambda match: -match.score)[:kwargs['top_k']])
+
+    async def afrom_documents(self, documents, ids, **kwargs):
+        for doc, vector_id in zip(documents, ids):
+            self.upserted.append(vector_id)
+            self.add(vector_id, {'text': doc.page_content, **doc.metadata})
+
+
+@pytest.fixture
+def pinecone_index() -> FakeIndex:
+    return FakeIndex()
@@ -0,0 +1,63 @@
+import asyncio
+
+from langchain_core.documents import Document
+
+from answer_cache import AnswerCache
+
+
+def ask(cache: AnswerCache, embedding, user_id: int = 1):
+    return asyncio.run(cache.get(user_id, embedding))
+
+
+def test_similar_question_gets_the_cached_answer(redis):
+    cache = AnswerCache(redis, similarity=0.95)
+    lookup = ask(cache, [1.0, 0.0, 0.0])
+    assert (lookup.version, lookup.answer) == (0, None)
+
+    sources = [Document(page_content='note', metadata={'source': 7})]
+    asyncio.run(cache.put(1, lookup.version, [1.0, 0.0, 0.0], 'when is the trip?', 'On Friday.', sources))
+
+    hit = ask(cache, [0.99, 0.05, 0.0])
+    assert hit.answer == 'On Friday.'
+    assert hit.documents == sources
+    assert ask(cache, [0.0, 1.0, 0.0]).answer is None
+    # Answers are per user
+    assert ask(cache, [1.0, 0.0, 0.0], user_id=2).answer is None
+
+
+def test_invalidate_drops_answers_and_stale_writes(redis):
+    cache = AnswerCache(redis)
+    before = ask(cache, [1.0, 0.0])
+    asyncio.run(cache.invalidate(1))
+    # An answer computed before the knowledge base changed is written after the invalidation
+    asyncio.run(cache.put(1, before.version, [1.0, 0.0], 'q', 'old answer', []))
+
+    lookup = ask(cache, [1.0, 0.0])
+    assert (lookup.version, lookup.answer) == (1, None)
+    assert cache.redis.data['answer_cache:1:entries'] == {}
+
+    asyncio.run(cache.put(1, lookup.version, [1.0, 0.0], 'q', 'new answer', []))
+    assert ask(cache, [1.0, 0.0]).answer == 'new answer'
+
+
+def test_least_recently_used_entries_are_evicted(redis):
+    cache = AnswerCache(redis, max_entries=2)
+    for i, embedding in enumerate(([1.0, 0.0, 0.0], [0.0, 1.0, 0.0])):
+        asyncio.run(cache.put(1, 0, embedding, f'q{i}', f'a{i}', []))
+    # Using the first entry makes the second the least recently used
+    assert ask(cache, [1.0, 0.0, 0.0]).answer == 'a0'
+    asyncio.run(cache.put(1, 0, [0.0, 0.0, 1.0], 'q2', 'a2', []))
+
+    assert ask(cache, [0.0, 1.0, 0.0]).answer is None
+    assert ask(cache, [1.0, 0.0, 0.0]).answer == 'a0'
+    assert ask(cache, [0.0, 0.0, 1.0]).answer == 'a2'
+    assert len(cache.redis.data['answer_cache:1:vectors']) == 2
+
+
+def test_redis_errors_are_misses(broken_redis):
+    cache = AnswerCache(broken_redis)
+    assert ask(cache, [1.0]).answer is None
+    asyncio.run(cache.put(1, 0, [1.0], 'q', 'a', []))
+    asyncio.run(cache.invalidate(1))
+    # Disabled without Redis
+    assert ask(AnswerCache(None), [1.0]).answer is None
@@ -8,6 +8,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from tortoise import Tortoise
 from tortoise.exceptions import ConfigurationError
+from generate_schema import init
 from models import TelegramUser, Note
 from backend import upload_notes_to_pinecone
 
@@ -22,11 +23,7 @@ TEST_USER_ID = os.getenv('TEST_USER_ID')
 
 async def init_db():
     """Initialize Tortoise ORM."""
-    await Tortoise.init(
-        db_url='sqlite://db.sqlite3',  # Ensure this matches your actual database URL
-        modules={'models': ['models']}  # Correct module reference pointing to models.py
-    )
-    await Tortoise.generate_schemas()
+    await init()  # DB_URL from the environment, see generate_schema.py
     logger.info("Tortoise ORM initialized and schemas generated.")
 
 async def create_example_user():
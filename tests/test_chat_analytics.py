@@ -0,0 +1,64 @@
+import datetime
+
+import polars as pl
+
+from chat_analytics import analyze_chat, render_report
+
+START = datetime.datetime(2024, 3, 1, 12)
+
+
+def thread() -> pl.DataFrame:
+    """Parsed chat of one reply chain, every message answers the one before after `delay` seconds."""
+
+    delays = [0, 30, 120, 600, 2 * 60 * 60, 2 * 24 * 60 * 60, 30, 30]
+    dates, date = [], START
+    for delay in delays:
+        date += datetime.timedelta(seconds=delay)
+        dates.append(date)
+    return pl.DataFrame({
+        'chat_id': ['5'] * 8,
+        'msg_id': [str(msg_id) for msg_id in range(1, 9)],
+        'sender': ['Alice', 'Bob', 'Alice', 'Bob', 'Alice', 'Bob', 'Alice', 'Carol'],
+        'reply_to_msg_id': [''] + [str(msg_id) for msg_id in range(1, 8)],
+        'date': [date.strftime('%Y-%m-%dT%H:%M:%S') for date in dates],
+        'date_unixtime': [str(int(date.timestamp())) for date in dates],
+        'msg_type': ['text'] * 7 + ['photo'],
+        'msg_content': [f'message {msg_id}' for msg_id in range(1, 9)],
+        'forwarded_from': [''] * 7 + ['News'],
+        'has_mention': [0, 1, 0, 0, 0, 0, 0, 0],
+        'has_hashtag': [0] * 8,
+    })
+
+
+def test_overview_and_top_senders():
+    stats = analyze_chat(thread())
+
+    assert stats['overview'].row(0, named=True) == {
+        'messages': 8, 'senders': 3,
+        'date_from': START, 'date_to': START + datetime.timedelta(days=2, seconds=7200 + 750 + 60),
+        'replies': 7, 'forwarded': 1, 'mentions': 1, 'hashtags': 0,
+    }
+    assert stats['top_senders'].rows() == [('Alice', 4), ('Bob', 3), ('Carol', 1)]
+    assert stats['media'].rows() == [('text', 7), ('photo', 1)]
+
+
+def test_reply_depth_is_capped():
+    # Replies deeper than MAX_REPLY_DEPTH count as MAX_REPLY_DEPTH
+    assert analyze_chat(thread())['reply_depth'].rows() == [(1, 1), (2, 1), (3, 1), (4, 1), (5, 3)]
+
+
+def test_response_times():
+    stats = analyze_chat(thread())
+
+    assert stats['response_time']['median_s'].item() == 120
+    assert dict(stats['response_buckets'].iter_rows()) == {'< 1 мин': 3, '< 5 мин': 1, '< 1 ч': 1, '< 1 д': 1, '≥ 1 д': 1}
+
+
+def test_report():
+    report = render_report(analyze_chat(thread()), 'Work <b>')
+
+    assert 'Статистика чата «Work &lt;b&gt;»' in report
+    assert 'Сообщений: 8, участников: 3, период: 2024-03-01 — 2024-03-03' in report
+    assert 'Топ отправителей: Alice 50%, Bob 38%, Carol 12%' in report
+    assert 'Глубина веток: 1: 1, 2: 1, 3: 1, 4: 1, 5+: 3' in report
+    assert 'медиана 2 мин' in report
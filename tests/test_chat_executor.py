@@ -0,0 +1,113 @@
+import asyncio
+
+from chat_executor import KeyedExecutor
+
+
+def test_updates_of_a_key_run_in_order_one_at_a_time():
+
+    async def main():
+        executor = KeyedExecutor()
+        log = []
+
+        def handler(name, delay):
+            async def fn():
+                log.append(f'start {name}')
+                await asyncio.sleep(delay)
+                log.append(f'end {name}')
+                return name
+            return fn
+
+        results = await asyncio.gather(*(
+            executor.run('chat', handler(i, delay)) for i, delay in enumerate((0.03, 0.0, 0.01))
+        ))
+        return results, log, executor
+
+    results, log, executor = asyncio.run(main())
+    assert results == [0, 1, 2]
+    assert log == ['start 0', 'end 0', 'start 1', 'end 1', 'start 2', 'end 2']
+    assert executor.queues == {}
+
+
+def test_keys_run_concurrently_up_to_the_limit():
+
+    async def main():
+        executor = KeyedExecutor(max_concurrency=2)
+        running, peak = 0, 0
+
+        async def fn():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+
+        await asyncio.gather(*(executor.run(key, fn) for key in range(5)))
+        return peak, executor.stats()
+
+    peak, stats = asyncio.run(main())
+    assert peak == 2
+    assert stats['wait_count'] == 5 and stats['active_keys'] == 0
+
+
+def test_handler_failure_reaches_its_caller_only():
+
+    async def main():
+        executor = KeyedExecutor()
+
+        async def fail():
+            raise ValueError('broken update')
+
+        async def ok():
+            return 'next'
+
+        return await asyncio.gather(executor.run('chat', fail), executor.run('chat', ok), return_exceptions=True)
+
+    failed, result = asyncio.run(main())
+    assert isinstance(failed, ValueError)
+    assert result == 'next'
+
+
+def test_cancelled_handler_cancels_its_caller_and_the_chat_goes_on():
+
+    async def main():
+        executor = KeyedExecutor()
+
+        async def cancelled():
+            task = asyncio.create_task(asyncio.sleep(1))
+            task.cancel()
+            await task
+
+        async def ok():
+            return 'next'
+
+        return await asyncio.gather(executor.run('chat', cancelled), executor.run('chat', ok), return_exceptions=True)
+
+    cancelled, result = asyncio.run(main())
+    assert isinstance(cancelled, asyncio.CancelledError)
+    assert result == 'next'
+
+
+def test_cancelled_drainer_cancels_the_queued_updates():
+
+    async def main():
+        executor = KeyedExecutor()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(1)
+
+        async def ok():
+            return 'never'
+
+        callers = [asyncio.create_task(executor.run('chat', fn)) for fn in (slow, ok)]
+        await started.wait()
+        for drainer in executor.drainers:
+            drainer.cancel()
+        results = await asyncio.wait_for(asyncio.gather(*callers, return_exceptions=True), 1)
+        return results, executor
+
+    results, executor = asyncio.run(main())
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert executor.queues == {}
+
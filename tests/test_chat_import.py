@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import polars as pl
+import pytest
+from langchain_pinecone.vectorstores import Pinecone
+
+import backend
+from import_archive import ImportArchive
+from pinecone_maintenance import Target, forget_embedded
+from term_stats import TermStatsIndex
+
+START = datetime.datetime(2024, 3, 1, 12)
+
+
+def export(messages: dict[int, tuple[int, str]]) -> pl.DataFrame:
+    """Parsed export of chat 5, msg_id -> (minutes after START, text)."""
+
+    dates = [START + datetime.timedelta(minutes=minutes) for minutes, _ in messages.values()]
+    return pl.DataFrame({
+        'chat_id': [5] * len(messages),
+        'msg_id': list(messages),
+        'sender': ['Alice'] * len(messages),
+        'sender_id': ['user1'] * len(messages),
+        'date': [date.strftime('%Y-%m-%dT%H:%M:%S') for date in dates],
+        'date_unixtime': [str(int(date.timestamp())) for date in dates],
+        'msg_type': ['text'] * len(messages),
+        'msg_content': [text for _, text in messages.values()],
+    })
+
+
+@pytest.fixture
+def index(pinecone_index, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    index = pinecone_index
+    monkeypatch.setattr(Pinecone, 'afrom_documents', index.afrom_documents)
+    monkeypatch.setattr(backend, 'get_pinecone_index', lambda index_name: index)
+    monkeypatch.setattr(backend, 'get_embeddings', lambda: None)
+    return index
+
+
+def user() -> SimpleNamespace:
+
+    async def save():
+        pass
+
+    async def values(*fields):
+        return []
+
+    notes = SimpleNamespace(filter=lambda **kwargs: SimpleNamespace(values=values))
+    return SimpleNamespace(telegram_id=1, first_name='Alice', index_name='saved-ai-1', vector_storage_namespace='user_1_notes', save=save, notes=notes)
+
+
+def upload(df: pl.DataFrame):
+    return asyncio.run(backend.upload_exported_chat_to_pinecone(user(), df, 'Work'))
+
+
+# Three conversations, hours apart: 1-3, 10-18, 20
+FIRST = {
+    **{msg_id: (msg_id, f'morning {msg_id}') for msg_id in (1, 2, 3)},
+    **{msg_id: (120 + msg_id, f'plan {msg_id}') for msg_id in range(10, 19)},
+    20: (300, 'evening 20'),
+}
+
+
+def test_reimport_rewindows_edited_and_appended_messages(index):
+    upload(export(FIRST))
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_1_0', 'chat_5_20_0']
+    index.upserted.clear()
+
+    # Message 10 edited, message 21 appended to the last conversation
+    summary = upload(export({**FIRST, 10: (130, 'plan 10 edited'), 21: (301, 'evening 21')}))
+
+    assert (summary.new, summary.edited) == (1, 1)
+    assert sorted(index.upserted) == ['chat_5_10_0', 'chat_5_20_0']
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_1_0', 'chat_5_20_0']
+    # The edited window still covers the unchanged messages after the edited one
+    assert index.vectors['chat_5_10_0'].metadata['msg_ids'] == [str(msg_id) for msg_id in range(10, 19)]
+    assert 'plan 10 edited' in index.vectors['chat_5_10_0'].metadata['text']
+    assert 'plan 18' in index.vectors['chat_5_10_0'].metadata['text']
+    assert index.vectors['chat_5_20_0'].metadata['msg_ids'] == ['20', '21']
+
+
+def test_reimport_takes_edited_messages_out_of_the_term_stats(index, tmp_path):
+    upload(export(FIRST))
+    term_stats = asyncio.run(backend.get_term_stats(user()))
+
+    upload(export({**FIRST, 10: (130, 'schedule 10'), 21: (301, 'evening 21')}))
+
+    # Updated in place like built from scratch over the archived chat
+    rebuilt = TermStatsIndex(2, str(tmp_path))
+    rebuilt.build(ImportArchive(1).scan(), pl.DataFrame(schema={'msg_content': pl.Utf8, 'sender': pl.Utf8, 'date': pl.Utf8}))
+    assert 'schedule' in term_stats.frequencies(source='work')
+    assert term_stats.frequencies(source='work') == pytest.approx(rebuilt.frequencies(source='work'))
+
+
+def test_reimport_deletes_replaced_windows(index):
+    upload(export(FIRST))
+
+    # Message 15 now replies to a message outside its window, the window splits in two
+    df = export({**FIRST, 15: (135, 'plan 15 edited')}).with_columns(
+        pl.when(pl.col('msg_id') == 15).then(pl.lit('2')).otherwise(None).alias('reply_to_msg_id')
+    )
+    upload(df)
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_15_0', 'chat_5_1_0', 'chat_5_20_0']
+
+    # The reply removed, the windows merge again and the split off one is deleted
+    upload(export({**FIRST, 15: (135, 'plan 15 edited again')}))
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_1_0', 'chat_5_20_0']
+    assert index.vectors['chat_5_10_0'].metadata['msg_ids'] == [str(msg_id) for msg_id in range(10, 19)]
+
+
+def test_reimport_of_chat_imported_before_the_window_index(index, tmp_path):
+    upload(export(FIRST))
+    (tmp_path / 'import_archive' / 'user_1' / 'windows.parquet').unlink()
+    # A window of an earlier import, overwritten since by a window of fresh messages only
+    index.add('chat_5_10_0', {'text': 'Alice: plan 10', 'msg_ids': ['10']})
+    index.add('chat_5_11_0', {'text': 'Alice: plan 11', 'msg_ids': ['11']})
+
+    upload(export({**FIRST, 21: (301, 'evening 21')}))
+
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_1_0', 'chat_5_20_0']
+    assert index.vectors['chat_5_10_0'].metadata['msg_ids'] == [str(msg_id) for msg_id in range(10, 19)]
+
+
+def test_reimport_after_deleting_the_chat(index):
+    upload(export(FIRST))
+
+    index.vectors.clear()
+    forget_embedded(Target('saved-ai-1', 'user_1_notes', 3), {'Work'})
+
+    summary = upload(export(FIRST))
+    assert (summary.new, summary.unchanged) == (len(FIRST), 0)
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_1_0', 'chat_5_20_0']
+
+
+def test_reimport_after_deleting_the_namespace(index):
+    upload(export(FIRST))
+
+    index.vectors.clear()
+    forget_embedded(Target('saved-ai-1', 'user_1_notes', 3))
+
+    summary = upload(export({**FIRST, 21: (301, 'evening 21')}))
+    assert (summary.new, summary.unchanged) == (len(FIRST) + 1, 0)
+    assert sorted(index.vectors) == ['chat_5_10_0', 'chat_5_1_0', 'chat_5_20_0']
@@ -0,0 +1,94 @@
+import datetime
+
+import polars as pl
+from langchain_core.documents import Document
+
+from chunking import TokenChunker, count_tokens, window_conversation
+
+START = datetime.datetime(2024, 3, 1, 12)
+
+
+def sentences(n: int, words: int = 12) -> str:
+    return ' '.join(f'Sentence {i} ' + ' '.join(['word'] * words) + '.' for i in range(n))
+
+
+def chat(rows: list[tuple]) -> pl.DataFrame:
+    """Parsed chat from (msg_id, minutes after START, sender, text, reply_to_msg_id) rows."""
+
+    dates = [START + datetime.timedelta(minutes=minutes) for _, minutes, *_ in rows]
+    return pl.DataFrame({
+        'chat_id': ['5'] * len(rows),
+        'msg_id': [row[0] for row in rows],
+        'sender': [row[2] for row in rows],
+        'sender_id': [f'user_{row[2]}' for row in rows],
+        'reply_to_msg_id': [str(row[4]) if row[4] else '' for row in rows],
+        'date': [date.strftime('%Y-%m-%dT%H:%M:%S') for date in dates],
+        'date_unixtime': [str(int(date.timestamp())) for date in dates],
+        'msg_type': ['text'] * len(rows),
+        'msg_content': [row[3] for row in rows],
+        'forwarded_from': [''] * len(rows),
+    })
+
+
+def test_short_text_is_one_chunk():
+    assert TokenChunker(max_tokens=50).split_text('A short note.') == ['A short note.']
+
+
+def test_long_text_is_split_on_sentences_within_the_budget():
+    chunker = TokenChunker(max_tokens=60, overlap_tokens=20)
+    text = sentences(10)
+    chunks = chunker.split_text(text)
+
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 60 for chunk in chunks)
+    assert all(chunk.startswith('Sentence') and chunk.endswith('.') for chunk in chunks)
+    # Consecutive chunks share the last whole sentence
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.split('.')[0] + '.' in previous
+    assert 'Sentence 9 ' in chunks[-1]
+
+
+def test_sentence_over_the_budget_is_split_on_tokens():
+    chunks = TokenChunker(max_tokens=20, overlap_tokens=0).split_text(' '.join(['word'] * 100))
+    assert len(chunks) == 5
+    assert all(count_tokens(chunk) <= 20 for chunk in chunks)
+
+
+def test_split_documents_records_tokens_and_stats():
+    documents = [Document(page_content='A short note.', metadata={'source': 1}), Document(page_content=sentences(10), metadata={'source': 2})]
+    chunks, stats = TokenChunker(max_tokens=60).split_documents(documents)
+
+    assert chunks[0].metadata == {'source': 1, 'tokens': count_tokens('A short note.')}
+    assert {chunk.metadata['source'] for chunk in chunks[1:]} == {2}
+    assert (stats.documents, stats.chunks, stats.split_documents) == (2, len(chunks), 1)
+    assert stats.tokens == sum(chunk.metadata['tokens'] for chunk in chunks)
+
+
+def test_window_conversation_splits_on_gaps_and_replies():
+    df = chat([
+        (1, 0, 'Alice', 'lunch?', None),
+        (2, 1, 'Bob', 'sure', None),
+        # An hour later, but replying into the first window
+        (3, 61, 'Alice', 'still on?', 2),
+        (4, 200, 'Bob', 'new topic', None),
+        # Replies to a message outside the current window
+        (5, 201, 'Alice', 'about lunch', 1),
+    ])
+    windows = window_conversation(df, 'Work')
+
+    assert windows['msg_ids'].to_list() == [['1', '2', '3'], ['4'], ['5']]
+    first = windows.row(0, named=True)
+    assert first['text'] == 'Alice: lunch?\nBob: sure\nAlice: still on?\nFrom the chat: Work'
+    assert (first['date'], first['date_end']) == ('2024-03-01T12:00:00', '2024-03-01T13:01:00')
+    assert first['date_end_unix'] - first['date_unix'] == 61 * 60
+    assert first['sender_ids'] == ['user_Alice', 'user_Bob']
+    assert first['msg_types'] == ['text']
+    assert windows['chat_id'].to_list() == ['5'] * 3
+
+
+def test_window_conversation_limits_turns_and_tokens():
+    turns = chat([(i, i, 'Alice' if i % 2 else 'Bob', f'message {i}', None) for i in range(1, 8)])
+    assert window_conversation(turns, 'Work', max_turns=2)['msg_ids'].to_list() == [['1', '2', '3'], ['4', '5', '6'], ['7']]
+
+    long = chat([(i, i, 'Alice', 'word ' * 30, None) for i in range(1, 4)])
+    assert window_conversation(long, 'Work', max_tokens=70)['msg_ids'].to_list() == [['1', '2'], ['3']]
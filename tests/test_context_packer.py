@@ -0,0 +1,72 @@
+from langchain_core.documents import Document
+
+from chunking import count_tokens
+from context_packer import adaptive_k, pack_context, remove_seen
+
+FOOTER = '\nFrom the chat: Work'
+
+
+def doc(text: str, source: int) -> Document:
+    return Document(page_content=text, metadata={'source': source})
+
+
+def long_line(i: int, words: int = 40) -> str:
+    return f'Alice: line {i} ' + ' '.join(f'w{i}x{j}' for j in range(words))
+
+
+def test_adaptive_k_stops_at_the_first_large_drop():
+    assert adaptive_k([0.9, 0.89, 0.7, 0.69]) == 2
+    assert adaptive_k([0.9, 0.6, 0.59], min_k=2) == 3
+    assert adaptive_k([0.9, 0.89, 0.88]) == 3
+    assert adaptive_k([]) == 0
+
+
+def test_remove_seen_drops_repeated_long_sentences_only():
+    seen = set()
+    assert remove_seen('The meeting moved to Friday afternoon. Ok. See you.', seen) == 'The meeting moved to Friday afternoon. Ok. See you.'
+    assert remove_seen('Ok. The meeting  moved to friday afternoon. New plan for the weekend trip.', seen) == 'Ok. New plan for the weekend trip.'
+
+
+def test_pack_keeps_relevance_order_and_drops_duplicates():
+    shared = 'We agreed to book the train tickets on Monday.'
+    packed = pack_context([
+        (doc(f'Less relevant note. {shared}', 2), 0.80),
+        (doc(f'{shared} The hotel is near the station.', 1), 0.82),
+        (doc(shared, 3), 0.81),
+    ])
+
+    assert [d.metadata['source'] for d in packed.documents] == [1, 2]
+    assert packed.documents[1].page_content == 'Less relevant note.'
+    assert packed.documents[0].metadata['score'] == 0.82
+    assert packed.duplicates == 1
+    assert packed.tokens < packed.retrieved_tokens
+
+
+def test_pack_cuts_repeated_footers_before_documents():
+    results = [(doc(long_line(i) + FOOTER, i), 0.9 - i * 0.01) for i in range(3)]
+    full = sum(count_tokens(d.page_content) for d, _ in results) + 2
+    footer_tokens = count_tokens(FOOTER)
+
+    packed = pack_context(results, max_tokens=full - footer_tokens)
+
+    assert len(packed.documents) == 3
+    assert packed.documents[0].page_content.endswith(FOOTER)
+    assert packed.footers_cut >= 1 and packed.over_budget == 0
+    assert packed.tokens <= full - footer_tokens
+
+
+def test_pack_drops_least_relevant_documents_over_the_budget():
+    results = [(doc(long_line(i), i), 0.9 - i * 0.01) for i in range(4)]
+    budget = count_tokens(long_line(0)) * 2 + 1
+
+    packed = pack_context(results, max_tokens=budget)
+
+    assert [d.metadata['source'] for d in packed.documents] == [0, 1]
+    assert packed.over_budget == 2
+    assert packed.tokens <= budget
+
+
+def test_pack_truncates_a_single_document_over_the_budget():
+    packed = pack_context([(doc(long_line(0, words=200), 0), 0.9)], max_tokens=50)
+    assert packed.tokens == 50
+    assert count_tokens(packed.documents[0].page_content) <= 50
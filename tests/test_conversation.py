@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+from conversation import KEEP_TURNS, Conversation
+
+
+class FakeLLM:
+
+    def __init__(self, fail: bool = False):
+        self.fail, self.prompts = fail, []
+
+    async def ainvoke(self, prompt, config=None):
+        self.prompts.append(prompt)
+        if self.fail:
+            raise RuntimeError('rate limited')
+        return SimpleNamespace(content='they talked about the trip')
+
+
+def long_conversation(turns: int) -> Conversation:
+    conversation = Conversation(context='notes')
+    for i in range(turns):
+        conversation.add(f'question {i} ' + 'word ' * 50, f'answer {i} ' + 'word ' * 50)
+    return conversation
+
+
+def test_round_trips_through_fsm_data():
+    conversation = long_conversation(2)
+    conversation.summary = 'earlier'
+    assert Conversation.from_dict(conversation.to_dict()) == conversation
+
+
+def test_messages_put_context_and_summary_into_the_system_prompt():
+    conversation = Conversation(context='notes', summary='earlier', turns=[('human', 'q'), ('ai', 'a')])
+    messages = conversation.messages('You answer.', 'next')
+    assert [message.type for message in messages] == ['system', 'human', 'ai', 'human']
+    assert messages[0].content == 'You answer.\nnotes\n\nSummary of the earlier conversation:\nearlier'
+    assert messages[-1].content == 'next'
+
+
+def test_compact_is_a_no_op_under_the_budget():
+    conversation, llm = long_conversation(2), FakeLLM()
+    before = conversation.to_dict()
+    assert asyncio.run(conversation.compact(llm, max_tokens=10_000)) is False
+    assert conversation.to_dict() == before
+    assert llm.prompts == []
+
+
+def test_compact_folds_older_turns_into_the_summary():
+    conversation, llm = long_conversation(5), FakeLLM()
+    kept = conversation.turns[-KEEP_TURNS:]
+    assert asyncio.run(conversation.compact(llm, max_tokens=500)) is True
+    assert conversation.summary == 'they talked about the trip'
+    assert conversation.turns == kept
+    assert 'question 0' in llm.prompts[0] and 'question 4' not in llm.prompts[0]
+
+
+def test_compact_drops_oldest_turns_when_summarizing_fails():
+    conversation = long_conversation(5)
+    assert asyncio.run(conversation.compact(FakeLLM(fail=True), max_tokens=100)) is True
+    assert conversation.summary == ''
+    assert len(conversation.turns) == 2
+    assert conversation.turns[0][1].startswith('question 4')
@@ -0,0 +1,105 @@
+import datetime
+
+import polars as pl
+
+from import_archive import ImportArchive, SeenIndex, WindowIndex, message_fingerprints
+
+
+def chat_frame(messages: dict[int, str], chat_id: int = 5) -> pl.DataFrame:
+    start = datetime.datetime(2024, 3, 1, 12)
+    return pl.DataFrame({
+        'chat_id': [chat_id] * len(messages),
+        'msg_id': list(messages),
+        'sender': ['Alice'] * len(messages),
+        'sender_id': ['user1'] * len(messages),
+        'date': [start + datetime.timedelta(minutes=msg_id) for msg_id in messages],
+        'msg_type': ['text'] * len(messages),
+        'msg_content': list(messages.values()),
+    })
+
+
+def test_add_chat_keeps_one_merged_snapshot(tmp_path):
+    archive = ImportArchive(1, str(tmp_path))
+    archive.add_chat(chat_frame({1: 'a', 2: 'b', 3: 'c'}), 'Work')
+    archive.add_chat(chat_frame({9: 'other'}, chat_id=6), 'Home')
+    # A later export: message 2 edited, message 4 appended, message 1 no longer exported
+    entry = archive.add_chat(chat_frame({2: 'b2', 3: 'c', 4: 'd'}), 'Work')
+
+    assert [e['chat_name'] for e in archive.load_manifest()] == ['Home', 'Work']
+    assert entry['rows'] == 4
+    assert sorted(p.name for p in (tmp_path / 'user_1').glob('*.parquet')) == sorted(e['file'] for e in archive.load_manifest())
+
+    work = archive.scan('Work').collect()
+    assert work['msg_id'].to_list() == [1, 2, 3, 4]
+    assert work['msg_content'].to_list() == ['a', 'b2', 'c', 'd']
+    assert work['chat_name'].unique().to_list() == ['Work']
+
+
+def test_seen_index_classifies_new_edited_and_unchanged_messages(tmp_path):
+    seen = SeenIndex(1, str(tmp_path))
+    keys, hashes = message_fingerprints(chat_frame({1: 'a', 2: 'b', 3: 'c'}), 'Work')
+    new, edited = seen.classify(keys, hashes)
+    assert new.all() and not edited.any()
+
+    seen.add(keys, hashes)
+    seen.save()
+    seen = SeenIndex(1, str(tmp_path))
+    assert len(seen) == 3
+
+    keys, hashes = message_fingerprints(chat_frame({2: 'b', 3: 'c2', 4: 'd'}), 'Work')
+    new, edited = seen.classify(keys, hashes)
+    assert new.tolist() == [False, False, True]
+    assert edited.tolist() == [False, True, False]
+
+
+def test_seen_index_keys_messages_by_chat(tmp_path):
+    seen = SeenIndex(1, str(tmp_path))
+    seen.add(*message_fingerprints(chat_frame({1: 'a'}, chat_id=5), 'Work'))
+
+    # The same msg_id in another chat, or in an export without a chat id, is another message
+    new, _ = seen.classify(*message_fingerprints(chat_frame({1: 'a'}, chat_id=6), 'Work'))
+    assert new.tolist() == [True]
+    new, _ = seen.classify(*message_fingerprints(chat_frame({1: 'a'}).with_columns(pl.lit(None).alias('chat_id')), 'Work'))
+    assert new.tolist() == [True]
+
+
+def test_seen_index_keeps_the_newest_hash(tmp_path):
+    seen = SeenIndex(1, str(tmp_path))
+    seen.add(*message_fingerprints(chat_frame({1: 'a', 2: 'b'}), 'Work'))
+    seen.add(*message_fingerprints(chat_frame({2: 'b2'}), 'Work'))
+    assert len(seen) == 2
+
+    _, edited = seen.classify(*message_fingerprints(chat_frame({1: 'a', 2: 'b2'}), 'Work'))
+    assert not edited.any()
+
+
+def test_seen_index_remove(tmp_path):
+    seen = SeenIndex(1, str(tmp_path))
+    keys, hashes = message_fingerprints(chat_frame({1: 'a', 2: 'b', 3: 'c'}), 'Work')
+    seen.add(keys, hashes)
+
+    seen.remove(keys[:2])
+    new, _ = seen.classify(keys, hashes)
+    assert new.tolist() == [True, True, False]
+
+    seen.remove()
+    assert len(seen) == 0
+
+
+def test_window_index(tmp_path):
+    windows = WindowIndex(1, str(tmp_path))
+    assert windows.stored('5') is None
+
+    windows.replace('5', ['chat_5_1_0', 'chat_5_4_0'], [1, 2])
+    windows.replace('6', ['chat_6_1_0'], [3])
+    windows.replace('5', ['chat_5_1_0'], [4])
+    windows.save()
+
+    windows = WindowIndex(1, str(tmp_path))
+    assert windows.stored('5') == {'chat_5_1_0': 4}
+    assert windows.stored('6') == {'chat_6_1_0': 3}
+
+    windows.remove({'5'})
+    assert windows.stored('5') is None and windows.stored('6') is not None
+    windows.remove()
+    assert windows.stored('6') is None
@@ -0,0 +1,116 @@
+import time
+import asyncio
+
+import pytest
+from langchain_core.documents import Document
+
+import inline_search
+from inline_search import InlineSearch
+
+
+def documents(*sources: int) -> list[Document]:
+    return [Document(page_content=f'note {source}', metadata={'source': source}) for source in sources]
+
+
+@pytest.fixture(autouse=True)
+def short_debounce(monkeypatch):
+    monkeypatch.setattr(inline_search, 'INLINE_DEBOUNCE', 0.01)
+
+
+@pytest.mark.parametrize('with_redis', [True, False])
+def test_only_the_last_query_typed_is_settled(redis, with_redis):
+    search = InlineSearch(redis if with_redis else None)
+
+    async def main():
+        await search.start(1, 'q1', 'app')
+        await search.start(1, 'q2', 'appl')
+        # Queries of other users don't supersede
+        await search.start(2, 'q3', 'pear')
+        return await search.settled(1, 'q1'), await search.settled(1, 'q2'), await search.settled(2, 'q3')
+
+    assert asyncio.run(main()) == (False, True, True)
+
+
+def test_cached_query_and_longest_cached_prefix(redis):
+    search = InlineSearch(redis)
+
+    async def main():
+        await search.store(1, 'app', documents(1))
+        await search.store(1, 'apple', documents(2))
+        return (
+            await search.start(1, 'q1', 'apple'),
+            await search.start(1, 'q2', 'apple pie'),
+            await search.start(1, 'q3', 'banana'),
+        )
+
+    exact, prefix, miss = asyncio.run(main())
+    assert exact == (documents(2), None)
+    assert prefix == (None, documents(2))
+    assert miss == (None, None)
+
+
+def test_search_past_the_deadline_is_answered_with_the_fallback(redis):
+    search = InlineSearch(redis)
+
+    async def run():
+        await asyncio.sleep(0.05)
+        return documents(3)
+
+    async def main():
+        found = await search.search(1, 'q1', 'apple pie', run, deadline=time.monotonic() + 0.01, fallback=documents(2))
+        # The search keeps running and fills the cache
+        await asyncio.gather(*search.tasks)
+        return found, await search.start(1, 'q2', 'apple pie')
+
+    found, (cached, _) = asyncio.run(main())
+    assert found == (documents(2), False)
+    assert cached == documents(3)
+
+
+def test_search_within_the_deadline(redis):
+    search = InlineSearch(redis)
+
+    async def run():
+        return documents(3)
+
+    async def main():
+        await search.start(1, 'q1', 'apple')
+        return await search.search(1, 'q1', 'apple', run, deadline=time.monotonic() + 1)
+
+    assert asyncio.run(main()) == (documents(3), True)
+    assert search.pending == {} and search.semaphores == {}
+
+
+def test_query_superseded_while_waiting_for_a_search_slot(redis):
+    search = InlineSearch(redis)
+    searched = []
+
+    async def run(query):
+        searched.append(query)
+        await asyncio.sleep(0.02)
+        return documents(len(query))
+
+    async def main():
+        await search.start(1, 'q1', 'apple')
+        first = asyncio.create_task(search.search(1, 'q1', 'apple', lambda: run('apple'), deadline=time.monotonic() + 1))
+        await asyncio.sleep(0)
+        await search.start(1, 'q2', 'apple pie')
+        return await asyncio.gather(first, search.search(1, 'q1', 'apple', lambda: run('apple again'), deadline=time.monotonic() + 1))
+
+    assert asyncio.run(main()) == [(documents(5), True), None]
+    assert searched == ['apple']
+
+
+def test_invalidate_drops_the_cached_results(redis, broken_redis):
+    search = InlineSearch(redis)
+
+    async def main():
+        await search.store(1, 'apple', documents(1))
+        await search.store(2, 'apple', documents(2))
+        await search.invalidate(1)
+        return await search.start(1, 'q1', 'apple'), await search.start(2, 'q2', 'apple')
+
+    assert asyncio.run(main()) == ((None, None), (documents(2), None))
+    # Redis errors are misses
+    assert asyncio.run(InlineSearch(broken_redis).start(1, 'q1', 'apple')) == (None, None)
+    asyncio.run(InlineSearch(broken_redis).invalidate(1))
@@ -0,0 +1,51 @@
+import sys
+import time
+import asyncio
+import logging
+
+import tracing
+from loop_monitor import LoopMonitor, blocking_site
+from tracing import TraceSink, trace
+
+
+def parse_synchronously():
+    time.sleep(0.3)
+
+
+def test_stall_is_reported_at_the_blocking_site(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(tracing, 'SINK', TraceSink(str(tmp_path / 'traces.jsonl')))
+    monitor = LoopMonitor(interval=0.01, threshold=0.05)
+
+    async def handler():
+        with trace('update', user_id=7, handler='cmd_cloud'):
+            parse_synchronously()
+
+    async def main():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        await asyncio.create_task(handler())
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    with caplog.at_level(logging.WARNING, logger='loop_monitor'):
+        asyncio.run(main())
+
+    assert monitor.stats()['stalls'] == {'test_loop_monitor.py:parse_synchronously': 1}
+    assert monitor.max_lag >= 0.2
+    [record] = caplog.records
+    assert 'at test_loop_monitor.py:parse_synchronously (handler cmd_cloud, user 7)' in record.getMessage()
+    assert 'time.sleep(0.3)' in record.getMessage()
+
+
+def test_stall_shorter_than_a_watchdog_period_is_unknown():
+    monitor = LoopMonitor()
+    monitor._report(0.3)
+    assert monitor.stats()['stalls'] == {'unknown': 1}
+
+
+def test_blocking_site_is_the_innermost_frame_of_the_project():
+    # A frame of a library called from here
+    frame = eval(compile('sys._getframe()', '/usr/lib/python3/site-packages/library.py', 'eval'))
+
+    assert blocking_site(frame) == 'test_loop_monitor.py:test_blocking_site_is_the_innermost_frame_of_the_project'
+    assert blocking_site(None) == 'unknown'
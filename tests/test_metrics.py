@@ -0,0 +1,25 @@
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+import metrics
+
+
+def test_metrics_are_served_in_the_prometheus_text_format():
+    response = asyncio.run(metrics.metrics_handler(make_mocked_request('GET', '/metrics')))
+
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    assert 'X-Content-Type' not in response.headers
+    assert b'# TYPE' in response.body
+
+
+def test_token_use_is_logged_per_user_not_labelled(caplog):
+    token = metrics.current_user.set(42)
+    try:
+        with caplog.at_level('INFO', logger='metrics'):
+            metrics.record_openai_usage('gpt-4o-mini', {'prompt_tokens': 100, 'completion_tokens': 20})
+    finally:
+        metrics.current_user.reset(token)
+
+    assert 'OpenAI usage of user 42: 100 prompt and 20 completion tokens of gpt-4o-mini' in caplog.text
+    assert 'user="42"' not in metrics.REGISTRY.render()
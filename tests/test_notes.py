@@ -0,0 +1,65 @@
+import time
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import backend
+
+
+@pytest.fixture
+def tokyo_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'Asia/Tokyo')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_note_dates_are_utc_whatever_the_local_timezone(tokyo_time):
+    # created_at comes from Tortoise as naive UTC
+    note = SimpleNamespace(telegram_message_id=7, text='buy apples', created_at=datetime.datetime(2024, 3, 1, 12))
+
+    async def all_notes():
+        return [note]
+
+    user = SimpleNamespace(notes=SimpleNamespace(filter=lambda **kwargs: SimpleNamespace(all=all_notes)))
+    [doc] = asyncio.run(backend.get_docs_from_not_uploaded_notes(user))
+
+    expected = int(datetime.datetime(2024, 3, 1, 12, tzinfo=datetime.timezone.utc).timestamp())
+    assert doc.metadata['date_unix'] == doc.metadata['date_end_unix'] == expected
+    assert doc.metadata['source'] == 7
+
+
+def test_note_saved_during_the_upload_waits_for_the_next_one(pinecone_index, tmp_path, monkeypatch):
+    from langchain_pinecone.vectorstores import Pinecone
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backend, 'get_embeddings', lambda: None)
+    notes = [SimpleNamespace(id=1, telegram_message_id=7, text='buy apples', created_at=datetime.datetime(2024, 3, 1, 12), is_vectorized=False)]
+
+    async def afrom_documents(documents, ids=None, **kwargs):
+        # The user saves another note while the first one is embedded
+        notes.append(SimpleNamespace(id=2, telegram_message_id=8, text='buy pears', created_at=datetime.datetime(2024, 3, 1, 13), is_vectorized=False))
+        await pinecone_index.afrom_documents(documents, [f'note_{doc.metadata["source"]}' for doc in documents])
+
+    monkeypatch.setattr(Pinecone, 'afrom_documents', afrom_documents)
+
+    def notes_filter(is_vectorized=None, id__in=None):
+        selected = [note for note in notes if note.is_vectorized is is_vectorized or note.id in (id__in or ())]
+
+        async def all_notes():
+            return list(selected)
+
+        async def update(is_vectorized):
+            for note in selected:
+                note.is_vectorized = is_vectorized
+
+        return SimpleNamespace(all=all_notes, update=update)
+
+    user = SimpleNamespace(telegram_id=1, first_name='Test', index_name='saved-ai-1', vector_storage_namespace='user_1_notes', notes=SimpleNamespace(filter=notes_filter))
+    asyncio.run(backend.upload_notes_to_pinecone(user))
+
+    assert sorted(pinecone_index.vectors) == ['note_7']
+    assert [note.is_vectorized for note in notes] == [True, False]
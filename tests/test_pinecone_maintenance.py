@@ -0,0 +1,66 @@
+import polars as pl
+
+import pinecone_maintenance
+from import_archive import ImportArchive
+from pinecone_maintenance import PineconeMaintenance, Target
+
+
+def test_backfill_upserts_merged_metadata_in_batches(pinecone_index, tmp_path, monkeypatch):
+    monkeypatch.setattr(pinecone_maintenance, 'UPSERT_BATCH_SIZE', 2)
+    monkeypatch.setattr(pinecone_maintenance, 'Pinecone', lambda api_key: None)
+
+    async def load_note_dates(telegram_ids):
+        return {1: {10: 1700000000, 11: 1700000100, 12: 1700000200}}
+
+    monkeypatch.setattr(pinecone_maintenance, 'load_note_dates', load_note_dates)
+    monkeypatch.chdir(tmp_path)
+
+    index = pinecone_index
+    index.add_many({
+        'note_10': {'source': 10, 'text': 'a'},
+        'note_11': {'source': 11, 'text': 'b'},
+        'note_12': {'source': 12, 'text': 'c'},
+        'note_13': {'source': 13, 'text': 'no longer in the database'},
+        'done': {'source': 14, 'date_unix': 1},
+        'chat_5_1_0': {'msg_ids': ['1'], 'chat_name': 'Work', 'date': '2024-03-01T12:00:00', 'date_end': '2024-03-01T12:05:00'},
+    })
+    maintenance = PineconeMaintenance(workers=4)
+    maintenance.indexes['saved-ai-1'] = index
+
+    assert maintenance.backfill([Target('saved-ai-1', 'user_1_notes', 6)]) == 4
+
+    assert sorted(len(batch) for batch in index.upserts) == [2, 2]
+    upserted = {record['id']: record for batch in index.upserts for record in batch}
+    assert set(upserted) == {'note_10', 'note_11', 'note_12', 'chat_5_1_0'}
+    assert upserted['note_11'] == {
+        'id': 'note_11', 'values': [1.0],
+        'metadata': {'source': 11, 'text': 'b', 'date_unix': 1700000100, 'date_end_unix': 1700000100, 'msg_types': ['note']},
+    }
+    assert upserted['chat_5_1_0']['metadata']['chat_id'] == '5'
+    assert upserted['chat_5_1_0']['metadata']['date_end_unix'] - upserted['chat_5_1_0']['metadata']['date_unix'] == 300
+
+
+def test_delete_chat_lists_its_vectors_by_id_prefix(pinecone_index, tmp_path, monkeypatch):
+    monkeypatch.setattr(pinecone_maintenance, 'Pinecone', lambda api_key: None)
+    monkeypatch.setattr(pinecone_maintenance, 'DELETE_BATCH_SIZE', 2)
+    monkeypatch.chdir(tmp_path)
+    ImportArchive(1).add_chat(pl.DataFrame({'chat_id': [5], 'msg_id': [1], 'msg_content': ['hi']}), 'Work')
+
+    index = pinecone_index
+    index.add_many({
+        'chat_5_1_0': {'chat_name': 'Work'},
+        'chat_5_9_0': {'chat_name': 'Work'},
+        'chat_5_9_1': {'chat_name': 'Work'},
+        'chat_6_1_0': {'chat_name': 'Home'},
+        'note_1': {'source': 1},
+    })
+    index.fetch = None  # ids alone tell the chat
+    maintenance = PineconeMaintenance(workers=4)
+    maintenance.indexes['saved-ai-1'] = index
+    target = Target('saved-ai-1', 'user_1_notes', 5)
+
+    assert maintenance.count([target], {'Work'}) == {('saved-ai-1', 'user_1_notes'): 3}
+    maintenance.delete([target], {'Work'})
+
+    assert sorted(index.vectors) == ['chat_6_1_0', 'note_1']
+    assert maintenance.stats.vectors == 3
@@ -0,0 +1,61 @@
+import asyncio
+
+import numpy as np
+from langchain_core.documents import Document
+
+from retrieval import collapse_key, fetch_candidates, mmr, select_distinct
+
+
+def test_fetch_candidates(pinecone_index):
+    index = pinecone_index
+    index.add('note_1', {'text': 'first', 'source': 1}, [1.0, 0.0], score=0.8)
+    index.add('broken', None, [0.0, 1.0], score=0.7)
+    index.add('chat_5_10_0', {'text': 'second', 'msg_ids': ['10']}, [0.0, 1.0])
+    docs, scores, vectors = asyncio.run(fetch_candidates(index, 'user_1_notes', [1.0, 0.0], 6, {'msg_types': {'$in': ['note']}}))
+
+    assert index.queries == [{
+        'vector': [1.0, 0.0], 'top_k': 6, 'include_values': True, 'include_metadata': True,
+        'namespace': 'user_1_notes', 'filter': {'msg_types': {'$in': ['note']}},
+    }]
+    assert [(doc.id, doc.page_content, doc.metadata) for doc in docs] == [
+        ('note_1', 'first', {'source': 1}),
+        ('chat_5_10_0', 'second', {'msg_ids': ['10']}),
+    ]
+    assert np.allclose(scores, [0.9, 0.5])
+    assert vectors.shape == (2, 2)
+
+
+def test_mmr_prefers_novel_candidates():
+    query = np.array([1.0, 0.0])
+    vectors = np.array([[1.0, 0.0], [0.99, 0.14], [0.7, 0.7]])
+    # Without the novelty term the near copy of the first pick comes second
+    assert mmr(query, vectors, 2, lambda_mult=1.0, duplicate_similarity=1.1) == [0, 1]
+    assert mmr(query, vectors, 2, lambda_mult=0.3, duplicate_similarity=1.1) == [0, 2]
+
+
+def test_mmr_drops_groups_and_copies_of_picks():
+    query = np.array([1.0, 0.0])
+    vectors = np.array([[1.0, 0.0], [0.9, 0.1], [1.0, 0.001], [0.0, 1.0]])
+    assert mmr(query, vectors, 4, groups=np.array([0, 0, 1, 2])) == [0, 3]
+    assert mmr(query, vectors[:0], 3) == []
+
+
+def test_collapse_key():
+    assert collapse_key(Document(page_content='a', metadata={'source': 7})) == ('note', 7)
+    assert collapse_key(Document(page_content='a', metadata={'chat_name': 'Work', 'msg_ids': ['10', '11']})) == ('window', 'Work', '10')
+    assert collapse_key(Document(page_content=' Same  Text ')) == collapse_key(Document(page_content='same text'))
+
+
+def test_select_distinct_collapses_chunks_of_a_note():
+    docs = [
+        Document(page_content='note 1, chunk 0', metadata={'source': 1}),
+        Document(page_content='note 1, chunk 1', metadata={'source': 1}),
+        Document(page_content='note 2', metadata={'source': 2}),
+        Document(page_content='unrelated', metadata={'source': 3}),
+    ]
+    scores = np.array([0.9, 0.85, 0.8, 0.3], dtype=np.float32)
+    vectors = np.array([[1.0, 0.0], [0.9, 0.3], [0.6, 0.8], [0.0, 1.0]], dtype=np.float32)
+
+    picked = select_distinct(docs, scores, vectors, [1.0, 0.0], 3, score_threshold=0.5)
+    assert [doc.metadata['source'] for doc, _ in picked] == [1, 2]
+    assert [score for _, score in picked] == [np.float32(0.9), np.float32(0.8)]
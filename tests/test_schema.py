@@ -7,6 +7,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import asyncio
 from tortoise import Tortoise
 from tortoise.exceptions import ConfigurationError
+from generate_schema import init
 from models import TelegramUser, Note, UserMessage
 import logging
 
@@ -16,12 +17,8 @@ logger = logging.getLogger(__name__)
 
 async def run_tests():
     try:
-        # Initialize Tortoise ORM with the correct module reference
-        await Tortoise.init(
-            db_url='sqlite://db.sqlite3',  # Ensure this matches your actual database URL
-            modules={'models': ['models']}  # Correct module reference pointing to models.py
-        )
-        await Tortoise.generate_schemas()
+        # Initialize Tortoise ORM with DB_URL from the environment, see generate_schema.py
+        await init()
         logger.info("Tortoise ORM initialized and schemas generated.")
 
         # **CREATE**
@@ -0,0 +1,79 @@
+import datetime
+
+import polars as pl
+import pytest
+
+from import_archive import ImportArchive
+from search_filters import SearchFilters, metadata_filter, parse_filters
+
+
+def archive(tmp_path) -> str:
+    chats = ImportArchive(1, str(tmp_path))
+    for chat_id, name, senders in ((5, 'Work Chat', ['Alice', 'Bob']), (6, 'Family', ['Mom'])):
+        chats.add_chat(pl.DataFrame({
+            'chat_id': [chat_id] * len(senders),
+            'msg_id': list(range(len(senders))),
+            'sender': senders,
+            'sender_id': [f'user_{sender}' for sender in senders],
+            'msg_content': ['hi'] * len(senders),
+        }), name)
+    return str(tmp_path)
+
+
+def test_parse_filters_takes_filters_out_of_the_query():
+    query, filters = parse_filters('trip plans chat="Work Chat" sender=bob from=2024-03-01 to=2024-03-31 type=Photo')
+
+    assert query == 'trip plans'
+    assert filters == SearchFilters('Work Chat', 'bob', datetime.date(2024, 3, 1), datetime.date(2024, 3, 31), 'photo')
+    assert parse_filters('no filters, a=b') == ('no filters, a=b', SearchFilters())
+    assert not SearchFilters()
+
+
+def test_parse_filters_rejects_malformed_dates():
+    with pytest.raises(ValueError):
+        parse_filters('from=March')
+
+
+def test_names_resolve_to_ids_case_insensitively(tmp_path):
+    root = archive(tmp_path)
+
+    assert metadata_filter(SearchFilters(chat='work'), 1, root) == {'chat_id': {'$in': ['5']}}
+    assert metadata_filter(SearchFilters(chat='Work', sender='BOB'), 1, root) == {'$and': [
+        {'chat_id': {'$in': ['5']}},
+        {'sender_ids': {'$in': ['user_Bob']}},
+    ]}
+    assert metadata_filter(SearchFilters(chat='Notes'), 1, root) == {'msg_types': {'$in': ['note']}}
+
+
+def test_unknown_names_raise_lookup_error(tmp_path):
+    root = archive(tmp_path)
+
+    with pytest.raises(LookupError, match='Office'):
+        metadata_filter(SearchFilters(chat='Office'), 1, root)
+    with pytest.raises(LookupError, match='Carol'):
+        metadata_filter(SearchFilters(sender='Carol'), 1, root)
+    # Nothing imported yet
+    with pytest.raises(LookupError):
+        metadata_filter(SearchFilters(chat='Work'), 2, root)
+
+
+def test_dates_match_overlapping_windows_in_utc(tmp_path):
+    day = datetime.date(2024, 3, 1)
+    start = int(datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+    assert metadata_filter(SearchFilters(date_from=day, date_to=day, msg_type='photo'), 1, str(tmp_path)) == {'$and': [
+        {'date_end_unix': {'$gte': start}},
+        {'date_unix': {'$lt': start + 24 * 60 * 60}},
+        {'msg_types': {'$in': ['photo']}},
+    ]}
+
+
+def test_chat_exported_without_an_id_is_matched_by_name(tmp_path):
+    root = archive(tmp_path)
+    ImportArchive(1, root).add_chat(pl.DataFrame({'msg_id': [1], 'sender': ['Boss'], 'msg_content': ['hi']}), 'Work Archive')
+
+    assert metadata_filter(SearchFilters(chat='Archive'), 1, root) == {'chat_name': {'$in': ['Work Archive']}}
+    assert metadata_filter(SearchFilters(chat='work'), 1, root) == {'$or': [
+        {'chat_id': {'$in': ['5']}},
+        {'chat_name': {'$in': ['Work Archive']}},
+    ]}
@@ -0,0 +1,42 @@
+import asyncio
+
+from langchain_core.documents import Document
+
+from search_pages import SearchPages
+
+
+def documents(n: int) -> list[Document]:
+    return [Document(page_content=f'note {i}', metadata={'source': i}) for i in range(n)]
+
+
+def test_pages_of_stored_results(redis):
+    pages = SearchPages(redis, ttl=60)
+    cursor = asyncio.run(pages.save(1, documents(7)))
+
+    assert redis.ttls == {f'search:1:{cursor}': 60}
+    first, total = asyncio.run(pages.page(1, cursor, 0, size=5))
+    assert total == 7
+    assert [doc.metadata['source'] for doc in first] == [0, 1, 2, 3, 4]
+    last, _ = asyncio.run(pages.page(1, cursor, 5, size=5))
+    assert last == documents(7)[5:]
+
+
+def test_expired_or_foreign_cursor_has_no_pages(redis):
+    pages = SearchPages(redis)
+    cursor = asyncio.run(pages.save(1, documents(3)))
+
+    # Cursors are per user
+    assert asyncio.run(pages.page(2, cursor, 0)) is None
+    # Expired
+    redis.data.clear()
+    assert asyncio.run(pages.page(1, cursor, 0)) is None
+
+
+def test_nothing_is_stored_without_results_or_redis(redis, broken_redis):
+    assert asyncio.run(SearchPages(redis).save(1, [])) is None
+    assert asyncio.run(SearchPages(None).save(1, documents(3))) is None
+    assert asyncio.run(SearchPages(None).page(1, 'cursor', 0)) is None
+
+    broken = SearchPages(broken_redis)
+    assert asyncio.run(broken.save(1, documents(3))) is None
+    assert asyncio.run(broken.page(1, 'cursor', 0)) is None
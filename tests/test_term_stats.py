@@ -0,0 +1,82 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import polars as pl
+
+import term_stats
+
+from import_archive import ImportArchive
+from term_stats import CHAT_KIND, NOTES_KIND, NOTES_SOURCE, TermStatsIndex
+
+
+def messages(texts: list[str], sender: str = 'Alice', day: str = '2024-03-01') -> pl.DataFrame:
+    return pl.DataFrame({'msg_content': texts, 'sender': [sender] * len(texts), 'date': [f'{day}T12:00:00'] * len(texts)})
+
+
+def built(tmp_path, chats: dict[str, list[str]] | None = None, notes: list[str] = ()) -> TermStatsIndex:
+    archive = ImportArchive(1, str(tmp_path))
+    for name, texts in (chats or {}).items():
+        archive.add_chat(messages(texts).with_columns(pl.int_range(pl.len()).alias('msg_id'), pl.lit(len(name)).alias('chat_id')), name)
+    index = TermStatsIndex(1, str(tmp_path))
+    index.build(archive.scan(), messages(list(notes)))
+    return index
+
+
+def test_ingest_is_skipped_until_the_index_is_built(tmp_path):
+    index = TermStatsIndex(1, str(tmp_path))
+    index.add(messages(['apples']), CHAT_KIND, 'Work')
+    assert not index.exists
+    assert index.frequencies() == {}
+
+
+def test_build_backfills_chats_and_notes(tmp_path):
+    index = built(tmp_path, {'Work Chat': ['deadline friday', 'deadline moved']}, notes=['buy apples'])
+
+    assert set(index.frequencies()) == {'deadline', 'friday', 'moved', 'buy', 'apples'}
+    assert set(index.frequencies(source=NOTES_SOURCE)) == {'buy', 'apples'}
+    assert set(index.frequencies(source='work')) == {'deadline', 'friday', 'moved'}
+    assert index.frequencies(source='home') == {}
+
+
+def test_chat_named_notes_is_not_the_notes(tmp_path):
+    index = built(tmp_path, {'notes': ['meeting agenda']}, notes=['buy apples'])
+
+    assert set(index.frequencies(source='Notes')) == {'buy', 'apples'}
+    assert set(index.frequencies()) == {'meeting', 'agenda', 'buy', 'apples'}
+
+
+def test_edited_message_counts_once(tmp_path):
+    index = built(tmp_path, {'Work': ['deadline friday']})
+    before = index.frequencies(source='Work')
+
+    index.remove(messages(['deadline friday']), CHAT_KIND, 'Work')
+    index.add(messages(['deadline monday']), CHAT_KIND, 'Work')
+    after = index.frequencies(source='Work')
+    assert set(after) == {'deadline', 'monday'}
+    assert after['deadline'] == before['deadline']
+
+    index.compact()
+    assert len(index._parts('terms')) == 1
+    assert index.frequencies(source='Work') == after
+
+
+def test_filters_by_sender_and_day(tmp_path):
+    index = built(tmp_path)
+    index.add(messages(['apples'], sender='Alice', day='2024-03-01'), NOTES_KIND)
+    index.add(messages(['pears'], sender='Bob', day='2024-03-05'), NOTES_KIND)
+
+    assert set(index.frequencies(sender='bob')) == {'pears'}
+    assert set(index.frequencies(date_to=datetime.date(2024, 3, 2))) == {'apples'}
+
+
+def test_concurrent_ingests_count_every_message_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(term_stats, 'COMPACT_AFTER_PARTS', 2)
+    index = built(tmp_path, notes=['start'])
+
+    # Imports ingest from threads, every few ingests one of them compacts
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: TermStatsIndex(1, str(tmp_path)).add(messages(['apples']), CHAT_KIND, 'Work'), range(40)))
+
+    index.compact()
+    docs = pl.read_parquet(index._parts('docs'))
+    assert docs.filter(pl.col('kind') == CHAT_KIND)['n_docs'].sum() == 40
@@ -0,0 +1,78 @@
+import asyncio
+
+import orjson
+import pytest
+
+import tracing
+from tracing import TraceSink, current_span, span, start_span, trace
+
+
+@pytest.fixture
+def sink(tmp_path, monkeypatch) -> TraceSink:
+    sink = TraceSink(str(tmp_path / 'traces.jsonl'))
+    monkeypatch.setattr(tracing, 'SINK', sink)
+    return sink
+
+
+def written(sink: TraceSink) -> list[dict]:
+    sink.flush()
+    with open(sink.path, 'rb') as f:
+        return [orjson.loads(line) for line in f.read().splitlines()]
+
+
+def test_spans_nest_through_the_current_span(sink):
+
+    async def step(name: str):
+        with span(name):
+            await asyncio.sleep(0)
+
+    async def handler():
+        with trace('update', user_id=1, handler='search') as root:
+            with span('backend', op='search'):
+                # Tasks copy the context, their spans are children of the span that started them
+                await asyncio.gather(step('embed'), step('query'))
+            with pytest.raises(ValueError), span('render'):
+                raise ValueError('boom')
+            assert current_span.get() is root
+        assert current_span.get() is None
+
+    asyncio.run(handler())
+
+    [data] = written(sink)
+    assert data['user_id'] == 1
+    assert [(item['id'], item['parent'], item['name']) for item in data['spans']] == [
+        (0, None, 'update'), (1, 0, 'backend'), (2, 1, 'embed'), (3, 1, 'query'), (4, 0, 'render'),
+    ]
+    assert data['spans'][0]['attributes'] == {'handler': 'search'}
+    assert data['spans'][4]['error'] == 'ValueError'
+
+
+def test_spans_outside_of_a_trace_are_not_recorded(sink):
+    assert start_span('job') is None
+    with span('job') as child:
+        assert child is None
+    sink.flush()
+    assert sink.last_trace(1) is None
+
+
+def test_sink_rotates_and_finds_the_last_trace_of_a_user(sink):
+    sink.max_bytes = 1
+    for user_id in (1, 2, 1, 3):
+        with trace('update', user_id=user_id, n=user_id):
+            pass
+        # One trace per flush, so each one finds the file over max_bytes
+        sink.flush()
+
+    assert [data['user_id'] for data in written(sink)] == [3]
+    assert sink.last_trace(3)['user_id'] == 3
+    # The previous file is searched too, older ones are gone
+    assert sink.last_trace(1)['spans'][0]['attributes'] == {'n': 1}
+    assert sink.last_trace(2) is None
+
+
+def test_traces_are_written_off_the_calling_thread(sink):
+    with trace('update', user_id=1):
+        pass
+
+    assert sink.writer is not None and sink.writer.is_alive()
+    assert sink.last_trace(1)['user_id'] == 1
@@ -0,0 +1,132 @@
+import os
+import asyncio
+import contextlib
+
+import orjson
+import pytest
+
+for name, value in (('TG_BOT_TOKEN', '123:abc'), ('OPENAI_API_KEY', 'sk-test'), ('PINECONE_API_KEY', 'test')):
+    os.environ.setdefault(name, value)
+
+import webhook
+
+
+def raw_update(update_id: int, chat_id: int = 42) -> bytes:
+    return orjson.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1700000000,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': f'note {update_id}',
+        },
+    })
+
+
+def make_server(redis, log):
+    server = webhook.UpdateServer.__new__(webhook.UpdateServer)
+    server.redis, server.tasks = redis, set()
+
+    async def process_update(update):
+        log.append(f'start {update.update_id}')
+        await asyncio.sleep(0.01)
+        log.append(f'end {update.update_id}')
+
+    server.process_update = process_update
+    return server
+
+
+def test_updates_of_a_chat_run_in_update_id_order_across_workers(redis):
+
+    async def main():
+        log = []
+        first, second = make_server(redis, log), make_server(redis, log)
+        # Updates of one chat reach two workers out of order
+        await second.enqueue(42, 3, raw_update(3))
+        await first.enqueue(42, 1, raw_update(1))
+        await second.enqueue(42, 2, raw_update(2))
+        await asyncio.gather(first.drain_chat(42), second.drain_chat(42), first.drain_chat(42))
+        return log
+
+    assert asyncio.run(main()) == ['start 1', 'end 1', 'start 2', 'end 2', 'start 3', 'end 3']
+    assert redis.data['chat_updates:42'] == {}
+
+
+def test_failed_update_does_not_block_the_chat(redis):
+
+    async def main():
+        log = []
+        server = make_server(redis, log)
+        handled = server.process_update
+
+        async def process_update(update):
+            await handled(update)
+            if update.update_id == 1:
+                raise RuntimeError('boom')
+
+        server.process_update = process_update
+        await server.enqueue(7, 1, raw_update(1, chat_id=7))
+        await server.enqueue(7, 2, raw_update(2, chat_id=7))
+        with contextlib.suppress(RuntimeError):
+            await server.drain_chat(7)
+        await server.run_chat(7)
+        return log
+
+    assert asyncio.run(main()) == ['start 1', 'end 1', 'start 2', 'end 2']
+    assert not redis.locks['chat_lock:7'].locked()
+
+
+def test_lock_is_extended_while_a_slow_update_is_handled(redis, monkeypatch):
+    monkeypatch.setattr(webhook, 'CHAT_LOCK_TIMEOUT', 0.03)
+    server = make_server(redis, [])
+
+    async def slow_update(update):
+        await asyncio.sleep(0.1)
+
+    server.process_update = slow_update
+
+    async def main():
+        await server.enqueue(42, 1, raw_update(1))
+        await server.drain_chat(42)
+
+    asyncio.run(main())
+    assert redis.extensions['chat_lock:42'] >= 2
+
+
+def test_waiting_worker_leaves_the_queue_to_the_lock_holder(redis, monkeypatch):
+    monkeypatch.setattr(webhook, 'CHAT_LOCK_WAIT', 0.01)
+    log = []
+    holder, waiter = make_server(redis, log), make_server(redis, log)
+
+    async def main():
+        lock = redis.lock('chat_lock:42')
+        await lock.acquire()
+        await waiter.enqueue(42, 1, raw_update(1))
+        await waiter.drain_chat(42)
+        assert log == []
+        await lock.release()
+        await holder.drain_chat(42)
+
+    asyncio.run(main())
+    assert log == ['start 1', 'end 1']
+
+
+@pytest.mark.parametrize('fails', [False, True])
+def test_failed_update_is_forgotten_by_the_deduplication(redis, monkeypatch, fails):
+    server = webhook.UpdateServer.__new__(webhook.UpdateServer)
+    server.redis = redis
+
+    async def feed_update(bot, update):
+        if fails:
+            raise RuntimeError('boom')
+
+    monkeypatch.setattr(webhook.dp, 'feed_update', feed_update)
+    update = webhook.types.Update.model_validate(orjson.loads(raw_update(5)))
+
+    async def main():
+        assert not await server.is_duplicate(5)
+        await server.process_update(update)
+        return await server.is_duplicate(5)
+
+    assert asyncio.run(main()) is not fails
@@ -1,12 +1,8 @@
+import io
 import re
-import os
 
-import numpy as np
 import polars as pl
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from wordcloud import WordCloud
-
 from parse_telegram_json_polars import parse_telegram_chat
 
 STOPWORDS = ['',
@@ -614,10 +610,16 @@ STOPWORDS = ['',
  'll']
 
 STOPWORDS += ['типа', 'кстати', 'знаю']
+STOPWORDS = frozenset(STOPWORDS)
+
+FILE_NOT_INCLUDED = '(File not included. Change data exporting settings to download.)'
+
+# Terms kept for the wordcloud, it only draws max_words of them anyway
+MAX_TERMS = 1000
 
 def clean_text(text, for_rf_idf=False):
 
-    text = text.replace('(File not included. Change data exporting settings to download.)', '')
+    text = text.replace(FILE_NOT_INCLUDED, '')
 
     # Clear characters other than numbers and letters of the alphabet only (english and russian)
     text = re.sub(r'[^A-Za-zА-Яа-яЁё: ]', '', text, flags=re.IGNORECASE)
@@ -627,19 +629,71 @@ def clean_text(text, for_rf_idf=False):
     
     return text
 
-def generate_wordcloud(df: pl.DataFrame, chat_name: str) -> str:
+def clean_text_expr(column: str = 'msg_content') -> pl.Expr:
+    """clean_text as a native Polars expression."""
+    return (
+        pl.col(column)
+        .fill_null('')
+        .str.replace_all(FILE_NOT_INCLUDED, '', literal=True)
+        .str.replace_all(r'[^A-Za-zА-Яа-яЁё: ]', '')
+    )
+
+def terms_expr(column: str = 'msg_content') -> pl.Expr:
+    """List of lowercase terms of every message, tokenized like TfidfVectorizer, stopwords included."""
+    return clean_text_expr(column).str.to_lowercase().str.extract_all(r'\w\w+')
+
+def term_frequencies(df: pl.DataFrame, max_terms: int = MAX_TERMS) -> dict[str, float]:
+    """Sum of l2-normalized TF-IDF weights per term over all messages.
+
+    Same weights as TfidfVectorizer(stop_words=STOPWORDS) with the default
+    token pattern and smooth idf, computed with hash aggregations in Polars
+    instead of building a sparse matrix over the whole vocabulary.
+    """
+
+    n_docs = df.height
+    stopwords = pl.Series(list(STOPWORDS))
+
+    counts = (
+        df.lazy()
+        .select(terms_expr().alias('term'))
+        .with_row_index('doc')
+        .explode('term')
+        .filter(pl.col('term').is_not_null() & ~pl.col('term').is_in(stopwords))
+        .group_by('doc', 'term')
+        .agg(pl.len().alias('tf'))
+    )
+
+    weights = (
+        counts
+        .with_columns(
+            (pl.col('tf') * (((1 + n_docs) / (1 + pl.len().over('term'))).log() + 1)).alias('weight')
+        )
+        .with_columns(
+            (pl.col('weight') / (pl.col('weight') ** 2).sum().over('doc').sqrt()).alias('weight')
+        )
+        .group_by('term')
+        .agg(pl.col('weight').sum())
+        .sort('weight', descending=True)
+        .head(max_terms)
+        .collect()
+    )
+
+    return dict(zip(weights['term'].to_list(), weights['weight'].to_list()))
+
+def generate_wordcloud(df: pl.DataFrame, chat_name: str) -> bytes:
+    """Render the wordcloud of a chat as PNG bytes."""
+
+    return render_wordcloud(term_frequencies(df))
 
-    vectorizer = TfidfVectorizer(stop_words=STOPWORDS)
-    tfidf_matrix = vectorizer.fit_transform(df['msg_content'].map_elements(clean_text, return_dtype=pl.Object))
+def render_wordcloud(word_frequencies: dict[str, float]) -> bytes:
 
-    column_sums = np.array(tfidf_matrix.sum(axis=0)).flatten()
-    column_names = vectorizer.get_feature_names_out()
-    word_frequencies = dict(zip(column_names, column_sums))
+    # wordcloud pulls in matplotlib, only the import and the rendering paths need it
+    from wordcloud import WordCloud
 
     wordcloud = WordCloud(max_font_size=80, max_words=100, stopwords=STOPWORDS, min_font_size=15)
     wordcloud.generate_from_frequencies(word_frequencies)
 
-    image_path = os.path.join('wordclouds', f'{chat_name}_wordcloud.png')
-    wordcloud.to_file(image_path)
+    buffer = io.BytesIO()
+    wordcloud.to_image().save(buffer, format='PNG')
 
-    return image_path
\ No newline at end of file
+    return buffer.getvalue()
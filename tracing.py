@@ -0,0 +1,364 @@
+"""Request-scoped tracing: a tree of timed spans per handled update.
+
+The dispatcher opens a root span for every update (see chat_executor.py),
+handlers, backend operations, LangChain steps and calls to external services
+add child spans through the `current_span` context variable. Spans opened
+outside of an update (scheduled jobs, startup) are not recorded.
+
+Finished traces are appended to TRACE_PATH as JSON lines, one trace per line,
+so that every webhook worker writes to the same file. A writer thread does
+the appending, off the event loop. `last_trace` finds the latest trace of a
+user there for the /trace command. TRACE_PATH= disables tracing.
+"""
+
+import os
+import html
+import time
+import uuid
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Iterator
+from uuid import UUID
+
+import orjson
+from langchain_core.callbacks import AsyncCallbackHandler
+
+TRACE_PATH = os.getenv('TRACE_PATH', 'traces.jsonl')
+# The sink is rotated to TRACE_PATH.1 when it grows over this size
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', 50 * 1024 * 1024))
+# How far from the end of the sink /trace looks for the last trace of a user
+TRACE_SEARCH_BYTES = 8 * 1024 * 1024
+# Spans in a trace beyond this are counted but not kept
+MAX_SPANS = 500
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+
+    def __init__(self, user_id: int | None):
+        self.trace_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.spans: list[Span] = []
+        self.dropped = 0
+
+    def to_dict(self) -> dict:
+        root = self.spans[0]
+        return {
+            'trace_id': self.trace_id,
+            'user_id': self.user_id,
+            'start': root.wall_start,
+            'duration_ms': root.duration_ms,
+            'dropped': self.dropped,
+            'spans': [span.to_dict(root.start) for span in self.spans],
+        }
+
+
+class Span:
+
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'attributes', 'start', 'wall_start', 'end', 'error')
+
+    def __init__(self, trace: Trace, name: str, parent: 'Span | None' = None, **attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = len(trace.spans) + trace.dropped
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.end = None
+        self.error = None
+
+        if len(trace.spans) < MAX_SPANS:
+            trace.spans.append(self)
+        else:
+            trace.dropped += 1
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def finish(self, error: BaseException | None = None):
+        if self.end is not None:
+            return
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = type(error).__name__
+        if self.parent_id is None:
+            SINK.write(self.trace)
+
+    def to_dict(self, trace_start: float) -> dict:
+        return {
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'offset_ms': round((self.start - trace_start) * 1000, 2),
+            'duration_ms': round(self.duration_ms, 2),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar('current_span', default=None)
+
+
+def start_span(name: str, **attributes) -> Span | None:
+    """Child span of the current span, None outside of a traced update. Not made current."""
+
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent, **attributes)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span | None]:
+    """Time a block as a child of the current span."""
+
+    child = start_span(name, **attributes)
+    if child is None:
+        yield None
+        return
+
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+
+@contextmanager
+def trace(name: str, user_id: int | None = None, **attributes) -> Iterator[Span | None]:
+    """Root span of a new trace, written to the sink when the block exits."""
+
+    if not SINK.path:
+        yield None
+        return
+
+    root = Span(Trace(user_id), name, **attributes)
+    token = current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.finish(e)
+        raise
+    finally:
+        current_span.reset(token)
+        root.finish()
+
+
+def annotate(**attributes):
+    """Add attributes to the root span of the current trace."""
+
+    current = current_span.get()
+    if current is not None:
+        current.trace.spans[0].attributes.update(attributes)
+
+
+class TracingCallbackHandler(AsyncCallbackHandler):
+    """LangChain callbacks turning chain, retriever, model and tool runs into spans.
+
+    Runs inline, so the span of a nested step is current while the step runs
+    and the HTTP calls it makes are nested under it. LangChain may end the
+    top-level run in another task than it started it, so that one is never
+    made current: it would stay current in the caller after the run.
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        self.runs: dict[UUID, tuple[Span, Span | None]] = {}
+
+    def _start(self, kind: str, serialized: dict | None, run_id: UUID, parent_run_id: UUID | None, name: str | None):
+        name = name or (serialized or {}).get('name') or ((serialized or {}).get('id') or ['unknown'])[-1]
+        parent = self.runs[parent_run_id][0] if parent_run_id in self.runs else current_span.get()
+        if parent is None:
+            return
+        child = Span(parent.trace, f'langchain.{kind}', parent, step=name)
+        if parent_run_id is None:
+            self.runs[run_id] = (child, None)
+        else:
+            self.runs[run_id] = (child, current_span.get())
+            current_span.set(child)
+
+    def _end(self, run_id: UUID, error: BaseException | None = None):
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        child, previous = run
+        child.finish(error)
+        if previous is not None and current_span.get() is child:
+            current_span.set(previous)
+
+    async def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self._start('chain', serialized, run_id, parent_run_id, kwargs.get('name'))
+
+    async def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    async def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    async def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self._start('retriever', serialized, run_id, parent_run_id, kwargs.get('name'))
+
+    async def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    async def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self._start('llm', serialized, run_id, parent_run_id, kwargs.get('name'))
+
+    async def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start('llm', serialized, run_id, parent_run_id, kwargs.get('name'))
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        self._start('tool', serialized, run_id, parent_run_id, kwargs.get('name'))
+
+    async def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    async def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+
+def langchain_config() -> dict:
+    """Runnable config adding LangChain steps to the current trace."""
+
+    if current_span.get() is None:
+        return {}
+    return {'callbacks': [TracingCallbackHandler()]}
+
+
+class TraceSink:
+    """Append-only JSONL file of finished traces.
+
+    write() only queues the trace's line, a writer thread appends the queued
+    lines, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, path: str | None, max_bytes: int = TRACE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pending: list[bytes] = []
+        self.lock = threading.Lock()
+        # Held while appending, flush() from another thread waits for the writer's batch
+        self.file_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.writer: threading.Thread | None = None
+
+    def write(self, trace: Trace):
+        if not self.path:
+            return
+        line = orjson.dumps(trace.to_dict(), default=str) + b'\n'
+        with self.lock:
+            self.pending.append(line)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Append the queued traces."""
+
+        with self.file_lock:
+            with self.lock:
+                lines, self.pending = self.pending, []
+            if not lines:
+                return
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+                # One write call per batch, appends of several workers don't interleave
+                with open(self.path, 'ab') as f:
+                    f.write(b''.join(lines))
+            except OSError:
+                logger.exception(f'Failed to write {len(lines)} traces')
+
+    def last_trace(self, user_id: int) -> dict | None:
+        """Latest trace of a user in the sink, None if there is none in its tail."""
+
+        if not self.path:
+            return None
+        self.flush()
+        needle = f'"user_id":{user_id},'.encode()
+        for path in (self.path, self.path + '.1'):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                f.seek(max(0, os.path.getsize(path) - TRACE_SEARCH_BYTES))
+                lines = f.read().split(b'\n')
+            for line in reversed(lines):
+                if needle in line:
+                    try:
+                        return orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue
+        return None
+
+
+SINK = TraceSink(TRACE_PATH)
+
+
+def format_trace(data: dict, max_lines: int = 40) -> str:
+    """HTML span tree of a trace for a Telegram message: start offset, duration, name."""
+
+    spans = data['spans']
+    children: dict[int | None, list[dict]] = {}
+    for item in spans:
+        children.setdefault(item['parent'], []).append(item)
+
+    # Longer traces keep their slowest spans, the rest is counted
+    kept = spans
+    if len(spans) > max_lines:
+        threshold = sorted((item['duration_ms'] for item in spans), reverse=True)[max_lines - 1]
+        kept = [item for item in spans if item['duration_ms'] >= threshold or item['parent'] is None][:max_lines]
+    kept_ids = {item['id'] for item in kept}
+
+    lines = []
+
+    def walk(item: dict, depth: int):
+        if item['id'] in kept_ids:
+            name = item['name']
+            details = ' '.join(f'{key}={value}' for key, value in item['attributes'].items())
+            if details:
+                name += f' [{details}]'
+            if item['error']:
+                name += f' ! {item["error"]}'
+            # Fits a Telegram message with max_lines lines
+            name = name if len(name) <= 64 else name[:63] + '…'
+            lines.append(f"{item['offset_ms']:>8.0f} {item['duration_ms']:>8.1f}  {'  ' * depth}{name}")
+        for child in children.get(item['id'], []):
+            walk(child, depth + 1 if item['id'] in kept_ids else depth)
+
+    for root in children.get(None, []):
+        walk(root, 0)
+
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data['start']))
+    header = f"Trace {data['trace_id'][:8]} of user {data['user_id']}, {started}, {data['duration_ms'] / 1000:.2f} s"
+    hidden = len(spans) - len(kept) + data.get('dropped', 0)
+    footer = f'\n{hidden} short spans hidden' if hidden else ''
+    table = f"{'at, ms':>8} {'took, ms':>8}  span\n" + '\n'.join(lines)
+    return f'{html.escape(header)}\n<pre>{html.escape(table)}</pre>{footer}'
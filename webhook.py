@@ -0,0 +1,213 @@
+"""Webhook mode: an aiohttp update server that can run as several worker processes.
+
+Telegram (or a load balancer in front of the workers) posts updates to
+WEBHOOK_PATH. Every update is acknowledged right away and handled in the
+background: redelivered updates are dropped by update_id in Redis.
+
+Updates of one chat can reach different workers, so they are not handled by
+the worker that received them. They go into a per-chat Redis queue ordered
+by update_id. Every worker that enqueued an update then takes the chat's
+Redis lock and handles the lowest update_id left in the queue, one per
+lock, until the queue is empty. Updates of a chat are handled one at a time
+and in update_id order, whichever worker runs them. The lock is extended
+while an update is handled, however long the handler takes, and expires
+soon after a worker dies. An update whose handler failed is forgotten by
+the deduplication, so a redelivery is handled again.
+
+Usage:
+    python webhook.py --workers 4 --port 8080
+"""
+
+import os
+import sys
+import asyncio
+import logging
+import argparse
+import multiprocessing
+
+import orjson
+from aiohttp import web
+from aiogram import types
+from redis.exceptions import LockError
+
+from bot import bot, dp, redis_storage, on_startup
+from chat_executor import update_chat_key
+from metrics import METRICS_PORT, QUEUE_DEPTH
+
+import dotenv
+dotenv.load_dotenv(override=True)
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base url, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))
+# Optional JSONL file to record raw updates, they can be replayed with webhook_replay.py
+WEBHOOK_RECORD_PATH = os.getenv('WEBHOOK_RECORD_PATH')
+
+UPDATE_DEDUP_TTL = 24 * 60 * 60  # Telegram gives up redelivering after 24 hours
+# The chat lock expires unless its holder extends it, every third of the timeout while it handles an update
+CHAT_LOCK_TIMEOUT = 60
+# A worker gives up waiting after this, the holder handles the queued update once it is done.
+# Longer than the timeout, so the lock of a worker that died has expired before
+CHAT_LOCK_WAIT = 2 * CHAT_LOCK_TIMEOUT
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateServer:
+
+    def __init__(self):
+        self.redis = redis_storage.redis
+        self.tasks = set()
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        first_delivery = await self.redis.set(f'update:{update_id}', 1, nx=True, ex=UPDATE_DEDUP_TTL)
+        return not first_delivery
+
+    async def process_update(self, update: types.Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            logger.exception(f'Failed to process update {update.update_id}')
+            # A redelivery of a failed update is handled again
+            await self.redis.delete(f'update:{update.update_id}')
+
+    async def enqueue(self, key: int, update_id: int, raw: bytes):
+        await (
+            self.redis.pipeline(transaction=False)
+            .zadd(f'chat_updates:{key}', {raw: update_id})
+            .expire(f'chat_updates:{key}', UPDATE_DEDUP_TTL)
+            .execute()
+        )
+
+    async def drain_chat(self, key: int):
+        """Handle the queued updates of a chat in update_id order, whichever worker received them."""
+
+        lock = self.redis.lock(f'chat_lock:{key}', timeout=CHAT_LOCK_TIMEOUT, blocking_timeout=CHAT_LOCK_WAIT)
+        while True:
+            if not await lock.acquire():
+                logger.warning(f'Chat {key} stayed locked for {CHAT_LOCK_WAIT}s, its updates are left to the lock holder')
+                return
+
+            heartbeat = asyncio.create_task(self.keep_lock(lock, key))
+            try:
+                popped = await self.redis.zpopmin(f'chat_updates:{key}')
+                if not popped:
+                    return
+                raw, _ = popped[0]
+                await self.process_update(types.Update.model_validate(orjson.loads(raw), context={'bot': bot}))
+            finally:
+                heartbeat.cancel()
+                try:
+                    await lock.release()
+                except LockError:
+                    logger.warning(f'Lock of chat {key} expired while its update was handled')
+
+    async def keep_lock(self, lock, key: int):
+        """Extend the lock of a chat for as long as one of its updates is handled."""
+
+        while True:
+            await asyncio.sleep(CHAT_LOCK_TIMEOUT / 3)
+            try:
+                await lock.reacquire()
+            except LockError:
+                logger.exception(f'Failed to extend the lock of chat {key}')
+                return
+
+    async def run_chat(self, key: int):
+        try:
+            await self.drain_chat(key)
+        except Exception:
+            logger.exception(f'Failed to handle the queued updates of chat {key}')
+
+    async def handle(self, request: web.Request) -> web.Response:
+
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+
+        raw = await request.read()
+        update = types.Update.model_validate(orjson.loads(raw), context={'bot': bot})
+
+        if await self.is_duplicate(update.update_id):
+            logger.info(f'Skipping redelivered update {update.update_id}')
+            return web.Response()
+
+        if WEBHOOK_RECORD_PATH:
+            with open(WEBHOOK_RECORD_PATH, 'ab') as f:
+                f.write(raw.strip() + b'\n')
+
+        key = update_chat_key(update)
+        if key is None:
+            task = asyncio.create_task(self.process_update(update))
+        else:
+            await self.enqueue(key, update.update_id, raw.strip())
+            task = asyncio.create_task(self.run_chat(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return web.Response()
+
+
+def create_app(is_primary: bool = True, metrics_port: int = METRICS_PORT) -> web.Application:
+
+    server = UpdateServer()
+    QUEUE_DEPTH.set_function(lambda: len(server.tasks), queue='webhook_tasks')
+
+    async def startup(app: web.Application):
+        # Only one worker runs the scheduler and registers the webhook
+        await on_startup(run_scheduler=is_primary, metrics_port=metrics_port)
+        if is_primary and WEBHOOK_URL:
+            await bot.set_webhook(
+                f'{WEBHOOK_URL}{WEBHOOK_PATH}',
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+
+    async def cleanup(app: web.Application):
+        if server.tasks:
+            await asyncio.gather(*server.tasks, return_exceptions=True)
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, server.handle)
+    app.on_startup.append(startup)
+    app.on_cleanup.append(cleanup)
+    return app
+
+
+def run_worker(worker_id: int, host: str, port: int):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    # Every worker serves its own metrics, on consecutive ports
+    metrics_port = METRICS_PORT + worker_id if METRICS_PORT else 0
+    web.run_app(create_app(is_primary=worker_id == 0, metrics_port=metrics_port), host=host, port=port, reuse_port=True, print=None)
+
+
+def run(workers: int = WEBHOOK_WORKERS, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+
+    if workers == 1:
+        run_worker(0, host, port)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(worker_id, host, port))
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run the bot in webhook mode.")
+    parser.add_argument("--workers", type=int, default=WEBHOOK_WORKERS)
+    parser.add_argument("--host", default=WEBHOOK_HOST)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    args = parser.parse_args()
+
+    run(workers=args.workers, host=args.host, port=args.port)
@@ -0,0 +1,72 @@
+"""Post recorded Telegram updates to a running webhook server.
+
+Updates are read from a JSONL file (one update per line, as written with
+WEBHOOK_RECORD_PATH) or a JSON array.
+
+Usage:
+    python webhook_replay.py updates.jsonl --url http://localhost:8080/webhook --concurrency 20
+"""
+
+import os
+import time
+import asyncio
+import argparse
+
+import orjson
+from aiohttp import ClientSession
+
+import dotenv
+dotenv.load_dotenv(override=True)
+
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, 'rb') as f:
+        contents = f.read().strip()
+    if contents.startswith(b'['):
+        return orjson.loads(contents)
+    return [orjson.loads(line) for line in contents.splitlines() if line.strip()]
+
+
+async def replay(updates: list[dict], url: str, concurrency: int, repeat: int) -> dict:
+
+    headers = {'Content-Type': 'application/json'}
+    if WEBHOOK_SECRET:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = WEBHOOK_SECRET
+
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async def post(session, update):
+        async with semaphore:
+            async with session.post(url, data=orjson.dumps(update), headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async with ClientSession() as session:
+        # Repeating the same update_id checks the redelivery deduplication
+        await asyncio.gather(*(post(session, update) for _ in range(repeat) for update in updates))
+
+    return statuses
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the webhook endpoint.")
+    parser.add_argument("updates", help="JSONL or JSON array with Telegram updates")
+    parser.add_argument("--url", default="http://localhost:8080/webhook")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1, help="Send every update this many times")
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates)
+    started = time.perf_counter()
+    statuses = asyncio.run(replay(updates, args.url, args.concurrency, args.repeat))
+    elapsed = time.perf_counter() - started
+
+    total = sum(statuses.values())
+    print(f"Posted {total} updates in {elapsed:.2f}s ({total / elapsed:.0f} updates/s), statuses: {statuses}")
+
+
+if __name__ == "__main__":
+    main()